@@ -3,13 +3,17 @@
 """marrow.mailer mail delivery framework and MIME message abstraction."""
 
 
+import hashlib
+import re
 import warnings
 import pkg_resources
 
+from collections import OrderedDict
 from email import charset
 from functools import partial
 
 from marrow.mailer.message import Message
+from marrow.mailer import msgid
 from marrow.mailer.exc import MailerNotRunning
 
 from marrow.util.compat import basestring
@@ -21,6 +25,8 @@ __all__ = ['Mailer', 'Delivery', 'Message']
 
 log = __import__('logging').getLogger(__name__)
 
+_volatile = re.compile(br'^(?:message-id|date):.*\n(?:[ \t].*\n)*', re.I | re.M)  # Headers unique to each message.
+
 
 class Mailer(object):
 	"""The primary marrow.mailer interface.
@@ -118,6 +124,7 @@ class Mailer(object):
 		
 		log.info("Mail delivery service starting.")
 		
+		msgid.hostname()  # Resolve, and cache, the local host name used in Message-IDs now rather than on first delivery.
 		self.manager.startup()
 		self.running = True
 		
@@ -139,14 +146,24 @@ class Mailer(object):
 		
 		return self
 	
-	def send(self, message):
+	def send(self, message, priority=None):
+		"""Deliver a message, returning the result of the manager's delivery.
+		
+		Background managers deliver waiting messages of high priority (1 or 2, or "high") ahead of those of normal and
+		low priority (4 or 5, "low", or "bulk").  A priority, if given, is passed to the manager alongside the message
+		and takes the place of the message's own priority in this choice; the message itself is left unaltered.
+		"""
+		
 		if not self.running:
 			raise MailerNotRunning("Mail service not running.")
 		
 		log.info("Attempting delivery of message %s.", message.id)
 		
 		try:
-			result = self.manager.deliver(message)
+			if priority is None:
+				result = self.manager.deliver(message)
+			else:
+				result = self.manager.deliver(message, priority)
 		
 		except:
 			log.error("Delivery of message %s failed.", message.id)
@@ -155,6 +172,78 @@ class Mailer(object):
 		log.debug("Message %s delivered.", message.id)
 		return result
 	
+	def asend(self, message):
+		"""Deliver a message from within an asyncio coroutine, returning an awaitable.
+		
+		Requires Python 3.5 or later.  With the asyncio manager delivery happens on the running event loop; other
+		managers are driven from the loop's default executor so the loop is never blocked.
+		"""
+		
+		if not self.running:
+			raise MailerNotRunning("Mail service not running.")
+		
+		from marrow.mailer.manager.aio import send
+		return send(self, message)
+	
+	def merge(self, prototype, records):
+		"""Deliver a personalized copy of the prototype message to each recipient described by records.
+		
+		Each record is a mapping providing the recipient as ``to`` along with the values of the replacement fields
+		used in the prototype's subject and bodies; see marrow.mailer.merge for details.  The prototype is compiled
+		once, then every message is handed to the manager before returning the list of the results of each delivery.
+		"""
+		
+		if not self.running:
+			raise MailerNotRunning("Mail service not running.")
+		
+		from marrow.mailer.merge import Template
+		template = Template(prototype)
+		
+		return [self.send(template(record, mailer=self)) for record in records]
+	
+	def bulk(self, messages):
+		"""Deliver many messages, sending those identical but for their Message-ID and Date as one.
+		
+		Messages whose rendered headers and bodies otherwise match are grouped, and each group delivered as a single
+		message addressed to the recipients of all of them: the SMTP transport uploads its content once for every
+		transaction, each naming up to the server's recipient limit, and reports the recipients refused.  The first
+		message of each group is delivered in place of the others, with its own Message-ID and Date.  Returns the list
+		of the results of the delivery of each group, in the order the groups first appear.
+		"""
+		
+		if not self.running:
+			raise MailerNotRunning("Mail service not running.")
+		
+		groups = OrderedDict()
+		
+		for message in messages:
+			headers, _, body = bytes(message).partition(b'\n\n')
+			key = hashlib.sha1(_volatile.sub(b'', headers + b'\n') + body).digest()
+			groups.setdefault(key, []).append(message)
+		
+		return [self.send(self._combine(group) if len(group) > 1 else group[0]) for group in groups.values()]
+	
+	@staticmethod
+	def _combine(group):
+		"""Produce a copy of the first of the given messages blind copied to the recipients of the others."""
+		
+		lead = group[0]
+		combined = lead.__class__.__new__(lead.__class__)
+		combined.__setstate__(lead.__getstate__())
+		
+		seen = set(lead.recipients.string_addresses)
+		bcc = list(lead.bcc)
+		
+		for message in group[1:]:
+			for recipient in message.recipients:
+				if recipient.envelope not in seen:
+					seen.add(recipient.envelope)
+					bcc.append(recipient)
+		
+		combined.bcc = bcc
+		
+		return combined
+	
 	def new(self, author=None, to=None, subject=None, **kw):
 		data = dict(self.message_config)
 		data['mailer'] = self
@@ -8,11 +8,13 @@ import sys
 from email.utils import formataddr, parseaddr
 from email.header import Header
 
-from marrow.mailer.validator import EmailValidator
+from marrow.mailer.validator import CachingEmailValidator
 from marrow.util.compat import basestring, unicode, unicodestr, native
 
 __all__ = ['Address', 'AddressList']
 
+validator = CachingEmailValidator()  # Shared by all addresses; memoizes recently validated strings.
+
 
 class Address(object):
 	"""Validated electronic mail address class.
@@ -21,11 +23,19 @@ class Address(object):
 	Python's built-in `parseaddr` and `formataddr` helper functions and helps
 	guarantee a uniform base for all e-mail address operations.
 
+	Addresses are immutable once constructed, allowing their encoded forms to
+	be calculated once and cached.
+
 	The AddressList unit tests provide comprehensive testing of this class as
 	well."""
 
+	__slots__ = ('name', 'address', 'encoding', '_envelope', '_encoded')
+
 	def __init__(self, name_or_email, email=None, encoding='utf-8'):
-		self.encoding = encoding
+		init = object.__setattr__
+		init(self, 'encoding', encoding)
+		init(self, '_envelope', None)
+		init(self, '_encoded', None)  # Encoded forms, by encoding, allocated once first needed.
 
 		if email is None:
 			if isinstance(name_or_email, AddressList):
@@ -35,28 +45,37 @@ class Address(object):
 				name_or_email = unicode(name_or_email[0])
 
 			if isinstance(name_or_email, (tuple, list)):
-				self.name = unicodestr(name_or_email[0], encoding)
-				self.address = unicodestr(name_or_email[1], encoding)
+				name = unicodestr(name_or_email[0], encoding)
+				address = unicodestr(name_or_email[1], encoding)
 
 			elif isinstance(name_or_email, bytes):
-				self.name, self.address = parseaddr(unicodestr(name_or_email, encoding))
+				name, address = parseaddr(unicodestr(name_or_email, encoding))
 
 			elif isinstance(name_or_email, unicode):
-				self.name, self.address = parseaddr(name_or_email)
+				name, address = parseaddr(name_or_email)
 
 			else:
 				raise TypeError('Expected string, tuple or list, got {0} instead'.format(
 						repr(type(name_or_email))
 					))
 		else:
-			self.name = unicodestr(name_or_email, encoding)
-			self.address = unicodestr(email, encoding)
+			name = unicodestr(name_or_email, encoding)
+			address = unicodestr(email, encoding)
+
+		init(self, 'name', name)
+		init(self, 'address', address)
 
-		email, err = EmailValidator().validate_email(self.address)
+		email, err = validator.validate_email(address)
 
 		if err:
 			raise ValueError('"{0}" is not a valid e-mail address: {1}'.format(email, err))
 
+	def __setattr__(self, name, value):
+		raise AttributeError("Address instances are immutable; construct a new Address instead.")
+
+	def __reduce__(self):
+		return self.__class__, ((self.name, self.address), None, self.encoding)
+
 	def __eq__(self, other):
 		if isinstance(other, Address):
 			return (self.name, self.address) == (other.name, other.address)
@@ -75,6 +94,10 @@ class Address(object):
 	def __ne__(self, other):
 		return not self == other
 
+	def __hash__(self):
+		# Consistent with equality against the (unicode) string form, e.g. for membership tests of a set.
+		return hash(unicode(self))
+
 	def __len__(self):
 		return len(self.__unicode__())
 
@@ -94,11 +117,16 @@ class Address(object):
 		__str__ = __unicode__
 
 	def encode(self, encoding=None):
-		name_string = None
-		
 		if encoding is None:
 			encoding = self.encoding
 		
+		encoded = self._encoded
+		
+		if encoded is not None and encoding in encoded:
+			return encoded[encoding]
+		
+		name_string = None
+		
 		if encoding != 'ascii':
 			try:  # This nonsense is to preserve Python 2 behaviour. Python 3 utf-8 encodes when asked for ascii!
 				self.name.encode('ascii', errors='strict')
@@ -110,24 +138,54 @@ class Address(object):
 		if name_string is None:
 			name_string = Header(self.name, encoding).encode()
 		
-		# Encode punycode for internationalized domains.
-		localpart, domain = self.address.split('@', 1)
-		domain = domain.encode('idna').decode()
-		address = '@'.join((localpart, domain))
+		value = formataddr((name_string, self.envelope)).replace('\n', '').encode(encoding)
+		
+		if encoded is None:
+			encoded = {}
+			object.__setattr__(self, '_encoded', encoded)
+		
+		encoded[encoding] = value
+		
+		return value
 
-		return formataddr((name_string, address)).replace('\n', '').encode(encoding)
+	@property
+	def envelope(self):
+		"""The bare address, with any internationalized domain punycode encoded, as used in an SMTP envelope."""
+		
+		if self._envelope is None:
+			localpart, domain = self.address.split('@', 1)
+			domain = domain.encode('idna').decode()
+			object.__setattr__(self, '_envelope', '@'.join((localpart, domain)))
+		
+		return self._envelope
 
 	@property
 	def valid(self):
-		email, err = EmailValidator().validate_email(self.address)
+		email, err = validator.validate_email(self.address)
 		return False if err else True
 
 
+def _invalidating(method):
+	"""Wrap a list method to discard the cached, joined forms of an AddressList before it is called."""
+	
+	def inner(self, *args, **kw):
+		self._encoded = None
+		return method(self, *args, **kw)
+	
+	inner.__name__ = method.__name__
+	inner.__doc__ = method.__doc__
+	
+	return inner
+
+
 class AddressList(list):
+	__slots__ = ('encoding', '_encoded')
+	
 	def __init__(self, addresses=None, encoding="utf-8"):
 		super(AddressList, self).__init__()
 
 		self.encoding = encoding
+		self._encoded = None  # Joined header values, by encoding, until the list changes.
 
 		if addresses is None:
 			return
@@ -144,6 +202,16 @@ class AddressList(list):
 
 		self.extend(addresses)
 
+	def __reduce__(self):
+		return self.__class__, (list(self), self.encoding)
+
+	def __setstate__(self, state):
+		"""Restore the attributes of a list pickled before AddressList was slotted."""
+
+		for name in self.__slots__:
+			if name in state:
+				setattr(self, name, state[name])
+
 	def __repr__(self):
 		if not self:
 			return "AddressList()"
@@ -154,7 +222,7 @@ class AddressList(list):
 		return self.encode()
 
 	def __unicode__(self):
-		return ", ".join(unicode(i) for i in self)
+		return self._cached(None, lambda: ", ".join(unicode(i) for i in self))
 
 	if sys.version_info < (3, 0):
 		__str__ = __bytes__
@@ -162,6 +230,19 @@ class AddressList(list):
 	else:  # pragma: no cover
 		__str__ = __unicode__
 
+	def _cached(self, key, produce):
+		cache = getattr(self, '_encoded', None)  # Absent if unpickled from an older release.
+		
+		if cache is None:
+			cache = self._encoded = {}
+		
+		try:
+			return cache[key]
+		
+		except KeyError:
+			value = cache[key] = produce()
+			return value
+
 	def __setitem__(self, k, value):
 		if isinstance(k, slice):
 			value = [Address(val) if not isinstance(val, Address) else val for val in value]
@@ -169,17 +250,23 @@ class AddressList(list):
 		elif not isinstance(value, Address):
 			value = Address(value)
 
+		self._encoded = None
 		super(AddressList, self).__setitem__(k, value)
 
 	def __setslice__(self, i, j, sequence):
 		self.__setitem__(slice(i, j), sequence)
 
+	def __iadd__(self, sequence):
+		self.extend(sequence)
+		return self
+
 	def encode(self, encoding=None):
 		encoding = encoding if encoding else self.encoding
-		return b", ".join([a.encode(encoding) for a in self])
+		return self._cached(encoding, lambda: b", ".join([a.encode(encoding) for a in self]))
 
 	def extend(self, sequence):
 		values = [Address(val) if not isinstance(val, Address) else val for val in sequence]
+		self._encoded = None
 		super(AddressList, self).extend(values)
 
 	def append(self, value):
@@ -190,15 +277,19 @@ class AddressList(list):
 		return AddressList([i.address for i in self])
 
 	@property
-	def string_addresses(self, encoding=None):
+	def string_addresses(self):
 		"""Return a list of string representations of the addresses suitable
 		for usage in an SMTP transaction."""
 		
-		if not encoding:
-			encoding = self.encoding
-		
 		# We need the punycode goodness.
-		return [Address(i.address).encode(encoding).decode(encoding) for i in self]
+		return [i.envelope for i in self]
+
+
+for _method in ('__delitem__', '__delslice__', '__imul__', 'insert', 'pop', 'remove', 'reverse', 'sort', 'clear'):
+	if hasattr(list, _method):
+		setattr(AddressList, _method, _invalidating(getattr(list, _method)))
+
+del _method
 
 
 class AutoConverter(object):
@@ -210,10 +301,18 @@ class AutoConverter(object):
 		self.attr = native(attr)
 
 	def __get__(self, instance, owner):
+		if instance is None:
+			return self
+
 		value = getattr(instance, self.attr, None)
 
 		if value is None:
-			return self.cls() if self.can else None
+			if not self.can:
+				return None
+
+			# Allocated on first use and retained, so that the empty value may be modified in place.
+			value = self.cls()
+			object.__setattr__(instance, self.attr, value)
 
 		return value
 
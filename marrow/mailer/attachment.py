@@ -0,0 +1,262 @@
+# encoding: utf-8
+
+"""MIME parts whose content is read and encoded only when the message is serialized."""
+
+from __future__ import unicode_literals
+
+import base64
+import hashlib
+import mmap
+import os
+
+from collections import OrderedDict
+from email.mime.nonmultipart import MIMENonMultipart
+from threading import Lock
+
+from marrow.util.compat import native
+
+
+__all__ = ['Attachment', 'AttachmentCache', 'cache']
+
+
+_encode = getattr(base64, 'encodebytes', None) or base64.encodestring
+
+# Each base64 line encodes 57 bytes, so chunks of a multiple of that size concatenate into a single valid encoding.
+CHUNK = 57 * 1024
+
+
+class Attachment(MIMENonMultipart, object):
+	"""A base64-encoded MIME part referencing its content rather than holding an encoded copy of it.
+
+	The content is given either as the path of a file, or as data: a byte string, bytearray, mmap, or a seekable
+	binary file object positioned at the start of the content.  Nothing is read until the message is serialized;
+	message streaming encodes the content a chunk at a time, while ``get_payload()`` and ``as_string()`` produce the
+	complete encoding on demand.  Files small enough to be held by the given AttachmentCache are instead encoded whole,
+	as each is serialized, and the encoding shared with other attachments of the same file.
+
+	File objects must remain open, and paths must remain readable, until the message has been delivered.
+	"""
+
+	def __init__(self, maintype, subtype, data=None, path=None, encoded=None, cache=None, **params):
+		self._path = path
+		self._cache = cache
+		self._source = None
+		self._offset = 0
+		self._text = encoded  # A pre-encoded payload, such as one shared through the attachment cache.
+
+		MIMENonMultipart.__init__(self, maintype, subtype, **params)
+		self.add_header('Content-Transfer-Encoding', 'base64')
+
+		if path is not None or encoded is not None:
+			return
+
+		if isinstance(data, (bytes, bytearray, mmap.mmap)):
+			self._source = data
+			return
+
+		if hasattr(data, 'read'):
+			try:
+				self._offset = data.tell()
+				seekable = data.seekable() if hasattr(data, 'seekable') else hasattr(data, 'seek')
+
+			except (AttributeError, IOError, OSError):
+				seekable = False
+
+			# Content that can not be re-read on demand must be captured now.
+			self._source = data if seekable else data.read()
+			return
+
+		raise TypeError("Unable to read attachment contents")
+
+	def __getstate__(self):
+		"""Pickle file and mmap sources by value; they can not survive a process boundary as references."""
+
+		state = self.__dict__.copy()
+		state['_cache'] = None  # Process-wide; the file is read anew once unpickled.
+
+		if self._path is None and self._source is not None and not isinstance(self._source, bytes):
+			state['_source'] = self.read()
+			state['_offset'] = 0
+
+		return state
+
+	@property
+	def _payload(self):
+		if self._text is not None:
+			return self._text
+
+		return self._cached() or ''.join(self.iter_payload())
+
+	@_payload.setter
+	def _payload(self, value):
+		# The email package initializes the payload to None; any real assignment replaces the referenced content.
+		if value is not None:
+			self._text = value
+
+	def is_multipart(self):
+		return False
+
+	def _cached(self):
+		"""Return the shared encoding of the file, if the cache will hold it; looked up afresh for each serialization."""
+
+		cache = self._cache
+
+		if cache is None or self._path is None:
+			return None
+
+		key = cache.key(path=self._path)
+
+		return cache.encoded(key, path=self._path) if key else None
+
+	def get_payload(self, i=None, decode=False):
+		if decode and self._text is None and i is None:
+			return self.read()
+
+		return super(Attachment, self).get_payload(i, decode)
+
+	def chunks(self, size=CHUNK):
+		"""Yield the unencoded content as a series of byte strings of at most size bytes."""
+
+		if self._path is not None:
+			with open(self._path, 'rb') as fh:
+				for chunk in iter(lambda: fh.read(size), b''):
+					yield chunk
+
+			return
+
+		source = self._source
+
+		if hasattr(source, 'read') and not isinstance(source, mmap.mmap):
+			source.seek(self._offset)
+
+			for chunk in iter(lambda: source.read(size), b''):
+				yield chunk
+
+			return
+
+		for i in range(0, len(source), size):
+			yield bytes(source[i:i + size])
+
+	def read(self):
+		"""Return the complete unencoded content."""
+
+		return b''.join(self.chunks())
+
+	def iter_payload(self):
+		"""Yield the encoded payload incrementally, as a series of newline-terminated strings."""
+
+		text = self._text if self._text is not None else self._cached()
+
+		if text is not None:
+			yield text
+			return
+
+		for chunk in self.chunks():
+			yield native(_encode(chunk))
+
+
+class AttachmentCache(object):
+	"""A process-wide store of base64-encoded attachment payloads, shared between messages.
+
+	Files are identified by path, size, and modification time, and in-memory content by a SHA-256 digest.  The
+	encoded text is immutable, so each message attaching the same content references a single copy.  The least
+	recently used payloads are evicted once their combined length exceeds *budget* characters; content larger than
+	*limit* bytes is never cached, and is instead read and encoded lazily for each message.
+
+	The image types identified by Message.embed are remembered for cached files, too.
+
+	Instances are safe to share between threads.
+	"""
+
+	__slots__ = ('budget', 'limit', 'size', 'hits', 'misses', '_entries', '_kinds', '_lock')
+
+	def __init__(self, budget=32 * 1024 * 1024, limit=None):
+		self.budget = budget
+		self.limit = budget // 8 if limit is None else limit
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+		self._kinds = OrderedDict()
+		self._lock = Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def key(self, data=None, path=None):
+		"""Identify the given content, returning None if it should not be cached."""
+
+		if path is not None:
+			stat = os.stat(path)
+
+			if stat.st_size > self.limit:
+				return None
+
+			return ('path', os.path.abspath(path), stat.st_size, getattr(stat, 'st_mtime_ns', stat.st_mtime),
+					stat.st_ino)
+
+		if isinstance(data, (bytes, bytearray)) and len(data) <= self.limit:
+			return ('sha256', hashlib.sha256(data).digest())
+
+		return None
+
+	def encoded(self, key, data=None, path=None):
+		"""Return the shared encoding of the content identified by key, encoding and remembering it if needed."""
+
+		entries = self._entries
+
+		with self._lock:
+			text = entries.pop(key, None)
+
+			if text is not None:
+				entries[key] = text  # Mark as most recently used.
+				self.hits += 1
+				return text
+
+			self.misses += 1
+
+		if path is not None:
+			with open(path, 'rb') as fh:
+				data = fh.read()
+
+		text = native(_encode(bytes(data)))
+
+		with self._lock:
+			if key in entries:  # Another thread got here first; share its copy.
+				return entries[key]
+
+			entries[key] = text
+			self.size += len(text)
+
+			while self.size > self.budget and entries:
+				evicted, value = entries.popitem(last=False)
+				self._kinds.pop(evicted, None)
+				self.size -= len(value)
+
+		return text
+
+	def kind(self, key, sniff):
+		"""Return the remembered image type of the content identified by key, otherwise the result of sniff()."""
+
+		with self._lock:
+			if key in self._kinds:
+				return self._kinds[key]
+
+		result = sniff()
+
+		with self._lock:
+			self._kinds[key] = result
+
+			if len(self._kinds) > 4096:
+				self._kinds.popitem(last=False)
+
+		return result
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._kinds.clear()
+			self.size = 0
+
+
+cache = AttachmentCache()  # Shared by all messages; set its budget to zero to disable caching.
@@ -0,0 +1,82 @@
+# encoding: utf-8
+
+"""Build MIME documents using the modern email package API.
+
+Requires Python 3.6 or later.  Where the default builder in Message.mime uses the legacy ``MIMEText`` and
+``MIMEMultipart`` classes, relying on the globally registered UTF-8 charset for its body encoding, these builders
+produce an ``EmailMessage`` governed by an ``email.policy``:
+
+ * the document serializes directly to CRLF-terminated bytes suitable for SMTP;
+ * each text part is given the cheapest transfer encoding able to carry it: 7bit, quoted-printable, or base64
+   (8bit too, if the policy permits it); and
+ * headers are encoded by the policy's header registry rather than the legacy Header class.
+
+Select one by name using the ``builder`` attribute of a Message, or the ``message.builder`` configuration directive.
+"""
+
+from email.message import EmailMessage, MIMEPart
+from email import policy as policies
+
+
+__all__ = ['SMTP', 'SMTPUTF8', 'Builder', 'builders']
+
+
+SMTP = policies.SMTP.clone(cte_type='7bit')  # Safe for any SMTP server.
+SMTPUTF8 = policies.SMTPUTF8  # Requires the 8BITMIME and SMTPUTF8 extensions of the receiving server.
+
+
+class Builder(object):
+	"""Produce the MIME document for a Message under the given policy."""
+
+	__slots__ = ('policy', )
+
+	def __init__(self, policy):
+		self.policy = policy
+
+	def text(self, content, subtype, charset, cls=MIMEPart):
+		part = cls(policy=self.policy)
+		part.set_content(content, subtype=subtype, charset=charset)  # Chooses the transfer encoding.
+		return part
+
+	def container(self, subtype, parts, cls=MIMEPart):
+		container = cls(policy=self.policy)
+		container['Content-Type'] = 'multipart/' + subtype
+
+		if cls is EmailMessage:
+			container['MIME-Version'] = '1.0'
+
+		for part in parts:
+			container.attach(part)
+
+		return container
+
+	def __call__(self, message, plain, rich=None):
+		"""Build the document from the message and its already-rendered plain and rich text bodies."""
+
+		charset = message.encoding
+		outer = [] if message.attachments else [EmailMessage]  # The class of the outermost part.
+
+		if not rich:
+			document = self.text(plain, 'plain', charset, *outer)
+
+		else:
+			plain = self.text(plain, 'plain', charset)
+			rich = self.text(rich, 'html', charset)
+
+			if message.embedded:
+				rich = self.container('related', [rich] + list(message.embedded))
+
+			document = self.container('alternative', [plain, rich], *outer)
+
+		if message.attachments:
+			document = self.container('mixed', [document] + list(message.attachments), EmailMessage)
+
+		message._add_headers_to_message(document, message._build_header_list(message.author, message.sender))
+
+		return document
+
+
+builders = {
+		'smtp': Builder(SMTP),
+		'smtputf8': Builder(SMTPUTF8),
+	}
@@ -10,7 +10,10 @@ __all__ = [
         'TransportFailedException',
         'MessageFailedException',
         'TransportExhaustedException',
-        'ManagerException'
+        'ManagerException',
+        'TransportPoolTimeoutException',
+        'QueueFullException',
+        'RateLimitedException'
     ]
 
 
@@ -81,11 +84,35 @@ class MessageFailedException(TransportException):
 class TransportExhaustedException(TransportException):
     """The transport has successfully delivered the message, but can no longer
     be used for future message delivery; a new instance should be used on the
-    next request."""
+    next request.  The delivery result, if any, is available as e.result."""
     
-    pass
+    def __init__(self, *args, **kw):
+        self.result = kw.pop('result', None)
+        
+        super(TransportExhaustedException, self).__init__(*args, **kw)
 
 
 class ManagerException(MailException):
     """The base for all marrow.mailer Manager exceptions."""
     pass
+
+
+class TransportPoolTimeoutException(ManagerException):
+    """No transport became available within the transport pool's timeout."""
+    
+    pass
+
+
+class QueueFullException(ManagerException):
+    """The manager's delivery queue is at capacity and the message was not accepted; try again later."""
+    
+    pass
+
+
+class RateLimitedException(ManagerException):
+    """Delivery of the message would exceed a configured rate; it should be attempted again after delay seconds."""
+    
+    def __init__(self, delay):
+        self.delay = delay
+        
+        super(RateLimitedException, self).__init__(delay)
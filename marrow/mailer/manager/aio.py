@@ -0,0 +1,216 @@
+# encoding: utf-8
+
+"""Deliver messages concurrently from a single asyncio event loop.
+
+Requires Python 3.5 or later and a transport whose startup, deliver, and shutdown methods are coroutines, such as the
+asynchronous SMTP transport.
+"""
+
+import asyncio
+
+from concurrent import futures
+
+from marrow.util.convert import boolean
+
+from marrow.mailer.exc import TransportExhaustedException, TransportFailedException, DeliveryFailedException, MessageFailedException
+from marrow.mailer.manager.util import Backoff
+
+
+__all__ = ['AsyncManager', 'send']
+
+log = __import__('logging').getLogger(__name__)
+
+
+
+async def send(mailer, message):
+    """Deliver a message through the given Mailer from within a coroutine.
+
+    Asynchronous managers are awaited directly; blocking managers are driven from the default executor so the event
+    loop is never stalled, and any Future they return is awaited in turn.
+    """
+
+    if getattr(mailer.manager, 'asynchronous', False):
+        return await mailer.send(message)
+
+    result = await asyncio.get_event_loop().run_in_executor(None, mailer.send, message)
+
+    if isinstance(result, futures.Future):
+        result = await asyncio.wrap_future(result)
+
+    return result
+
+
+
+class AsyncManager(object):
+    """Multiplex many concurrent deliveries over a pool of asynchronous transports.
+
+    Accepts the following configuration directives, in addition to those understood by Backoff:
+
+     * workers - the maximum number of simultaneous deliveries (and thus open transports)
+     * pool_probe - before re-use, await the transport's probe() coroutine (if any) and discard it on a false result
+
+    Failed deliveries are retried, up to message.retries times, after a backoff delay during which they hold neither a
+    transport nor a worker slot.
+
+    Deliveries must be initiated from the thread running the event loop; each returns an asyncio Task resolving to
+    the same (message, result) tuple the other managers produce.
+    """
+
+    __slots__ = ('workers', 'transport', 'transports', 'slots', 'loop', 'running', 'backoff', 'probe')
+
+    name = "Asyncio"
+    asynchronous = True
+
+    def __init__(self, config, transport):
+        self.workers = int(config.get('workers', 100))
+        self.transport = transport
+        self.backoff = Backoff(config)
+        self.probe = boolean(config.get('pool_probe', False))
+
+        self.transports = []  # Idle transports; the most recently used is re-used first.
+        self.slots = None
+        self.loop = None
+        self.running = False
+
+        super(AsyncManager, self).__init__()
+
+    def startup(self):
+        log.info("%s manager starting.", self.name)
+
+        self.running = True
+
+        log.info("%s manager ready.", self.name)
+
+    def _bind(self):
+        """Associate the manager with the running event loop, discarding transports bound to a previous loop."""
+
+        loop = asyncio.get_event_loop()
+
+        if loop is self.loop:
+            return
+
+        if self.loop is not None and not self.loop.is_closed():
+            for transport in self.transports:
+                close = getattr(transport, 'close', None)
+
+                if close:
+                    close()
+
+        del self.transports[:]
+
+        self.loop = loop
+        self.slots = asyncio.Semaphore(self.workers)
+
+    def deliver(self, message, priority=None):
+        # Deliveries are not queued; each begins as soon as a worker slot is free, whatever its priority.
+        self._bind()
+        return asyncio.ensure_future(self._deliver(message))
+
+    async def _deliver(self, message):
+        attempt = 0
+
+        while True:
+            # Each attempt occupies a worker slot; a failed attempt gives its slot up while awaiting the retry.
+            async with self.slots:
+                transport = await self._acquire()
+
+                try:
+                    result = await transport.deliver(message)
+
+                except MessageFailedException as e:
+                    self._release(transport)
+                    raise DeliveryFailedException(message, e.args[0] if e.args else "No reason given.")
+
+                except TransportFailedException:
+                    # The transport has suffered an internal error; it is
+                    # discarded and delivery attempted again later.
+                    await transport.shutdown()
+
+                except TransportExhaustedException as e:
+                    # The transport sent the message, but pre-emptively
+                    # informed us that future attempts will not be successful.
+                    await transport.shutdown()
+                    return message, e.result
+
+                except:
+                    log.error("Shutting down transport due to unhandled exception.", exc_info=True)
+                    await transport.shutdown()
+                    raise
+
+                else:
+                    self._release(transport)
+                    return message, result
+
+            if message.retries <= 0:
+                raise DeliveryFailedException(message, "Transport failed; retries exhausted.")
+
+            message.retries -= 1
+            delay = self.backoff(attempt)
+            attempt += 1
+
+            log.info("Retrying delivery in %.2f seconds; %d retr%s remaining.", delay, message.retries,
+                    "y" if message.retries == 1 else "ies")
+            await asyncio.sleep(delay)
+
+    async def _acquire(self):
+        while self.transports:
+            transport = self.transports.pop()
+
+            if await self._healthy(transport):
+                log.debug("Acquired existing transport instance.")
+                return transport
+
+            log.debug("Discarding transport instance which failed its health check.")
+            await transport.shutdown()
+
+        log.debug("Unable to acquire existing transport, initalizing new instance.")
+        transport = self.transport()
+        await transport.startup()
+
+        return transport
+
+    async def _healthy(self, transport):
+        probe = getattr(transport, 'probe', None)
+
+        if not self.probe or probe is None:
+            return True
+
+        try:
+            return await probe()
+
+        except Exception: # pragma: no cover
+            log.debug("Transport health check raised an exception.", exc_info=True)
+            return False
+
+    def _release(self, transport):
+        if not self.running or getattr(transport, 'ephemeral', False):
+            asyncio.ensure_future(transport.shutdown())
+            return
+
+        log.debug("Scheduling transport instance for re-use.")
+        self.transports.append(transport)
+
+    def shutdown(self):
+        """Close idle transports.
+
+        When called from within a running event loop this returns a Task the caller may await; otherwise the loop is
+        run until every transport has disconnected.
+        """
+
+        log.info("%s manager stopping.", self.name)
+
+        self.running = False
+        transports, self.transports = self.transports, []
+
+        if self.loop is None or self.loop.is_closed() or not transports:
+            log.info("%s manager stopped.", self.name)
+            return
+
+        log.debug("Draining transport pool.")
+        closing = asyncio.gather(*[self.loop.create_task(transport.shutdown()) for transport in transports])
+
+        if self.loop.is_running():
+            return closing
+
+        self.loop.run_until_complete(closing)
+        log.info("%s manager stopped.", self.name)
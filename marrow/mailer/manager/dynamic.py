@@ -1,15 +1,21 @@
 # encoding: utf-8
 
 import atexit
+import pickle
+import tempfile
 import threading
 import weakref
 import sys
 import math
 
+from collections import deque
 from functools import partial
 
-from marrow.mailer.manager.futures import worker
-from marrow.mailer.manager.util import TransportPool
+from marrow.util.convert import boolean
+
+from marrow.mailer.exc import QueueFullException, RateLimitedException, TransportFailedException
+from marrow.mailer.manager.futures import FuturesManager
+from marrow.mailer.manager.util import LANES, Concurrency, LaneQueue, Priority, choose, clock
 
 try:
     import queue
@@ -29,11 +35,20 @@ log = __import__('logging').getLogger(__name__)
 
 def thread_worker(executor, jobs, timeout, maximum):
     i = maximum + 1
+    exhausted = False
 
     try:
         while i:
             i -= 1
 
+            runner = executor()
+
+            if runner is not None and runner._regulate():
+                log.debug("Worker retired to reduce concurrency.")
+                break
+
+            del runner
+
             try:
                 work = jobs.get(True, timeout)
 
@@ -53,10 +68,31 @@ def thread_worker(executor, jobs, timeout, maximum):
                 break
 
             else:
-                work.run()
+                runner = executor()
+                work = runner._admit(work) if runner is not None else work
+                del runner
+
+                retire = False
+
+                while work is not None:  # Run the work, then any held for its shard.
+                    work.run()
+
+                    runner = executor()
+                    work = runner._release(work) if runner is not None else None
+
+                    if work is not None and runner._regulate():
+                        runner._relinquish(work)
+                        work, retire = None, True
+
+                    del runner
+
+                if retire:
+                    log.debug("Worker retired to reduce concurrency.")
+                    break
 
         else:  # pragma: no cover
             log.debug("Worker death from exhaustion.")
+            exhausted = True
 
     except:  # pragma: no cover
         log.critical("Unhandled exception in worker.", exc_info=True)
@@ -65,15 +101,20 @@ def thread_worker(executor, jobs, timeout, maximum):
     if runner:
         runner._threads.discard(threading.current_thread())
 
+        if exhausted:  # Replace this thread if work remains.
+            runner._replenish()
+
 
 class WorkItem(object):
-    __slots__ = ('future', 'fn', 'args', 'kwargs')
+    __slots__ = ('future', 'fn', 'args', 'kwargs', 'queued', 'shard')
 
     def __init__(self, future, fn, args, kwargs):
         self.future = future
         self.fn = fn
         self.args = args
         self.kwargs = kwargs
+        self.queued = clock()
+        self.shard = None
 
     def run(self):
         if not self.future.set_running_or_notify_cancel():
@@ -90,42 +131,483 @@ class WorkItem(object):
             self.future.set_result(result)
 
 
+def domain(message):
+    """Shard messages by recipient domain; a message to several domains is sharded by the first, alphabetically."""
+
+    domains = set(address.address.rpartition('@')[2].lower() for address in getattr(message, 'recipients', ()))
+    return min(domains) if domains else None
+
+
+class Exchanger(object):
+    """Shard messages by the most preferred mail exchanger of their recipient domain, as returned by domain().
+
+    Domains served by the same provider share a shard.  Requires the PyDNS package; lookups are cached, and a domain
+    whose lookup fails or takes longer than timeout seconds is its own shard.
+    """
+
+    __slots__ = ('dns', 'timeout', 'cache', 'size', 'lock')
+
+    def __init__(self, timeout=5, size=4096):
+        try:
+            import DNS
+        except ImportError:
+            raise ImportError("To shard by mail exchanger install the PyDNS package.")
+
+        self.dns = DNS
+        self.timeout = timeout
+        self.cache = {}
+        self.size = size
+        self.lock = threading.Lock()
+
+    def __call__(self, message):
+        name = domain(message)
+
+        if name is None:
+            return None
+
+        with self.lock:
+            if name in self.cache:
+                return self.cache[name]
+
+        try:
+            request = self.dns.Request(name, qtype='mx', timeout=self.timeout)
+            records = [answer['data'] for answer in request.req().answers]
+
+        except Exception:
+            log.warning("Unable to look up the mail exchanger of %s; sharding by domain.", name, exc_info=True)
+            records = None
+
+        key = min(records)[1].lower() if records else name
+
+        with self.lock:
+            if len(self.cache) >= self.size:
+                self.cache.clear()
+
+            self.cache[name] = key
+
+        return key
+
+
+shards = {
+        'domain': lambda config: domain,
+        'mx': lambda config: Exchanger(float(config.get('shard_timeout', 5))),
+    }
+
+
+def _throttled(result):
+    """Determine if a delivery result reports recipients temporarily refused, e.g. by a rate limit."""
+
+    if not isinstance(result, dict):
+        return False
+
+    for reply in result.values():
+        try:
+            if 400 <= int(reply[0]) < 500:
+                return True
+
+        except (TypeError, ValueError, IndexError):
+            continue
+
+    return False
+
+
+def measured(concurrency, fn, message):
+    """Make a delivery attempt, reporting its latency and any sign of congestion to the concurrency limit."""
+
+    start = clock()
+
+    try:
+        result = fn(message)
+
+    except TransportFailedException:
+        concurrency(clock() - start, True)
+        raise
+
+    except RateLimitedException:  # No delivery was attempted.
+        raise
+
+    except Exception:
+        concurrency(clock() - start)
+        raise
+
+    concurrency(clock() - start, _throttled(result[1]))
+
+    return result
+
+
+class Overflow(object):
+    """Work items whose arguments are kept in a temporary file rather than in memory.
+
+    Only the future and callable of each item are retained; the arguments (for a delivery, the message) are pickled
+    to disk and loaded again as the item is returned to the queue.  Items are kept in lanes, and returned from them
+    with the same weighted fairness as the queue's own.
+    """
+
+    __slots__ = ('path', 'file', 'lanes', 'weights', 'credit', 'starvation', 'count', 'lock')
+
+    def __init__(self, path=None, weights=None, starvation=None):
+        self.path = path
+        self.file = None
+        self.weights = dict(weights or LANES)
+        self.lanes = dict((name, deque()) for name in self.weights)
+        self.credit = dict((name, 0) for name in self.weights)
+        self.starvation = starvation
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, work, lane):
+        """Write the given work item to disk, returning False if its arguments can not be pickled."""
+
+        try:
+            payload = pickle.dumps(work.args, pickle.HIGHEST_PROTOCOL)
+
+        except Exception:
+            return False
+
+        with self.lock:
+            if self.file is None:
+                self.file = tempfile.TemporaryFile(dir=self.path)
+
+            self.file.seek(0, 2)
+            entry = (work.future, work.fn, work.kwargs, work.queued, self.file.tell(), len(payload))
+            self.lanes[lane].append((work.queued, entry))
+            self.count += 1
+            self.file.write(payload)
+
+        return True
+
+    def pop(self):
+        """Remove and return the next work item, or None if there are none."""
+
+        with self.lock:
+            lane = choose(self.lanes, self.weights, self.credit, self.starvation)
+
+            if lane is None:
+                return None
+
+            future, fn, kwargs, queued, offset, length = self.lanes[lane].popleft()[1]
+            self.count -= 1
+            self.file.seek(offset)
+            payload = self.file.read(length)
+
+            if not self.count:  # Reclaim the space once drained.
+                self.file.seek(0)
+                self.file.truncate()
+
+        work = WorkItem(future, fn, pickle.loads(payload), kwargs)
+        work.queued = queued
+
+        return work
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class WorkQueue(LaneQueue):
+    """A lane queue of work items holding at most capacity of them, applying a policy when full.
+
+    The policies are:
+
+     * block - wait up to timeout seconds (forever, if None) for room, then raise QueueFullException
+     * raise - raise QueueFullException immediately
+     * spill - write the work to an Overflow on disk, returning it to the queue as room becomes available
+
+    A capacity of zero is unlimited.  Items taken from the queue but set aside, see hold(), count against the
+    capacity until taken up.  The number of items waiting, the time spent waiting by the most recently dequeued item
+    and an average of the same, and the number of items rejected and spilled are tracked.
+    """
+
+    policies = ('block', 'raise', 'spill')
+
+    def __init__(self, capacity=0, policy='block', timeout=None, path=None, lanes=None, starvation=None):
+        if policy not in self.policies:
+            raise ValueError("Unknown queue overflow policy: %s" % (policy, ))
+
+        super(WorkQueue, self).__init__(lanes, starvation, capacity)
+
+        self.policy = policy
+        self.timeout = timeout
+        self.overflow = Overflow(path, self.weights, starvation) if policy == 'spill' else None
+
+        self.wait = 0.0  # Seconds the most recently dequeued item spent waiting.
+        self.average = 0.0  # Exponentially weighted moving average of the same.
+        self.rejected = 0
+        self.spilled = 0
+        self.held = 0  # Items set aside by the consumer, still counted against capacity.
+
+    @property
+    def depth(self):
+        """The number of items waiting, in memory or on disk."""
+        return self.qsize() + (len(self.overflow) if self.overflow is not None else 0)
+
+    def full(self):
+        with self.mutex:
+            return 0 < self.maxsize <= self._qsize() + self.held
+
+    def hold(self, count):
+        """Count items set aside after being taken from the queue (a positive count), or since taken up (negative)."""
+
+        with self.not_full:
+            self.held += count
+
+            if count < 0:
+                self.not_full.notify(-count)
+
+        if count < 0 and self.overflow is not None and len(self.overflow):
+            self._refill()
+
+    def put(self, work, admit=True):
+        """Add work to the queue; unless admit is true, the capacity is ignored."""
+
+        if not admit or not self.maxsize:
+            return self.force(work)
+
+        overflow = self.overflow
+
+        if overflow is not None:
+            if len(overflow) or self.full():  # Once spilling, keep spilling so as to preserve ordering.
+                if overflow.append(work, self.lane(work)):
+                    self.spilled += 1
+
+                    if not self.full():  # The queue drained while the work was being written.
+                        self._refill()
+
+                    return
+
+                log.warning("Unable to spill work to disk; queueing it in memory regardless of capacity.")
+                return self.force(work)
+
+            return self.force(work)
+
+        deadline = None if self.timeout is None else clock() + self.timeout
+
+        with self.not_full:
+            while self._qsize() + self.held >= self.maxsize:
+                remaining = None if deadline is None else deadline - clock()
+
+                if self.policy != 'block' or (remaining is not None and remaining <= 0):
+                    self.rejected += 1
+                    raise QueueFullException("The delivery queue is full (%d waiting)." % (self.maxsize, ))
+
+                self.not_full.wait(remaining)
+
+            self._put(work)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def force(self, work):
+        """Add work to the queue regardless of its capacity."""
+
+        with self.not_full:
+            self._put(work)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        work = queue.Queue.get(self, block, timeout)
+
+        if work is not None:
+            self.wait = wait = clock() - work.queued
+            self.average += (wait - self.average) * 0.1
+
+        if self.overflow is not None and len(self.overflow):
+            self._refill()
+
+        return work
+
+    def _refill(self):
+        while not self.full():
+            work = self.overflow.pop()
+
+            if work is None:
+                break
+
+            self.force(work)
+
+    def close(self):
+        if self.overflow is not None:
+            self.overflow.close()
+
+
 class ScalingPoolExecutor(futures.ThreadPoolExecutor):
-    def __init__(self, workers, divisor, timeout):
+    """A thread pool growing with, and shrinking after, the depth of its work queue.
+
+    The queue may be bounded, and is divided into lanes; see WorkQueue and LaneQueue for the meaning of capacity,
+    policy, wait, path, lanes, and starvation.  Given a
+    Concurrency limit, the pool is held to it as well, threads exiting between work items while above it.
+
+    Given a shard function, work is partitioned by the key it returns for the first argument, and at most
+    shard_workers items of any one shard run at once.  Work taken from the queue for a shard already at its limit is
+    held aside, to be run by a thread of that shard as it finishes; the other threads carry on with other shards.
+    """
+
+    def __init__(self, workers, divisor, timeout, capacity=0, policy='block', wait=None, path=None,
+            concurrency=None, lanes=None, starvation=None, shard=None, shard_workers=1):
         self._max_workers = workers
         self.divisor = divisor
         self.timeout = timeout
+        self.concurrency = concurrency
+        self.shard = shard
+        self.shard_workers = shard_workers
 
-        self._work_queue = queue.Queue()
+        self._shards = {}  # Shard key to [running, held work].
+        self._running = 0  # Threads occupied by a shard; not available for other work.
+        self._shard_lock = threading.Lock()
+
+        self._work_queue = WorkQueue(capacity, policy, wait, path, lanes, starvation)
 
         self._threads = set()
+        self._broken = False  # Checked by submit() on Python 3.7 and later.
         self._shutdown = False
         self._shutdown_lock = threading.Lock()
         self._management_lock = threading.Lock()
 
         atexit.register(self._atexit)
 
+    @property
+    def depth(self):
+        """The number of work items waiting to be run, including those held for a busy shard."""
+        return self._work_queue.depth + self._work_queue.held
+
+    @property
+    def wait(self):
+        """The average number of seconds recent work items spent waiting to be run."""
+        return self._work_queue.average
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule the callable, applying the queue's overflow policy if it is at capacity."""
+        return self._enqueue(fn, args, kwargs, True)
+
+    def requeue(self, fn, *args, **kwargs):
+        """Schedule the callable regardless of the queue's capacity; for work already accepted, such as a retry."""
+        return self._enqueue(fn, args, kwargs, False)
+
+    def _enqueue(self, fn, args, kwargs, admit):
+        if self._shutdown:
+            raise RuntimeError("cannot schedule new futures after shutdown")
+
+        future = futures.Future()
+        self._work_queue.put(WorkItem(future, fn, args, kwargs), admit)  # May block; the lock must not be held.
+
+        with self._shutdown_lock:
+            if self._shutdown:  # Shut down while waiting for room; the work will never be run.
+                future.cancel()
+                return future
+
+            self._adjust_thread_count()
+
+        return future
+
     def shutdown(self, wait=True):
         with self._shutdown_lock:
             self._shutdown = True
 
             for i in range(len(self._threads)):
-                self._work_queue.put(None)
+                self._work_queue.force(None)
 
         if wait:
             for thread in list(self._threads):
                 thread.join()
 
+            self._work_queue.close()
+
     def _atexit(self):  # pragma: no cover
         self.shutdown(True)
 
     def _spawn(self):
-        t = threading.Thread(target=thread_worker, args=(weakref.ref(self), self._work_queue, self.divisor, self.timeout))
+        t = threading.Thread(target=thread_worker, args=(weakref.ref(self), self._work_queue, self.timeout, self.divisor))
         t.daemon = True
+
+        with self._management_lock:
+            self._threads.add(t)  # Before starting, so the thread is counted by the time it may remove itself.
+
         t.start()
 
+    def _admit(self, work):
+        """Return the work item if it may run now, otherwise hold it for its shard and return None."""
+
+        if self.shard is None:
+            return work
+
+        work.shard = key = self.shard(work.args[0]) if work.args else None
+
+        with self._shard_lock:
+            state = self._shards.get(key)
+
+            if state is None:
+                state = self._shards[key] = [0, deque()]
+
+            if state[0] >= self.shard_workers:
+                state[1].append(work)
+                self._work_queue.hold(1)
+                return None
+
+            state[0] += 1
+            self._running += 1
+
+        return work
+
+    def _release(self, work):
+        """Called once an admitted work item has run; return the next item held for its shard, if any."""
+
+        if self.shard is None:
+            return None
+
+        with self._shard_lock:
+            state = self._shards[work.shard]
+            held = state[1].popleft() if state[1] else None
+
+            if held is None:
+                state[0] -= 1
+                self._running -= 1
+
+                if not state[0]:
+                    del self._shards[work.shard]
+
+        if held is not None:
+            self._work_queue.hold(-1)
+
+        return held
+
+    def _relinquish(self, work):
+        """Return a held work item taken up by a retiring thread to the queue, giving up its place in the shard."""
+
+        with self._shard_lock:
+            state = self._shards[work.shard]
+            state[0] -= 1
+            self._running -= 1
+
+            if not state[0] and not state[1]:
+                del self._shards[work.shard]
+
+        self._work_queue.force(work)
+
+    def _replenish(self):
+        with self._shutdown_lock:
+            if not self._shutdown:
+                self._adjust_thread_count()
+
+    def _regulate(self):
+        """Called by each worker between work items: return True if the calling thread should exit to honour the
+        concurrency limit, otherwise start any threads a raised limit now permits."""
+
+        if self.concurrency is None:
+            return False
+
         with self._management_lock:
-            self._threads.add(t)
+            if len(self._threads) > max(1, int(self.concurrency)):
+                self._threads.discard(threading.current_thread())
+                return True
+
+        self._replenish()
+
+        return False
 
     def _adjust_thread_count(self):
         pool = len(self._threads)
@@ -139,50 +621,102 @@ class ScalingPoolExecutor(futures.ThreadPoolExecutor):
 
     @property
     def _optimum_workers(self):
-        return min(self._max_workers, math.ceil(self._work_queue.qsize() / float(self.divisor)))
+        workers = self._max_workers
+
+        if self.concurrency is not None:
+            workers = min(workers, max(1, int(self.concurrency)))
+
+        return min(workers, self._running + math.ceil(self._work_queue.depth / float(self.divisor)))
+
+
+class DynamicManager(FuturesManager):
+    """Deliver messages from a pool of background threads scaled to the workload.
 
+    Accepts the following configuration directives, in addition to those understood by FuturesManager:
 
-class DynamicManager(object):
-    __slots__ = ('workers', 'divisor', 'timeout', 'executor', 'transport')
+     * workers - the maximum number of delivery threads
+     * divisor - the number of messages a thread delivers before exiting; the queue depth is divided by this to
+       determine the number of threads required
+     * timeout - the number of seconds a thread waits for work before exiting
+     * capacity - the number of messages which may wait for delivery (default: 0, unlimited)
+     * overflow - what deliver() does when the queue is at capacity: block, raise, or spill (default: block)
+     * overflow_timeout - the number of seconds deliver() may block before raising (default: None, forever)
+     * spill_path - the directory spilled messages are written to (default: the system temporary directory)
+     * adaptive - limit the number of simultaneous deliveries according to their latency and failures, as
+       described by Concurrency, never exceeding workers (default: False)
+     * shard - partition waiting messages by recipient domain ("domain") or by mail exchanger ("mx", requiring
+       PyDNS), limiting the threads any one shard may occupy (default: None)
+     * shard_workers - the number of threads a single shard may occupy at once (default: a quarter of workers)
+     * shard_timeout - the number of seconds a mail exchanger lookup may take, after which the domain is its own
+       shard (default: 5)
+
+    When full, the raise policy and an expired block raise QueueFullException from deliver().  Spilled messages are
+    pickled to disk and read back as the queue drains; the copy read back is the one delivered and retried.
+    Capacity is only applied by deliver(), on the calling thread; retries and messages deferred by a rate limit were
+    already accepted, and are requeued regardless of it, never blocking the retry scheduler.
+
+    With sharding, a slow or unresponsive destination ties up no more than shard_workers of the threads; messages to
+    it wait, held aside, while the remaining threads deliver to other destinations.  Held messages are counted by
+    depth, and against capacity.
+    """
+
+    __slots__ = ('divisor', 'timeout', 'capacity', 'overflow', 'overflow_timeout', 'spill_path', 'concurrency', 'shard',
+            'shard_workers')
 
     name = "Dynamic"
     Executor = ScalingPoolExecutor
 
     def __init__(self, config, transport):
+        super(DynamicManager, self).__init__(config, transport)
+
         self.workers = int(config.get('workers', 10))  # Maximum number of threads to create.
         self.divisor = int(config.get('divisor', 10))  # Estimate the number of required threads by dividing the queue size by this.
         self.timeout = float(config.get('timeout', 60))  # Seconds before starvation.
 
-        self.executor = None
-        self.transport = TransportPool(transport)
+        self.capacity = int(config.get('capacity', 0))
+        self.overflow = config.get('overflow', 'block')
+        self.overflow_timeout = config.get('overflow_timeout', None)
+        self.spill_path = config.get('spill_path', None)
 
-        super(DynamicManager, self).__init__()
+        if self.overflow not in WorkQueue.policies:
+            raise ValueError("Unknown overflow policy: %s" % (self.overflow, ))
 
-    def startup(self):
-        log.info("%s manager starting up.", self.name)
+        if self.overflow_timeout is not None:
+            self.overflow_timeout = float(self.overflow_timeout)
 
-        log.debug("Initializing transport queue.")
-        self.transport.startup()
+        self.concurrency = Concurrency(config, self.workers) if boolean(config.get('adaptive', False)) else None
 
-        workers = self.workers
-        log.debug("Starting thread pool with %d workers." % (workers, ))
-        self.executor = self.Executor(workers, self.divisor, self.timeout)
+        shard = config.get('shard', None)
 
-        log.info("%s manager ready.", self.name)
+        if shard and shard not in shards:
+            raise ValueError("Unknown shard type: %s" % (shard, ))
 
-    def deliver(self, message):
-        # Return the Future object so the application can register callbacks.
-        # We pass the message so the executor can do what it needs to to make
-        # the message thread-local.
-        return self.executor.submit(partial(worker, self.transport), message)
+        self.shard = shards[shard](config) if shard else None
+        self.shard_workers = int(config.get('shard_workers', max(1, self.workers // 4)))
 
-    def shutdown(self, wait=True):
-        log.info("%s manager stopping.", self.name)
+    @property
+    def depth(self):
+        """The number of messages waiting for a delivery thread."""
+        return self.executor.depth if self.executor is not None else 0
+
+    @property
+    def wait(self):
+        """The average number of seconds recent messages waited for a delivery thread."""
+        return self.executor.wait if self.executor is not None else 0.0
+
+    def _executor(self):
+        return self.Executor(self.workers, self.divisor, self.timeout, self.capacity, self.overflow,
+                self.overflow_timeout, self.spill_path, self.concurrency, self.lanes, self.starvation, self.shard,
+                self.shard_workers)
+
+    def _dispatch(self, fn, message, admit, priority=None):
+        if self.concurrency is not None:
+            fn = partial(measured, self.concurrency, fn)
 
-        log.debug("Stopping thread pool.")
-        self.executor.shutdown(wait=wait)
+        if priority is not None:
+            fn = Priority(priority, fn)
 
-        log.debug("Draining transport queue.")
-        self.transport.shutdown()
+        if admit:
+            return self.executor.submit(fn, message)
 
-        log.info("%s manager stopped.", self.name)
+        return self.executor.requeue(fn, message)
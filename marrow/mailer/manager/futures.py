@@ -2,8 +2,8 @@
 
 from functools import partial
 
-from marrow.mailer.exc import TransportFailedException, TransportExhaustedException, MessageFailedException, DeliveryFailedException
-from marrow.mailer.manager.util import TransportPool
+from marrow.mailer.exc import TransportFailedException, TransportExhaustedException, MessageFailedException, DeliveryFailedException, RateLimitedException, QueueFullException
+from marrow.mailer.manager.util import TransportPool, Backoff, RetryScheduler, LaneQueue, Priority, RateLimiter, weights
 
 try:
     from concurrent import futures
@@ -11,79 +11,311 @@ except ImportError: # pragma: no cover
     raise ImportError("You must install the futures package to use background delivery.")
 
 
-__all__ = ['FuturesManager']
+__all__ = ['FuturesManager', 'LanePoolExecutor']
 
 log = __import__('logging').getLogger(__name__)
 
 
 
-def worker(pool, message):
-    # This may be non-obvious, but there are several conditions which
-    # we trap later that require us to retry the entire delivery.
-    result = None
-    
-    while True:
-        with pool() as transport:
+def worker(pool, message, limiter=None, renderer=None):
+    """Make a single attempt at delivery.
+
+    A TransportFailedException propagates to the caller, which decides if and when the message should be retried.
+    If a rate limiter is given and delivery through the acquired transport would exceed its per-transport rate, a
+    RateLimitedException is raised instead, without attempting delivery.
+
+    If a render pool is given the message is first serialized there, and that serialization released afterwards.
+    """
+
+    adopted = renderer is not None and adopt(renderer, message)
+
+    try:
+        return _worker(pool, message, limiter)
+
+    finally:
+        if adopted:
+            message._adopt(None)
+
+
+def _worker(pool, message, limiter):
+    failure = None
+
+    with pool() as transport:
+        delay = limiter.acquire(transport) if limiter is not None else 0
+
+        if not delay:
             try:
                 result = transport.deliver(message)
-            
+
             except MessageFailedException as e:
                 raise DeliveryFailedException(message, e.args[0] if e.args else "No reason given.")
-            
-            except TransportFailedException:
+
+            except TransportFailedException as e:
                 # The transport has suffered an internal error or has otherwise
-                # requested to not be recycled. Delivery should be attempted
-                # again.
+                # requested to not be recycled.  It is retired quietly as the
+                # block exits; only then is the failure passed on.
                 transport.ephemeral = True
-                continue
-            
-            except TransportExhaustedException:
+                failure = e
+
+            except TransportExhaustedException as e:
                 # The transport sent the message, but pre-emptively
                 # informed us that future attempts will not be successful.
                 transport.ephemeral = True
-        
-        break
-    
+                result = e.result
+
+    if failure is not None:
+        raise failure
+
+    if delay:  # Raised once the transport has been returned to the pool.
+        raise RateLimitedException(delay)
+
     return message, result
 
 
 
+def render(message):
+    """Serialize a message; used to render messages in a separate process."""
+
+    return bytes(message)
+
+
+def adopt(renderer, message):
+    """Serialize the message in the given process pool and adopt the result, returning False if unable to."""
+
+    message.id  # Settle the Message-ID here; the renderer works on a copy.
+
+    try:
+        message._adopt(renderer.submit(render, message).result())
+
+    except Exception as e:
+        log.warning("Unable to render message %s in the render pool; rendering during delivery: %r", message.id, e)
+        return False
+
+    return True
+
+
+def context():
+    """The multiprocessing context for render pools: worker processes must not be forked from a threaded process."""
+
+    try:
+        import multiprocessing
+        methods = multiprocessing.get_all_start_methods()
+
+    except AttributeError:  # pragma: no cover
+        return None
+
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+
+class LanePoolExecutor(futures.ThreadPoolExecutor):
+    """A thread pool taking waiting work from weighted priority lanes rather than in the order it was submitted.
+
+    See LaneQueue for the meaning of lanes and starvation.
+    """
+
+    def __init__(self, workers, lanes=None, starvation=None):
+        super(LanePoolExecutor, self).__init__(workers)
+        self._work_queue = LaneQueue(lanes, starvation)  # Before any worker threads are started.
+
+
 class FuturesManager(object):
-    __slots__ = ('workers', 'executor', 'transport')
-    
+    """Deliver messages from a pool of background threads.
+
+    Accepts the following configuration directives, in addition to those understood by Backoff:
+
+     * workers - the number of delivery threads
+     * render - the number of processes to serialize messages in before delivery (default: 0, rendering them on
+       the delivery threads instead)
+     * lanes - the delivery lanes and their relative weights, as a mapping or "name:weight, ..." string (default:
+       high:8, normal:4, low:1)
+     * starvation - the number of seconds after which a waiting message is delivered next, whatever its lane
+       (default: 30)
+     * rate, rate_domain, rate_domains, rate_transport, rate_burst - limits on the rate of delivery; see RateLimiter
+
+    Building the MIME document is CPU bound; with a render pool, a delivery thread taking up a message pickles it to
+    a worker process and delivers the text handed back, allowing throughput to scale with the available cores.  The
+    text is released after each attempt; nothing rendered is held while a message waits.  Worker processes are
+    started using the forkserver (or spawn) method where available, never forked from the threaded process.
+    Messages must not be modified once passed to deliver().
+
+    Waiting messages are queued in lanes chosen by their priority (see marrow.mailer.manager.util.lane) and taken
+    from them by weighted round-robin, so that transactional mail need not wait behind a bulk send.  A priority
+    passed to deliver() chooses the lane in place of the message's own, without altering the message.
+
+    Messages which would exceed a rate limit are parked with the retry scheduler until they may be delivered, leaving
+    the delivery threads free for messages to other domains; waiting for a rate limit does not use up retries.
+
+    Messages whose transport fails are handed to a retry scheduler rather than retried on the spot; they re-enter
+    the pool once their backoff delay has elapsed, up to message.retries times.  The Future returned by deliver()
+    spans every attempt.  Shutting down without waiting fails the Future of any message awaiting a retry with a
+    DeliveryFailedException, as does shutting down at all while a message is parked by a rate limit.
+    """
+
+    __slots__ = ('workers', 'executor', 'transport', 'backoff', 'scheduler', 'render', 'renderer', 'lanes',
+            'starvation', 'limiter')
+
+    name = "Futures delivery"
+
     def __init__(self, config, transport):
         self.workers = config.get('workers', 1)
-        
+        self.render = int(config.get('render', 0))
+        self.lanes = weights(config.get('lanes', None))
+        self.starvation = config.get('starvation', 30)
+
+        if self.starvation is not None:
+            self.starvation = float(self.starvation)
+
         self.executor = None
-        self.transport = TransportPool(transport)
-        
+        self.renderer = None
+        limiter = RateLimiter(config)
+        self.limiter = limiter if limiter.configured else None
+
+        self.transport = TransportPool(transport, config, limiter.forget if self.limiter else None)
+        self.backoff = Backoff(config)
+        self.scheduler = RetryScheduler(self._abandon)
+
         super(FuturesManager, self).__init__()
-    
+
+    def _executor(self):
+        return LanePoolExecutor(self.workers, self.lanes, self.starvation)
+
+    def _renderer(self):
+        try:
+            return futures.ProcessPoolExecutor(self.render, mp_context=context())
+
+        except TypeError:  # pragma: no cover - Python older than 3.7, or the futures backport.
+            return futures.ProcessPoolExecutor(self.render)
+
     def startup(self):
-        log.info("Futures delivery manager starting.")
-        
+        log.info("%s manager starting.", self.name)
+
         log.debug("Initializing transport queue.")
         self.transport.startup()
-        
+
         workers = self.workers
         log.debug("Starting thread pool with %d workers." % (workers, ))
-        self.executor = futures.ThreadPoolExecutor(workers)
-        
-        log.info("Futures delivery manager ready.")
-    
-    def deliver(self, message):
+        self.executor = self._executor()
+
+        if self.render:
+            log.debug("Starting render pool with %d processes." % (self.render, ))
+            self.renderer = self._renderer()
+
+        log.debug("Starting retry scheduler.")
+        self.scheduler.startup()
+
+        log.info("%s manager ready.", self.name)
+
+    def deliver(self, message, priority=None):
         # Return the Future object so the application can register callbacks.
         # We pass the message so the executor can do what it needs to to make
         # the message thread-local.
-        return self.executor.submit(partial(worker, self.transport), message)
-    
+        future = futures.Future()
+        self._attempt(future, message, 0, admit=True, priority=priority)
+        return future
+
+    def _dispatch(self, fn, message, admit, priority=None):
+        """Hand an attempt to the executor; only deliver() admits new work, any other attempt was already accepted."""
+
+        if priority is not None:
+            fn = Priority(priority, fn)
+
+        return self.executor.submit(fn, message)
+
+    def _park(self, future, message, attempt, delay, priority=None):
+        """Attempt delivery, with tokens already reserved, once the given delay has elapsed; False if unable to."""
+
+        if not self.scheduler.defer(delay, self._attempt, future, message, attempt, True, False, priority):
+            return False
+
+        log.debug("Delivery of message %s deferred %.2f seconds by rate limiting.", message.id, delay)
+        return True
+
+    def _attempt(self, future, message, attempt, reserved=False, admit=False, priority=None):
+        if future.cancelled():
+            log.debug("Delivery cancelled while awaiting retry.")
+            return
+
+        limiter = self.limiter
+
+        if limiter is not None and not reserved:
+            delay = limiter.reserve(message)
+
+            if delay and self._park(future, message, attempt, delay, priority):
+                return
+
+            if delay:  # The scheduler has stopped; fail rather than exceed the limit, or hold up shutdown.
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(DeliveryFailedException(message, "Rate limited; unable to defer delivery."))
+
+                return
+
+        try:
+            inner = self._dispatch(partial(worker, self.transport, limiter=limiter, renderer=self.renderer), message,
+                    admit, priority)
+
+        except Exception as e:  # E.g. RuntimeError, the executor having been shut down.
+            if admit and isinstance(e, QueueFullException):
+                raise  # Refused by deliver(); the caller is told directly.
+
+            if future.set_running_or_notify_cancel():
+                future.set_exception(DeliveryFailedException(message, str(e)))
+
+            return
+
+        inner.add_done_callback(partial(self._attempted, future, message, attempt, priority))
+
+    def _abandon(self, future, message, *args):
+        """Fail a delivery awaiting a retry, or a rate limit, which will now never be attempted."""
+
+        if future.set_running_or_notify_cancel():
+            future.set_exception(DeliveryFailedException(message, "Manager shut down before delivery was attempted."))
+
+    def _attempted(self, future, message, attempt, priority, inner):
+        exception = inner.exception()
+
+        if isinstance(exception, RateLimitedException):
+            if self._park(future, message, attempt, exception.delay, priority):
+                return
+
+            exception = DeliveryFailedException(message, "Rate limited; unable to defer delivery.")
+
+        if isinstance(exception, TransportFailedException):
+            if message.retries > 0:
+                delay = self.backoff(attempt)
+
+                if self.scheduler.schedule(delay, self._attempt, future, message, attempt + 1, False, False, priority):
+                    message.retries -= 1
+                    log.info("Retrying delivery in %.2f seconds; %d retr%s remaining.", delay, message.retries,
+                            "y" if message.retries == 1 else "ies")
+                    return
+
+            exception = DeliveryFailedException(message, "Transport failed; retries exhausted.")
+
+        if not future.set_running_or_notify_cancel():
+            return
+
+        if exception is not None:
+            future.set_exception(exception)
+            return
+
+        future.set_result(inner.result())
+
     def shutdown(self, wait=True):
-        log.info("Futures delivery manager stopping.")
-        
+        log.info("%s manager stopping.", self.name)
+
+        log.debug("Stopping retry scheduler.")
+        self.scheduler.shutdown(wait)
+
         log.debug("Stopping thread pool.")
         self.executor.shutdown(wait=wait)
-        
+
+        if self.renderer is not None:
+            log.debug("Stopping render pool.")
+            self.renderer.shutdown(wait=wait)
+            self.renderer = None
+
         log.debug("Draining transport queue.")
         self.transport.shutdown()
-        
-        log.info("Futures delivery manager stopped.")
+
+        log.info("%s manager stopped.", self.name)
@@ -1,7 +1,9 @@
 # encoding: utf-8
 
+import time
+
 from marrow.mailer.exc import TransportExhaustedException, TransportFailedException, DeliveryFailedException, MessageFailedException
-from marrow.mailer.manager.util import TransportPool
+from marrow.mailer.manager.util import TransportPool, Backoff, RateLimiter
 
 
 __all__ = ['ImmediateManager']
@@ -11,13 +13,18 @@ log = __import__('logging').getLogger(__name__)
 
 
 class ImmediateManager(object):
-    __slots__ = ('transport', )
+    __slots__ = ('transport', 'backoff', 'limiter')
     
     def __init__(self, config, Transport):
         """Initialize the immediate delivery manager."""
         
+        # Deliveries exceeding a configured rate wait; see RateLimiter.
+        limiter = RateLimiter(config)
+        self.limiter = limiter if limiter.configured else None
+        
         # Create a transport pool; this will encapsulate the recycling logic.
-        self.transport = TransportPool(Transport)
+        self.transport = TransportPool(Transport, config, limiter.forget if self.limiter else None)
+        self.backoff = Backoff(config)
         
         super(ImmediateManager, self).__init__()
     
@@ -34,11 +41,18 @@ class ImmediateManager(object):
         
         log.info("Immediate delivery manager started.")
     
-    def deliver(self, message):
+    def deliver(self, message, priority=None):
+        # Delivery is never queued, so the priority has no bearing on it.
         result = None
+        attempt = 0
         
         while True:
+            failed = False
+            
             with self.transport() as transport:
+                if self.limiter is not None:
+                    self.limiter.pace(message, transport)
+                
                 try:
                     result = transport.deliver(message)
                 
@@ -48,16 +62,29 @@ class ImmediateManager(object):
                 except TransportFailedException:
                     # The transport has suffered an internal error or has otherwise
                     # requested to not be recycled. Delivery should be attempted
-                    # again.
+                    # again, after a pause, if the message has retries remaining.
                     transport.ephemeral = True
-                    continue
+                    failed = True
                 
-                except TransportExhaustedException:
+                except TransportExhaustedException as e:
                     # The transport sent the message, but pre-emptively
                     # informed us that future attempts will not be successful.
                     transport.ephemeral = True
+                    result = e.result
+            
+            if not failed:
+                break
+            
+            if message.retries <= 0:
+                raise DeliveryFailedException(message, "Transport failed; retries exhausted.")
+            
+            message.retries -= 1
+            delay = self.backoff(attempt)
+            attempt += 1
             
-            break
+            log.info("Retrying delivery in %.2f seconds; %d retr%s remaining.", delay, message.retries,
+                    "y" if message.retries == 1 else "ies")
+            time.sleep(delay)
         
         return message, result
     
@@ -0,0 +1,378 @@
+# encoding: utf-8
+
+"""Durable background delivery backed by an on-disk journal."""
+
+import os
+import struct
+import pickle
+import threading
+import zlib
+
+from collections import OrderedDict
+from functools import partial
+from marrow.util.convert import boolean
+
+from marrow.mailer import record
+from marrow.mailer.exc import MailerNotRunning
+from marrow.mailer.message import Message
+from marrow.mailer.manager.futures import FuturesManager
+
+
+__all__ = ['Journal', 'SpoolManager']
+
+log = __import__('logging').getLogger(__name__)
+
+
+
+class Journal(object):
+    """An append-only log of spooled messages and their acknowledgements.
+
+    Each record is prefixed by its kind, sequence number, length, and CRC32 so a torn write at the tail (from a
+    crash mid-append) is detected and discarded on replay.  Appends are buffered; a background thread commits them
+    to stable storage in batches, issuing a single fsync for every record written within ``interval`` seconds (or
+    as soon as ``batch`` records are waiting).
+    """
+
+    __slots__ = ('path', 'interval', 'batch', 'compact', 'file', 'sequence', 'pending', 'written', 'synced',
+            'dirty', 'closing', 'condition', 'thread')
+
+    ENQUEUE = b'E'
+    ACKNOWLEDGE = b'A'
+
+    header = struct.Struct('>cQII')
+
+    def __init__(self, path, interval=0.01, batch=256, compact=16777216):
+        self.path = path
+        self.interval = interval
+        self.batch = batch
+        self.compact = compact  # Truncate an otherwise empty journal once it grows beyond this many bytes.
+
+        self.file = None
+        self.sequence = 0
+        self.pending = set()
+        self.written = 0
+        self.synced = 0
+        self.dirty = 0
+        self.closing = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def _read(self):
+        """Return the ordered mapping of unacknowledged sequence numbers to payloads."""
+
+        entries = OrderedDict()
+
+        if not os.path.exists(self.path):
+            return entries
+
+        header = self.header
+
+        with open(self.path, 'rb') as fh:
+            while True:
+                prefix = fh.read(header.size)
+
+                if len(prefix) < header.size:
+                    break
+
+                kind, ident, length, checksum = header.unpack(prefix)
+                payload = fh.read(length)
+
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != checksum:
+                    log.warning("Discarding damaged journal tail in %s.", self.path)
+                    break
+
+                self.sequence = max(self.sequence, ident + 1)
+
+                if kind == self.ENQUEUE:
+                    entries[ident] = payload
+
+                elif kind == self.ACKNOWLEDGE:
+                    entries.pop(ident, None)
+
+        return entries
+
+    def _record(self, kind, ident, payload=b''):
+        return self.header.pack(kind, ident, len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+    def open(self):
+        """Recover the journal, returning a list of (sequence, payload) pairs that were never acknowledged.
+
+        The journal is compacted to contain only those entries before new appends are accepted.
+        """
+
+        entries = self._read()
+        temporary = self.path + '.tmp'
+
+        with open(temporary, 'wb') as fh:
+            for ident, payload in entries.items():
+                fh.write(self._record(self.ENQUEUE, ident, payload))
+
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        os.rename(temporary, self.path)
+
+        self.file = open(self.path, 'ab')
+        self.pending = set(entries)
+        self.closing = False
+
+        self.thread = threading.Thread(target=self._commit, name="Journal commit")
+        self.thread.daemon = True
+        self.thread.start()
+
+        return list(entries.items())
+
+    def append(self, payload):
+        """Buffer a new entry, returning its sequence number and the commit position to wait() on, or None if the
+        journal has been closed."""
+
+        with self.condition:
+            if self.file is None:
+                return None
+
+            ident = self.sequence
+            self.sequence += 1
+
+            self.file.write(self._record(self.ENQUEUE, ident, payload))
+            self.pending.add(ident)
+            self.written += 1
+            self.dirty += 1
+
+            if self.dirty == 1 or self.dirty >= self.batch:
+                self.condition.notify_all()
+
+            return ident, self.written
+
+    def acknowledge(self, ident):
+        """Record that an entry has been dealt with and need not be replayed."""
+
+        with self.condition:
+            if self.file is None:
+                return
+
+            self.pending.discard(ident)
+
+            if not self.pending and self.file.tell() > self.compact:
+                log.debug("Truncating drained journal %s.", self.path)
+                self.file.seek(0)
+                self.file.truncate()
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.synced = self.written
+                self.dirty = 0
+                self.condition.notify_all()
+                return
+
+            self.file.write(self._record(self.ACKNOWLEDGE, ident))
+            self.written += 1
+            self.dirty += 1
+
+            if self.dirty == 1 or self.dirty >= self.batch:
+                self.condition.notify_all()
+
+    def entries(self):
+        """Return the (sequence, payload) pairs not yet acknowledged, e.g. to inspect a journal in use."""
+
+        with self.condition:
+            if self.file is not None:
+                self.file.flush()
+
+            return list(self._read().items())
+
+    def wait(self, position):
+        """Block until the record at the given commit position has reached stable storage."""
+
+        with self.condition:
+            while self.synced < position and self.file is not None:
+                self.condition.wait()
+
+    def _commit(self):
+        condition = self.condition
+
+        while True:
+            with condition:
+                while not self.dirty and not self.closing:
+                    condition.wait()
+
+                if not self.dirty:
+                    break
+
+                # Give concurrent writers a moment to join this batch.
+                if self.dirty < self.batch and not self.closing:
+                    condition.wait(self.interval)
+
+                self.file.flush()
+                position, self.dirty = self.written, 0
+                descriptor = self.file.fileno()
+
+            os.fsync(descriptor)
+
+            with condition:
+                self.synced = max(self.synced, position)
+                condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            if self.file is None:
+                return
+
+            self.closing = True
+            self.condition.notify_all()
+
+        self.thread.join()
+
+        with self.condition:
+            self.file.close()
+            self.file = None
+            self.condition.notify_all()
+
+
+
+class SpoolManager(FuturesManager):
+    """Background delivery with at-least-once semantics across process restarts.
+
+    Every message is journalled to disk before being handed to the delivery thread pool, and acknowledged once its
+    delivery concludes, including any retries.  Messages left unacknowledged by a crash or restart are delivered again on startup.
+
+    Messages are journalled as records (see Message.to_record) and so are redelivered as instances of Message.
+    Messages whose delivery failed are moved to a second journal rather than discarded; see failures().
+
+    By default deliver() returns only once the message has reached stable storage.  If durable is disabled it
+    returns immediately, and a crash loses the messages accepted within the last ``interval`` seconds.
+
+    Messages whose delivery has not concluded by shutdown, including those abandoned while awaiting a retry, are left
+    in the journal and delivered again on the next startup.
+
+    Accepts the following configuration directives in addition to those of the futures manager:
+
+     * path - the journal file to write to (required)
+     * interval - the maximum number of seconds an append may wait for its fsync batch
+     * batch - commit early once this many records are waiting
+     * durable - block deliver() until the message has been committed to disk (default True)
+     * failed - the journal retaining messages whose delivery failed, by default the path suffixed ``.failed``;
+       an empty value discards them
+    """
+
+    __slots__ = ('journal', 'failed', 'durable', 'abandoned')
+
+    name = "Spooled delivery"
+
+    def __init__(self, config, transport):
+        path = config.get('path', None)
+
+        if not path:
+            raise ValueError("You must specify the path of a journal file to spool messages to.")
+
+        interval, batch = float(config.get('interval', 0.01)), int(config.get('batch', 256))
+        failed = config.get('failed', path + '.failed')
+
+        self.journal = Journal(path, interval, batch)
+        self.failed = Journal(failed, interval, batch) if failed else None
+        self.durable = boolean(config.get('durable', True))
+        self.abandoned = set()  # Futures failed only because the manager shut down.
+
+        super(SpoolManager, self).__init__(config, transport)
+
+    @staticmethod
+    def dumps(message):
+        """Journal the message as a compact record, falling back on pickle for messages unable to be recorded."""
+
+        try:
+            return message.to_record()
+
+        except TypeError:  # E.g. a callable id generator or builder.
+            return pickle.dumps(message, 2)
+
+    @staticmethod
+    def loads(payload):
+        if payload.startswith(record.MAGIC):
+            return Message.from_record(payload)
+
+        return pickle.loads(payload)
+
+    def startup(self):
+        super(SpoolManager, self).startup()
+
+        if self.failed is not None:
+            failures = len(self.failed.open())
+
+            if failures:
+                log.warning("%d failed message%s retained in %s.", failures, "" if failures == 1 else "s",
+                        self.failed.path)
+
+        log.debug("Replaying journal %s.", self.journal.path)
+        pending = self.journal.open()
+
+        if pending:
+            log.warning("Redelivering %d spooled message%s.", len(pending), "" if len(pending) == 1 else "s")
+
+        for ident, payload in pending:
+            try:
+                message = self.loads(payload)
+
+            except Exception:
+                log.exception("Unable to restore spooled message %d; discarding.", ident)
+                self.journal.acknowledge(ident)
+                continue
+
+            self._submit(ident, message).add_done_callback(self._replayed)
+
+    @staticmethod
+    def _replayed(future):
+        if not future.cancelled() and future.exception() is not None:
+            log.error("Redelivery of spooled message failed: %s", future.exception())
+
+    def deliver(self, message, priority=None):
+        appended = self.journal.append(self.dumps(message))
+
+        if appended is None:
+            raise MailerNotRunning("The spool journal %s is closed." % (self.journal.path, ))
+
+        ident, position = appended
+
+        if self.durable:
+            self.journal.wait(position)
+
+        return self._submit(ident, message, priority)
+
+    def _submit(self, ident, message, priority=None):
+        future = super(SpoolManager, self).deliver(message, priority)
+        future.add_done_callback(partial(self._concluded, ident, message))
+        return future
+
+    def _abandon(self, future, message, *args):
+        self.abandoned.add(future)
+        super(SpoolManager, self)._abandon(future, message, *args)
+
+    def _concluded(self, ident, message, future):
+        if future in self.abandoned:  # Left in the journal, to be redelivered on the next startup.
+            self.abandoned.discard(future)
+            return
+
+        if self.failed is not None and not future.cancelled() and future.exception() is not None:
+            appended = self.failed.append(self.dumps(message))
+
+            if appended is None:  # Shut down; left in the journal, to be concluded again on the next startup.
+                return
+
+            # Committed before the acknowledgement, so a crash in between redelivers rather than loses it.
+            self.failed.wait(appended[1])
+
+        self.journal.acknowledge(ident)
+
+    def failures(self):
+        """Return the messages whose delivery failed, retained for inspection, as (sequence, message) pairs."""
+
+        if self.failed is None:
+            return []
+
+        return [(ident, self.loads(payload)) for ident, payload in self.failed.entries()]
+
+    def shutdown(self, wait=True):
+        super(SpoolManager, self).shutdown(wait)
+
+        log.debug("Closing journal.")
+        self.journal.close()
+
+        if self.failed is not None:
+            self.failed.close()
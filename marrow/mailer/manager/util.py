@@ -1,63 +1,305 @@
 # encoding: utf-8
 
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from collections import deque
+
+from marrow.util.compat import basestring
+from marrow.util.convert import boolean
+
+from marrow.mailer.exc import TransportPoolTimeoutException
+
 try:
     import queue
-except ImportError:
+except ImportError:  # pragma: no cover
     import Queue as queue
 
 
-__all__ = ['TransportPool']
+__all__ = ['TransportPool', 'Backoff', 'Concurrency', 'RetryScheduler', 'LANES', 'lane', 'weights', 'choose',
+        'Priority', 'LaneQueue', 'TokenBucket', 'RateLimiter']
 
 log = __import__('logging').getLogger(__name__)
 
+clock = getattr(time, 'monotonic', time.time)
+
 
 
 class TransportPool(object):
-    __slots__ = ('factory', 'transports')
-    
-    def __init__(self, factory):
+    """A pool of started transports, shared between delivery threads.
+
+    Accepts the following manager configuration directives:
+
+     * pool_size - the maximum number of transports open at once; unlimited by default
+     * pool_timeout - the number of seconds to wait for a transport when the pool is at capacity; forever by default
+     * pool_idle - close transports left unused for this many seconds
+     * pool_age - close transports once they have been open this many seconds
+     * pool_probe - before re-use, call the transport's probe() method (if any) and discard it on a false result;
+       the asyncio manager awaits the probe() coroutine of asynchronous transports instead
+     * pool_prewarm - keep at least this many idle transports open, opening them in the background, in parallel
+
+    Idle transports are re-used most recently released first, keeping the warmest connections busy and letting the
+    rest age out.  Should pre-warming fail, no further attempts are made for an exponentially increasing delay.
+
+    If given, retired is called with each transport once it has been shut down.
+    """
+
+    __slots__ = ('factory', 'size', 'timeout', 'idle', 'age', 'probe', 'prewarm', 'transports', 'count', 'condition',
+            'running', 'warming', 'failures', 'cooldown', 'retired')
+
+    def __init__(self, factory, config=None, retired=None):
+        config = config or {}
+
         self.factory = factory
-        self.transports = queue.Queue()
-    
-    def startup(self):
-        pass
-    
+        self.retired = retired
+        self.size = int(config['pool_size']) if config.get('pool_size') else None
+        self.timeout = float(config['pool_timeout']) if config.get('pool_timeout') is not None else None
+        self.idle = float(config['pool_idle']) if config.get('pool_idle') else None
+        self.age = float(config['pool_age']) if config.get('pool_age') else None
+        self.probe = boolean(config.get('pool_probe', False))
+        self.prewarm = int(config.get('pool_prewarm', 0))
+
+        if self.size is not None:
+            self.prewarm = min(self.prewarm, self.size)
+
+        self.transports = []  # Idle (transport, opened, released) entries; the last is the most recently released.
+        self.count = 0  # Transports open, whether idle or checked out, or being pre-warmed.
+        self.condition = threading.Condition()
+        self.running = False
+        self.warming = 0  # Transports being pre-warmed.
+        self.failures = 0  # Consecutive failures to pre-warm a transport.
+        self.cooldown = None  # No pre-warming is attempted before this time.
+
+    def startup(self, wait=False):
+        """Start pre-warming transports.  Unless waiting, this returns before they have connected."""
+
+        with self.condition:
+            self.running = True
+            self.failures = 0
+            self.cooldown = None
+            warming = self._reserve()
+
+        if warming:
+            log.debug("Pre-warming %d transport instance%s.", warming, "" if warming == 1 else "s")
+            self._warm(warming, wait)
+
+    def _reserve(self):
+        """Reserve room for the transports needed to restore the idle floor; call with the lock held."""
+
+        if not self.running or (self.cooldown is not None and clock() < self.cooldown):
+            return 0
+
+        deficit = self.prewarm - len(self.transports) - self.warming
+
+        if self.size is not None:
+            deficit = min(deficit, self.size - self.count)
+
+        if deficit <= 0:
+            return 0
+
+        self.count += deficit
+        self.warming += deficit
+
+        return deficit
+
+    def _warm(self, count, wait=False):
+        """Open transports, each in its own thread, adding them to the idle pool."""
+
+        threads = [threading.Thread(target=self._open, name="Transport pre-warm") for i in range(count)]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _open(self):
+        try:
+            transport = self.factory()
+            transport.startup()
+
+        except Exception:
+            log.warning("Unable to pre-warm transport instance.", exc_info=True)
+
+            with self.condition:
+                self.count -= 1
+                self.warming -= 1
+                self.failures += 1
+                self.cooldown = clock() + min(60, 0.5 * 2 ** self.failures)
+                self.condition.notify()
+
+            return
+
+        with self.condition:
+            self.warming -= 1
+            self.failures = 0
+            self.cooldown = None
+
+            if self.running:
+                now = clock()
+                self.transports.append((transport, now, now))
+                self.condition.notify()
+                return
+
+            self.count -= 1
+
+        self._close(transport)
+
+    def _close(self, transport):
+        try:
+            transport.shutdown()
+
+        finally:
+            if self.retired is not None:
+                self.retired(transport)
+
     def shutdown(self):
+        with self.condition:
+            self.running = False
+            transports, self.transports = self.transports, []
+            self.count -= len(transports)
+            self.condition.notify_all()
+
+        for transport, opened, released in transports:
+            self._close(transport)
+
+    def _expired(self, opened, released, now):
+        return (self.idle is not None and now - released >= self.idle) or \
+                (self.age is not None and now - opened >= self.age)
+
+    def _evict(self, now):
+        """Remove expired idle transports, returning them to be shut down outside of the lock."""
+
+        transports = self.transports
+        expired = [entry for entry in transports if self._expired(entry[1], entry[2], now)]
+
+        if expired:
+            transports[:] = [entry for entry in transports if not self._expired(entry[1], entry[2], now)]
+            self.count -= len(expired)
+            self.condition.notify_all()
+
+        return [entry[0] for entry in expired]
+
+    def _healthy(self, transport):
+        probe = getattr(transport, 'probe', None)
+
+        if not self.probe or probe is None:
+            return True
+
         try:
-            while True:
-                transport = self.transports.get(False)
-                transport.shutdown()
-        
-        except queue.Empty:
-            pass
-    
+            return probe()
+
+        except Exception: # pragma: no cover
+            log.debug("Transport health check raised an exception.", exc_info=True)
+            return False
+
+    def acquire(self):
+        """Return a started transport and the time at which it was opened."""
+
+        deadline = None if self.timeout is None else clock() + self.timeout
+
+        while True:
+            with self.condition:
+                while True:
+                    now = clock()
+                    expired = self._evict(now)
+
+                    if expired or self.transports:
+                        break
+
+                    if self.size is None or self.count < self.size:
+                        self.count += 1
+                        break
+
+                    if deadline is not None and now >= deadline:
+                        raise TransportPoolTimeoutException("No transport became available within %r seconds." % (self.timeout, ))
+
+                    self.condition.wait(None if deadline is None else deadline - now)
+
+                entry = self.transports.pop() if self.transports else None
+                warming = self._reserve()
+
+            if warming:
+                self._warm(warming)
+
+            for transport in expired:
+                log.debug("Closing expired transport instance.")
+                self._close(transport)
+
+            if entry is None:
+                if expired:
+                    continue  # Room has been made; reconsider under the lock.
+
+                break
+
+            transport, opened, released = entry
+
+            if self._healthy(transport):
+                log.debug("Acquired existing transport instance.")
+                return transport, opened
+
+            log.debug("Discarding transport instance which failed its health check.")
+            self.discard(transport)
+
+        # No transport is available, so we initialize another one.
+        log.debug("Unable to acquire existing transport, initalizing new instance.")
+
+        try:
+            transport = self.factory()
+            transport.startup()
+
+        except:
+            with self.condition:
+                self.count -= 1
+                self.condition.notify()
+
+            raise
+
+        return transport, clock()
+
+    def release(self, transport, opened):
+        """Return a transport to the pool for re-use, or shut it down if it has reached its maximum age."""
+
+        with self.condition:
+            if self.running and (self.age is None or clock() - opened < self.age):
+                self.transports.append((transport, opened, clock()))
+                self.condition.notify()
+                return
+
+        log.debug("Transport instance retired.")
+        self.discard(transport)
+
+    def discard(self, transport):
+        """Shut a checked out transport down, making room for another."""
+
+        with self.condition:
+            self.count -= 1
+            self.condition.notify()
+            warming = self._reserve()
+
+        self._close(transport)
+
+        if warming:
+            self._warm(warming)
+
     class Context(object):
-        __slots__ = ('pool', 'transport')
+        __slots__ = ('pool', 'transport', 'opened')
         
         def __init__(self, pool):
             self.pool = pool
             self.transport = None
+            self.opened = None
         
         def __enter__(self):
-            # First we attempt to find an available transport.
-            pool = self.pool
-            transport = None
-            
-            while not transport:
-                try:
-                    # By consuming transports this way, we maintain thread safety.
-                    # Transports are only accessed by a single thread at a time.
-                    transport = pool.transports.get(False)
-                    log.debug("Acquired existing transport instance.")
-                
-                except queue.Empty:
-                    # No transport is available, so we initialize another one.
-                    log.debug("Unable to acquire existing transport, initalizing new instance.")
-                    transport = pool.factory()
-                    transport.startup()
-            
-            self.transport = transport
-            return transport
+            # By consuming transports this way, we maintain thread safety.
+            # Transports are only accessed by a single thread at a time.
+            self.transport, self.opened = self.pool.acquire()
+            return self.transport
         
         def __exit__(self, type, value, traceback):
             transport = self.transport
@@ -65,16 +307,529 @@ class TransportPool(object):
             
             if type is not None:
                 log.error("Shutting down transport due to unhandled exception.", exc_info=True)
-                transport.shutdown()
+                self.pool.discard(transport)
                 return
             
             if not ephemeral:
                 log.debug("Scheduling transport instance for re-use.")
-                self.pool.transports.put(transport)
+                self.pool.release(transport, self.opened)
             
             else:
                 log.debug("Transport marked as ephemeral, shutting down instance.")
-                transport.shutdown()
+                self.pool.discard(transport)
     
     def __call__(self):
         return self.Context(self)
+
+
+
+class Backoff(object):
+    """Calculate exponentially increasing, jittered delays between delivery attempts.
+
+    Accepts the following manager configuration directives:
+
+     * retry_delay - the number of seconds to wait before the first retry
+     * retry_factor - the multiplier applied to the delay for each subsequent retry
+     * retry_maximum - the upper bound, in seconds, of any single delay
+     * retry_jitter - the fraction of each delay which is randomized, spreading out retries from a shared outage
+    """
+
+    __slots__ = ('delay', 'factor', 'maximum', 'jitter')
+
+    def __init__(self, config):
+        self.delay = float(config.get('retry_delay', 1))
+        self.factor = float(config.get('retry_factor', 2))
+        self.maximum = float(config.get('retry_maximum', 300))
+        self.jitter = float(config.get('retry_jitter', 0.5))
+
+    def __call__(self, attempt):
+        """Return the delay before the given retry, counting from zero."""
+
+        delay = min(self.maximum, self.delay * self.factor ** attempt)
+        return delay * (1 - self.jitter * random.random())
+
+
+class Concurrency(object):
+    """An adaptive limit on the number of simultaneous deliveries, using additive increase, multiplicative decrease.
+
+    Each completed delivery is reported along with its latency.  While latency stays within the tolerance of the
+    baseline (the lowest latency seen, slowly forgetting it so a persistently slower relay becomes the new normal) the
+    limit grows by one per limit's worth of deliveries.  On congestion, a transport failure, a temporary (4xx)
+    refusal, or latency beyond the tolerance, it is multiplied by the decrease factor, at most once per limit's worth
+    of deliveries so that a burst of failures from a single overload backs off only once.
+
+    Accepts the following manager configuration directives:
+
+     * concurrency_minimum - the lowest the limit may fall
+     * concurrency_initial - the limit to start from; defaults to the minimum
+     * concurrency_tolerance - the multiple of the baseline latency taken as a sign of saturation
+     * concurrency_decrease - the factor the limit is multiplied by on congestion
+
+    The limit never exceeds the maximum given.  Instances are safe to share between threads.
+    """
+
+    __slots__ = ('limit', 'minimum', 'maximum', 'tolerance', 'decrease', 'baseline', 'latency', 'completed', 'lock')
+
+    def __init__(self, config, maximum):
+        self.maximum = maximum
+        self.minimum = min(maximum, int(config.get('concurrency_minimum', 1)))
+        self.limit = float(max(self.minimum, min(maximum, int(config.get('concurrency_initial', self.minimum)))))
+        self.tolerance = float(config.get('concurrency_tolerance', 2))
+        self.decrease = float(config.get('concurrency_decrease', 0.5))
+
+        self.baseline = None  # The uncongested latency, in seconds.
+        self.latency = None  # A moving average of recent latency, in seconds.
+        self.completed = 0  # Deliveries since the limit was last decreased.
+        self.lock = threading.Lock()
+
+    def __int__(self):
+        return int(self.limit)
+
+    def __call__(self, latency, congested=False):
+        """Record a completed delivery, adjusting the limit."""
+
+        with self.lock:
+            baseline = self.baseline
+
+            if baseline is None or latency < baseline:
+                self.baseline = baseline = latency
+            else:
+                self.baseline = baseline = baseline + (latency - baseline) * 0.01
+
+            self.latency = latency if self.latency is None else self.latency + (latency - self.latency) * 0.2
+            self.completed += 1
+
+            if congested or self.latency > baseline * self.tolerance:
+                if self.completed >= self.limit:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self.completed = 0
+
+                return
+
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+
+class RetryScheduler(object):
+    """Invoke callbacks once their delay has elapsed.
+
+    Pending callbacks are kept on a heap ordered by due time and run, one at a time, by a single timer thread; they
+    should be brief, typically handing work back to an executor.  Callbacks given to defer() are never run early.
+
+    Should a pending callback never be run, the scheduler having been shut down without flushing or before a deferred
+    callback was due, abandon (if given) is called with its arguments instead, e.g. to fail the delivery it would
+    have retried.
+    """
+
+    __slots__ = ('heap', 'sequence', 'condition', 'thread', 'running', 'abandon')
+
+    def __init__(self, abandon=None):
+        self.abandon = abandon
+        self.heap = []
+        self.sequence = itertools.count()  # Tie-breaker preserving submission order for equal due times.
+        self.condition = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    def __len__(self):
+        return len(self.heap)
+
+    def startup(self):
+        self.running = True
+
+        self.thread = threading.Thread(target=self._run, name="Retry scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def schedule(self, delay, callback, *args):
+        """Arrange for callback(*args) to be called after delay seconds.
+
+        Returns False, without scheduling anything, if the scheduler is not running.
+        """
+
+        return self._schedule(delay, callback, args, False)
+
+    def defer(self, delay, callback, *args):
+        """As schedule(), but the callback is abandoned, rather than called early, if not yet due on shutdown."""
+
+        return self._schedule(delay, callback, args, True)
+
+    def _schedule(self, delay, callback, args, strict):
+        with self.condition:
+            if not self.running:
+                return False
+
+            entry = (clock() + delay, next(self.sequence), callback, args, strict)
+            heapq.heappush(self.heap, entry)
+
+            if self.heap[0] is entry:
+                self.condition.notify()
+
+        return True
+
+    def _run(self):
+        condition, heap = self.condition, self.heap
+
+        while True:
+            with condition:
+                while self.running:
+                    if not heap:
+                        condition.wait()
+                        continue
+
+                    remaining = heap[0][0] - clock()
+
+                    if remaining <= 0:
+                        break
+
+                    condition.wait(remaining)
+
+                if not self.running:
+                    return
+
+                due, sequence, callback, args, strict = heapq.heappop(heap)
+
+            try:
+                callback(*args)
+
+            except: # pragma: no cover
+                log.exception("Unhandled exception in scheduled callback.")
+
+    def shutdown(self, flush=True):
+        """Stop the timer thread.
+
+        Callbacks still pending are run immediately, in due order, if flush is set; otherwise, and for deferred
+        callbacks not yet due, they are abandoned.  Shutdown never waits for a callback to fall due.
+        """
+
+        with self.condition:
+            if not self.running:
+                return
+
+            self.running = False
+            pending = sorted(self.heap)
+            del self.heap[:]
+            self.condition.notify()
+
+        self.thread.join()
+
+        now = clock()
+        abandoned = [entry for entry in pending if not flush or (entry[4] and entry[0] > now)]
+        pending = [entry for entry in pending if flush and not (entry[4] and entry[0] > now)]
+
+        if abandoned:
+            log.debug("Abandoning %d pending callback%s.", len(abandoned), "" if len(abandoned) == 1 else "s")
+
+        for due, sequence, callback, args, strict in abandoned:
+            self._abandon(args)
+
+        if pending:
+            log.debug("Running %d pending callback%s early.", len(pending), "" if len(pending) == 1 else "s")
+
+        for due, sequence, callback, args, strict in pending:
+            try:
+                callback(*args)
+
+            except: # pragma: no cover
+                log.exception("Unhandled exception in scheduled callback.")
+
+    def _abandon(self, args):
+        if self.abandon is None:
+            return
+
+        try:
+            self.abandon(*args)
+
+        except: # pragma: no cover
+            log.exception("Unhandled exception abandoning scheduled callback.")
+
+
+LANES = {'high': 8, 'normal': 4, 'low': 1}  # The default lanes and their weights.
+
+_lanes = {
+        '1': 'high', '2': 'high', '4': 'low', '5': 'low',
+        'high': 'high', 'highest': 'high', 'urgent': 'high',
+        'low': 'low', 'lowest': 'low', 'non-urgent': 'low', 'bulk': 'low',
+    }
+
+
+def lane(message, priority=None):
+    """Return the delivery lane of the given message, determined by its priority: high, normal, or low.
+
+    X-Priority values of 1 and 2 (e.g. "1 (Highest)") are high, 4 and 5 low; the names high, urgent, low, non-urgent,
+    and bulk are also understood.  Anything else, including no priority at all, is normal.  A priority given
+    explicitly takes the place of the message's own.
+    """
+
+    if priority is None:
+        priority = getattr(message, 'priority', None)
+
+    if priority is None:
+        return 'normal'
+
+    priority = str(priority).strip().lower()
+
+    if priority[:1].isdigit():
+        priority = priority[:1]
+
+    return _lanes.get(priority, 'normal')
+
+
+def _mapping(value, cast):
+    """Interpret a configuration directive given as a mapping, or as a "name:value, ..." string."""
+
+    if isinstance(value, basestring):
+        value = (pair.rsplit(':', 1) for pair in value.split(',') if pair.strip())
+
+    return dict((name.strip(), cast(item)) for name, item in (value.items() if isinstance(value, dict) else value))
+
+
+def weights(value):
+    """Interpret the lanes configuration directive: a mapping of lane name to weight, or a "name:weight, ..." string."""
+
+    if not value:
+        return dict(LANES)
+
+    return _mapping(value, int)
+
+
+def choose(lanes, weights, credit, starvation=None):
+    """Select the lane to take the next item from, or None if all are empty.
+
+    The lanes are a mapping of name to a deque of (enqueued, item) tuples.  The credit, a mapping of name to integer
+    updated in place, carries the state of the smooth weighted round-robin between calls.
+    """
+
+    ready = [name for name in lanes if lanes[name]]
+
+    if len(ready) < 2:
+        return ready[0] if ready else None
+
+    if starvation is not None:
+        oldest = min(ready, key=lambda name: lanes[name][0][0])
+
+        if clock() - lanes[oldest][0][0] >= starvation:
+            return oldest
+
+    total = 0
+
+    for name in ready:
+        credit[name] += weights[name]
+        total += weights[name]
+
+    chosen = max(ready, key=credit.get)
+    credit[chosen] -= total
+
+    return chosen
+
+
+class Priority(object):
+    """A callable submitted to an executor along with the priority choosing its lane, in place of the message's own."""
+
+    __slots__ = ('priority', 'fn')
+
+    def __init__(self, priority, fn):
+        self.priority = priority
+        self.fn = fn
+
+    def __call__(self, *args, **kw):
+        return self.fn(*args, **kw)
+
+
+class LaneQueue(queue.Queue, object):
+    """A queue of work items dispatched from several lanes with weighted fairness.
+
+    Each work item is placed in the lane of its first argument, the message being delivered (see lane()), or of the
+    priority given by its callable, if that is a Priority.  A lane not among the configured weights falls back to
+    normal, or to the lowest weighted lane.  Items are taken from the non-empty lanes by smooth weighted round-robin,
+    so with the default weights of 8, 4, and 1 a high priority message waits behind at most a fraction of the bulk
+    queued ahead of it, while low priority mail still advances.
+
+    To protect against starvation, an item having waited starvation seconds or longer is taken next regardless of
+    its lane.  None, used to signal workers to exit, is only returned once every lane is empty.
+    """
+
+    def __init__(self, weights=None, starvation=None, maxsize=0):
+        self.weights = dict(weights or LANES)
+        self.starvation = starvation
+
+        if 'normal' in self.weights:
+            self.default = 'normal'
+        else:
+            self.default = min(self.weights, key=self.weights.get)
+
+        queue.Queue.__init__(self, maxsize)
+
+    def lane(self, work):
+        """Return the name of the lane the given work item belongs in."""
+
+        args = getattr(work, 'args', None)
+        name = lane(args[0] if args else None, getattr(getattr(work, 'fn', None), 'priority', None))
+        return name if name in self.weights else self.default
+
+    def _init(self, maxsize):
+        self.lanes = dict((name, deque()) for name in self.weights)
+        self.credit = dict((name, 0) for name in self.weights)
+        self.sentinels = deque()
+
+    def _qsize(self):
+        return sum(len(items) for items in self.lanes.values()) + len(self.sentinels)
+
+    def _put(self, work):
+        if work is None:
+            self.sentinels.append(work)
+            return
+
+        self.lanes[self.lane(work)].append((clock(), work))
+
+    def _get(self):
+        name = choose(self.lanes, self.weights, self.credit, self.starvation)
+
+        if name is None:
+            return self.sentinels.popleft()
+
+        return self.lanes[name].popleft()[1]
+
+
+class TokenBucket(object):
+    """Permit rate events per second on average, in bursts of up to capacity.  Not thread safe on its own.
+
+    Tokens may be taken in advance, leaving a debt; the wait then grows with each token reserved.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = clock()
+
+    def wait(self, now):
+        """Return the number of seconds until a token is available, zero if one is available now."""
+
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class RateLimiter(object):
+    """Pace deliveries using token buckets: one for all messages, one per recipient domain, and one per transport.
+
+    Accepts the following manager configuration directives, each a rate in messages per second:
+
+     * rate - the rate of all deliveries combined
+     * rate_domain - the rate of deliveries to each recipient domain
+     * rate_domains - rates for specific domains, overriding rate_domain; a mapping or "domain:rate, ..." string
+     * rate_transport - the rate of deliveries through each transport instance, e.g. an SMTP connection
+     * rate_burst - the number of seconds' worth of deliveries permitted at once after a pause (default: 1)
+
+    No limit applies where no rate is configured.  A message addressed to several domains requires a token from the
+    bucket of each.  Messages reserve their shared and domain tokens before being queued, and are then held back
+    until the reservation falls due; successive messages to a busy domain are so given successively later slots.
+    The token of a transport is taken only once it has been acquired for delivery; call forget() as the transport is
+    shut down, e.g. as the retired callback of a TransportPool, to drop its bucket.
+
+    Instances are safe to share between threads.
+    """
+
+    __slots__ = ('rate', 'domain', 'domains', 'transport', 'burst', 'buckets', 'lock')
+
+    limit = 4096  # Once tracking this many buckets, those which have refilled are forgotten.
+
+    def __init__(self, config):
+        self.rate = float(config['rate']) if config.get('rate') else None
+        self.domain = float(config['rate_domain']) if config.get('rate_domain') else None
+        self.domains = dict((domain.lower(), rate) for domain, rate in
+                _mapping(config.get('rate_domains') or {}, float).items())
+        self.transport = float(config['rate_transport']) if config.get('rate_transport') else None
+        self.burst = float(config.get('rate_burst', 1))
+
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    @property
+    def configured(self):
+        return bool(self.rate or self.domain or self.domains or self.transport)
+
+    def _bucket(self, key, rate):
+        bucket = self.buckets.get(key)
+
+        if bucket is None:
+            if len(self.buckets) >= self.limit:
+                self._prune()
+
+            bucket = self.buckets[key] = TokenBucket(rate, max(1.0, rate * self.burst))
+
+        return bucket
+
+    def _prune(self):
+        now = clock()
+
+        for key, bucket in list(self.buckets.items()):
+            if key is not None and bucket.wait(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self.buckets[key]  # Indistinguishable from a new bucket.
+
+    def _buckets(self, message):
+        if self.rate:
+            yield self._bucket(None, self.rate)
+
+        if self.domain or self.domains:
+            domains = set(address.address.rpartition('@')[2].lower()
+                    for address in getattr(message, 'recipients', ()))
+
+            for domain in domains:
+                rate = self.domains.get(domain, self.domain)
+
+                if rate:
+                    yield self._bucket(('domain', domain), rate)
+
+    def reserve(self, message):
+        """Take the shared and domain tokens the message requires, returning the number of seconds until they fall
+        due; the message should not be delivered before then."""
+
+        with self.lock:
+            now = clock()
+            delay = 0
+
+            for bucket in list(self._buckets(message)):
+                delay = max(delay, bucket.wait(now))
+                bucket.take()
+
+            return delay
+
+    def acquire(self, transport):
+        """Take a token for delivery through the given transport, or return the number of seconds until one is
+        available."""
+
+        if not self.transport:
+            return 0
+
+        with self.lock:
+            bucket = self._bucket(('transport', transport), self.transport)
+            delay = bucket.wait(clock())
+
+            if not delay:
+                bucket.take()
+
+            return delay
+
+    def forget(self, transport):
+        """Drop the bucket of a transport which has been shut down."""
+
+        with self.lock:
+            self.buckets.pop(('transport', transport), None)
+
+    def pace(self, message, transport):
+        """Block until the message may be delivered through the given transport, taking the tokens it requires."""
+
+        time.sleep(self.reserve(message))
+        delay = self.acquire(transport)
+
+        while delay:
+            time.sleep(delay)
+            delay = self.acquire(transport)
@@ -0,0 +1,368 @@
+# encoding: utf-8
+
+"""Mail merge: render one prototype message for many recipients.
+
+The prototype is compiled once into a skeleton: the serialized text of the message with every part that varies between
+recipients (the To, Subject, and Message-ID headers, and the text bodies) cut out.  Each merged message is then
+produced by joining the pre-rendered segments of the skeleton with the handful of segments rendered for its recipient.
+Attachments and static headers are encoded just once.  Each body is filled in from runs of static text and the lines
+containing replacement fields, then given the cheapest transfer encoding able to carry it, exactly as the bodies of
+any other message are; see marrow.mailer.transfer.
+
+Prototypes using an alternative MIME builder are not compiled; each merged message is built in full by the builder.
+
+Replacement fields use the ``str.format`` syntax, e.g. ``"Dear {name},"``, and are filled in from a mapping given for
+each recipient.  String values are HTML-escaped when substituted into the rich text body.
+"""
+
+from __future__ import unicode_literals
+
+import email
+import re
+import time
+import uuid
+
+from email.charset import Charset
+from email.message import Message as MIMEMessage
+from functools import partial
+from string import Formatter
+
+from marrow.mailer.address import AddressList
+from marrow.mailer.message import Message
+from marrow.mailer.stream import _render, _HeaderGenerator
+from marrow.mailer.transfer import TextPart, encode_body
+from marrow.util.compat import unicode
+
+try:
+	from html import escape
+except ImportError:  # pragma: no cover
+	from cgi import escape
+
+
+__all__ = ['Template', 'MergedMessage']
+
+
+_formatter = Formatter()
+
+
+def _fields(text):
+	"""Determine if the given text contains any replacement fields."""
+	return any(field is not None for literal, field, spec, conversion in _formatter.parse(text))
+
+
+class _Escaped(dict):
+	"""Replacement values for HTML content, escaping strings as they are substituted."""
+
+	def __getitem__(self, name):
+		value = dict.__getitem__(self, name)
+		return escape(value) if isinstance(value, unicode) else value
+
+
+class _Body(object):
+	"""A text body compiled into runs of static text and the templated lines filled in for each recipient.
+
+	Called with the replacement values of a recipient, returns the Content-Transfer-Encoding, encoded payload, and
+	8bit content (if any) of the body, as TextPart would produce them.
+	"""
+
+	__slots__ = ('segments', 'escape', 'charset')
+
+	def __init__(self, text, encoding, escape=False):
+		self.charset = Charset(encoding).get_output_charset()
+		self.escape = escape
+
+		segments = []
+
+		for line in text.splitlines(True):
+			if _fields(line):
+				segments.append(partial(self._line, line))
+				continue
+
+			line = _formatter.vformat(line, (), {})  # Unescape doubled braces.
+
+			if segments and not callable(segments[-1]):
+				segments[-1] += line
+			else:
+				segments.append(line)
+
+		self.segments = segments
+
+	@staticmethod
+	def _line(line, values):
+		return _formatter.vformat(line, (), values)
+
+	def __call__(self, values):
+		if self.escape:
+			values = _Escaped(values)
+
+		text = ''.join(segment if not callable(segment) else segment(values) for segment in self.segments)
+
+		return encode_body(text, self.charset)
+
+
+class Template(object):
+	"""A prototype message compiled for efficient, repeated personalization.
+
+	The prototype supplies everything common to the merged messages; its own To recipients are ignored.  Its plain
+	and rich bodies and its subject may contain replacement fields.  Merged messages share the prototype's other
+	address lists and attachment parts; replace, rather than modify, these on an individual merged message.  Unless
+	the prototype's date was explicitly set, each merged message is dated when it is produced.
+
+	A prototype using an alternative MIME builder is not compiled into a skeleton; its merged messages are built in
+	full, so that they are identical to the builder's output for any other message.
+	"""
+
+	__slots__ = ('prototype', 'state', 'text', 'subject', 'plain', 'rich', 'segments')
+
+	def __init__(self, prototype):
+		if not prototype.author:
+			raise ValueError("You must specify an author.")
+
+		if not prototype.subject:
+			raise ValueError("You must specify a subject.")
+
+		if not prototype.plain:
+			raise ValueError("You must provide plain text content.")
+
+		self.prototype = prototype
+
+		nonce = uuid.uuid4().hex
+		token = lambda kind, name: 'M{0}{1}{2}Z'.format(nonce, kind, name)
+
+		encoding = prototype.encoding
+		plain, rich = prototype._callable(prototype.plain), prototype._callable(prototype.rich)
+		subject = prototype.subject
+
+		self.text = plain, rich
+		self.plain = _Body(plain, encoding)
+		self.rich = _Body(rich, encoding, True) if rich else None
+		self.subject = subject if _fields(subject) else None
+		self.segments = None
+
+		# The attributes shared by every merged message.
+		self.state = state = prototype.__getstate__()
+		state['_template'] = self
+
+		if prototype.builder is not None:
+			state['_template'] = None
+			return
+
+		# Build the skeleton MIME document, with tokens marking each piece to be rendered per recipient.  The transfer
+		# encoding of each body depends upon its content, so its Content-Transfer-Encoding header is rendered, too.
+		parts = []
+
+		for name, body in (('plain', plain), ('html', rich)):
+			if not body:
+				parts.append(None)
+				continue
+
+			part = TextPart('', name, encoding)
+			part.replace_header('Content-Transfer-Encoding', token('E', name))
+			part.set_payload(token('B', name))
+			parts.append(part)
+
+		mime = prototype._mime_document(*parts)
+		headers = []
+
+		for name, value in prototype._build_header_list(prototype.author, prototype.sender):
+			lowered = name.lower()
+
+			if lowered == 'to':
+				value = token('H', 'to')
+
+			elif lowered == 'subject' and self.subject:
+				value = token('H', 'subject')
+
+			elif lowered == 'message-id' and value == prototype.id:
+				value = token('H', 'id')
+
+			elif lowered == 'date' and prototype._date is None:
+				value = token('H', 'date')  # Dated as each message is produced, unless explicitly set.
+
+			headers.append((name, value))
+
+		prototype._add_headers_to_message(mime, headers)
+
+		# Split the rendered skeleton into static text and the renderers of the pieces between.
+		pattern = re.compile(r'^([^:\n]+): M{0}([HE])(\w+?)Z\n|M{0}B(\w+?)Z'.format(nonce), re.M)
+		skeleton = mime.as_string()
+		segments = []
+		position = 0
+
+		for match in pattern.finditer(skeleton):
+			segments.append(skeleton[position:match.start()])
+			header, kind, name, body = match.groups()
+
+			if body:
+				segments.append(partial(self._payload, body == 'html'))
+			elif kind == 'E':
+				segments.append(partial(self._encoding, header, name == 'html'))
+			else:
+				segments.append(partial(self._header, header, name))
+
+			position = match.end()
+
+		segments.append(skeleton[position:])
+		self.segments = [segment for segment in segments if segment]
+
+	@staticmethod
+	def _header(name, kind, message, eight):
+		if kind == 'to':
+			value = unicode(message.to)
+		elif kind == 'subject':
+			value = message.subject
+		elif kind == 'date':
+			value = message._build_date_header_string(message.date)
+		else:
+			value = message.id
+
+		part = MIMEMessage()
+		part[name] = value
+
+		return _render(part, _HeaderGenerator)[:-1]  # Omit the blank line ending the header block.
+
+	def bodies(self, message):
+		"""Return the (encoding, payload, raw) of the plain and rich bodies of the given merged message."""
+
+		bodies = message._bodies
+
+		if bodies is None:
+			record = message._record
+			bodies = self.plain(record), self.rich(record) if self.rich else None
+			object.__setattr__(message, '_bodies', bodies)  # A cache; leave _dirty be.
+
+		return bodies
+
+	def _encoding(self, header, rich, message, eight):
+		encoding, payload, raw = self.bodies(message)[rich]
+		return '{0}: {1}\n'.format(header, '8bit' if eight and raw is not None else encoding)
+
+	def _payload(self, rich, message, eight):
+		encoding, payload, raw = self.bodies(message)[rich]
+		return raw if eight and raw is not None else payload
+
+	def iterate(self, message, eight=False):
+		"""Yield the text of the given merged message as a series of strings.
+
+		If eight is true, bodies which may be are written as 8bit, and yielded as encoded byte strings.
+		"""
+
+		for segment in self.segments:
+			yield segment if not callable(segment) else segment(message, eight)
+
+	def __call__(self, record, **kw):
+		"""Produce the message for the recipient described by the given mapping, which must include a 'to' value.
+
+		Additional keyword arguments are assigned as attributes of the new message, e.g. to bind it to a Mailer.
+		"""
+
+		message = MergedMessage.__new__(MergedMessage)
+		compiled = self.segments is not None
+
+		values = dict(self.state)
+		values['_record'] = record
+		values['_bodies'] = None
+		values['_to'] = AddressList(record['to'])
+		values['_id'] = None
+		values['_created'] = time.time()
+		values['_dirty'] = set() if compiled else set(Message._everything)
+		values['_processed'] = compiled
+		values['_rendered'] = None
+		values['_attachments'] = list(self.prototype.attachments)
+		values['_embedded'] = list(self.prototype.embedded)
+		values['_headers'] = self.prototype.headers.copy() if isinstance(self.prototype.headers, dict) else \
+				list(self.prototype.headers)
+		# Should the message be altered, its bodies are rendered in full from these.
+		values['plain'] = partial(_formatter.vformat, self.text[0], (), record)
+		values['rich'] = partial(_formatter.vformat, self.text[1], (), _Escaped(record)) if self.rich else None
+
+		if self.subject:
+			values['subject'] = _formatter.vformat(self.subject, (), record)
+
+		message.__setstate__(values)
+
+		for name in kw:
+			setattr(message, name, kw[name])
+
+		return message
+
+
+class MergedMessage(Message):
+	"""A message produced by a Template.
+
+	Until one of its attributes affecting the content is changed the message is rendered by filling in the template's
+	skeleton; afterwards it behaves as any other message.
+	"""
+
+	def _pristine(self):
+		if self._template is None:
+			return False
+
+		if self._dirty:
+			object.__setattr__(self, '_template', None)
+			object.__setattr__(self, '_rendered', None)
+			object.__setattr__(self, '_mime', None)
+			return False
+
+		return True
+
+	def __getstate__(self):
+		"""Pickle as a standalone message; the template is not retained."""
+
+		state = super(MergedMessage, self).__getstate__()
+		state['_id'] = self.id  # Merged messages are assigned their Message-ID lazily; settle it now.
+		state['_template'] = None
+		state['_record'] = None
+		state['_bodies'] = None
+		state['plain'] = self._callable(self.plain)
+		state['rich'] = self._callable(self.rich)
+		return state
+
+	@property
+	def mime(self):
+		if not self._pristine():
+			return Message.mime.fget(self)
+
+		mime = self._mime
+
+		if mime is None:
+			mime = self._mime = email.message_from_string(str(self))
+
+		return mime
+
+	def _render(self):
+		if not self._pristine():
+			return super(MergedMessage, self)._render()
+
+		rendered = self._rendered
+
+		if rendered is None:
+			rendered = [None, ''.join(self._template.iterate(self)), None]
+			object.__setattr__(self, '_rendered', rendered)
+
+		return rendered
+
+	def stream(self, size=65536, eight=None, utf8=None):
+		if not self._pristine() or self._rendered is not None:
+			return super(MergedMessage, self).stream(size, eight, utf8)
+
+		return self._chunks(self._template.iterate(self, bool(eight)), size)
+
+	def mail_options(self, eight=None, utf8=None):
+		if self._pristine() and self._rendered is None:
+			# The skeleton is 7-bit throughout; only the bodies may be written as 8bit.
+			if eight and any(body and body[2] is not None for body in self._template.bodies(self)):
+				return ['BODY=8BITMIME']
+
+			return []
+
+		return super(MergedMessage, self).mail_options(eight, utf8)
+
+	@staticmethod
+	def _chunks(texts, size):
+		for text in texts:
+			if not isinstance(text, bytes):
+				text = text.encode('ascii')
+
+			for i in range(0, len(text), size):
+				yield text[i:i + size]
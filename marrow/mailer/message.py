@@ -4,29 +4,88 @@
 
 from __future__ import unicode_literals
 
+import copy
+import email.message
 import imghdr
+import io
+import mmap
 import os
+import re
 import sys
 import time
-import base64
 
 from datetime import datetime
-from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from email.mime.nonmultipart import MIMENonMultipart
-from email.utils import make_msgid, formatdate
+from email.utils import formatdate
 from mimetypes import guess_type
 
 from marrow.mailer import release
+from marrow.mailer import msgid
+from marrow.mailer import record
+from marrow.mailer.attachment import Attachment, cache
 from marrow.mailer.address import Address, AddressList, AutoConverter
+from marrow.mailer.stream import flatten, flatten_binary, ChunkReader
+from marrow.mailer.transfer import TextPart, eight_bit, international, seven_bit
 from marrow.util.compat import basestring, unicode, native
+from marrow.util.object import load_object
 
 
 __all__ = ['Message']
 
 
+_EmailMessage = getattr(email.message, 'EmailMessage', ())
+_blank = re.compile(br'\r?\n\r?\n')  # The end of the header block.
+
+
+def _binary(document):
+	"""Determine if a MIME document was produced by a modern builder, and so serializes directly to bytes."""
+	return isinstance(document, _EmailMessage)
+
+
+def _detach(part):
+	"""Return a shallow copy of a MIME part whose headers may be altered independently of the original."""
+	clone = copy.copy(part)
+	clone._headers = list(part._headers)
+	return clone
+
+
+class _Lazy(object):
+	"""A container attribute, allocated only once it is first used."""
+
+	__slots__ = ('attr', 'factory')
+
+	def __init__(self, attr, factory):
+		self.attr = attr
+		self.factory = factory
+
+	def __get__(self, instance, owner):
+		if instance is None:
+			return self
+
+		value = getattr(instance, self.attr)
+
+		if value is None:
+			value = self.factory()
+			object.__setattr__(instance, self.attr, value)  # An empty container changes nothing; leave _dirty be.
+
+		return value
+
+	def __set__(self, instance, value):
+		setattr(instance, self.attr, value)
+
+
 class Message(object):
-	"""Represents an e-mail message."""
+	"""Represents an e-mail message.
+
+	Messages are slotted and allocate their address lists and attachment containers on first use, so that large
+	numbers of them may be queued cheaply.  The __dict__ slot is kept for compatibility with applications annotating
+	messages with attributes of their own, as was always possible; the dictionary is only allocated once they do.
+	"""
+
+	__slots__ = ('_dirty', '_id', '_processed', '_parts', '_rendered', '_mime', 'mailer', 'subject', '_date',
+			'_created', 'encoding', 'organization', 'priority', 'plain', 'rich', '_attachments', '_embedded',
+			'_headers', 'retries', 'brand', '_sender', '_author', '_to', '_cc', '_bcc', '_reply', '_notify',
+			'__dict__')
 
 	sender = AutoConverter('_sender', Address, False)
 	author = AutoConverter('_author', AddressList)
@@ -37,6 +96,40 @@ class Message(object):
 	reply = AutoConverter('_reply', AddressList)
 	notify = AutoConverter('_notify', AddressList)
 
+	attachments = _Lazy('_attachments', list)
+	embedded = _Lazy('_embedded', list)
+	headers = _Lazy('_headers', list)
+
+	# The Message-ID strategy: the name of one of the generators in marrow.mailer.msgid, a 'package:object'
+	# reference, or a callable accepting an optional domain.  May be overridden per message or in configuration.
+	id_generator = 'standard'
+
+	# The builder of the MIME document: None for the legacy email.mime classes, the name of one of the builders in
+	# marrow.mailer.builder (such as 'smtp'), a 'package:object' reference, or a callable.
+	builder = None
+
+	# The sections of the rendered message affected by each attribute.  Assigning retries, mailer, or bcc leaves the
+	# cached rendering intact; properties are tracked through the attributes they store to, and attributes not listed
+	# here are assumed to affect everything.
+	_sections = dict(
+			subject = ('headers', ), organization = ('headers', ), priority = ('headers', ),
+			brand = ('headers', ), id_generator = ('headers', ), _date = ('headers', ), _headers = ('headers', ),
+			_sender = ('headers', ), _author = ('headers', ), _to = ('headers', ), _cc = ('headers', ),
+			_reply = ('headers', ), _notify = ('headers', ),
+			sender = (), author = (), authors = (), to = (), cc = (), bcc = (), reply = (), notify = (), date = (),
+			headers = (), attachments = (), embedded = (),
+			plain = ('body', ), rich = ('body', ), encoding = ('headers', 'body'),
+			_attachments = ('attachments', ), _embedded = ('attachments', ),
+			retries = (), mailer = (), _bcc = (), _id = (), _processed = (), _dirty = (), _mime = (), _parts = (),
+			_rendered = (), _created = (),
+		)
+	_everything = ('headers', 'body', 'attachments')
+	_defaults = (('_id', None), ('_processed', False), ('_parts', None), ('_rendered', None), ('_mime', None),
+			('mailer', None), ('subject', None), ('_date', None), ('encoding', 'utf-8'), ('organization', None),
+			('priority', None), ('plain', None), ('rich', None), ('_attachments', None), ('_embedded', None),
+			('_headers', None), ('retries', 3), ('brand', True), ('_sender', None), ('_author', None), ('_to', None),
+			('_cc', None), ('_bcc', None), ('_reply', None), ('_notify', None))
+
 	def __init__(self, author=None, to=None, subject=None, **kw):
 		"""Instantiate a new Message object.
 
@@ -46,33 +139,12 @@ class Message(object):
 		arguments can be used to quickly prepare a simple message.
 		"""
 
-		# Internally used attributes
-		self._id = None
-		self._processed = False
-		self._dirty = False
-		self.mailer = None
-
-		# Default values
-		self.subject = None
-		self.date = datetime.now()
-		self.encoding = 'utf-8'
-		self.organization = None
-		self.priority = None
-		self.plain = None
-		self.rich = None
-		self.attachments = []
-		self.embedded = []
-		self.headers = []
-		self.retries = 3
-		self.brand = True
-
-		self._sender = None
-		self._author = AddressList()
-		self._to = AddressList()
-		self._cc = AddressList()
-		self._bcc = AddressList()
-		self._reply = AddressList()
-		self._notify = AddressList()
+		init = object.__setattr__
+		init(self, '_dirty', set(self._everything))  # The sections changed since the MIME document was last produced.
+		init(self, '_created', time.time())  # The default date; a datetime is only produced if needed.
+
+		for name, value in self._defaults:
+			init(self, name, value)
 
 		# Overrides at initialization time
 		if author is not None:
@@ -90,24 +162,213 @@ class Message(object):
 
 			setattr(self, k, kw[k])
 
+	@property
+	def date(self):
+		"""The date of the message: a datetime, timestamp, or string; by default the time the message was created."""
+		date = self._date
+		return datetime.fromtimestamp(self._created) if date is None else date
+	
+	@date.setter
+	def date(self, value):
+		self._date = value
+	
 	def __setattr__(self, name, value):
-		"""Set the dirty flag as properties are updated."""
+		"""Record which sections of the message are changed as properties are updated."""
 		object.__setattr__(self, name, value)
-		if name not in ('bcc', '_id', '_dirty', '_processed'):
-			object.__setattr__(self, '_dirty', True)
+		self._dirty.update(self._sections.get(name, self._everything))
+	
+	def __getstate__(self):
+		"""Pickle without the bound Mailer or any cached rendering; both are re-established on use."""
+		state = self.__dict__.copy()  # Attributes beyond those of Message itself.
+		
+		for name in Message.__slots__[:-1]:
+			state[name] = getattr(self, name)
+		
+		state['mailer'] = None
+		state['_processed'] = False
+		state['_dirty'] = set(self._everything)
+		state['_parts'] = None
+		state['_rendered'] = None
+		state['_mime'] = None
+		return state
+	
+	def __setstate__(self, state):
+		init = object.__setattr__
+		
+		for name in state:
+			init(self, name, state[name])
+	
+	def to_record(self):
+		"""Serialize the message as a compact, versioned byte string; restore it using from_record.
+		
+		Only the values set by the user are recorded: no rendering, bound Mailer, or encoded attachment payloads.
+		Bodies produced by callables are evaluated now, attachments read from files are recorded by path and read
+		again at delivery, and the id generator and builder must be given by name.  Attributes not defined by
+		Message are not retained.
+		"""
+		return record.dumps(self)
+	
+	@classmethod
+	def from_record(cls, data):
+		"""Reconstruct a message from the product of to_record."""
+		return record.loads(data, cls)
+	
+	def _adopted(self):
+		"""Return the rendering adopted from elsewhere, if it remains valid."""
+		rendered = self._rendered
+		
+		if rendered is not None and rendered[0] is None and not self._dirty:
+			return rendered
+	
+	def _adopt(self, data):
+		"""Use a serialization of this message produced elsewhere, e.g. in another process, until it is next changed.
+		
+		The message should not have been altered since the state it was rendered from was captured.  Any change
+		afterwards marks a section dirty, invalidating the adopted serialization, and the MIME document is then
+		built again from scratch.  Passing None releases an adopted serialization.
+		"""
+		init = object.__setattr__
+		
+		if data is None:
+			if self._adopted() is not None:
+				init(self, '_rendered', None)
+			
+			return
+		
+		self._dirty.clear()
+		init(self, '_processed', False)  # Any cached MIME document or parts predate the adopted rendering.
+		init(self, '_parts', None)
+		init(self, '_rendered', [None, None, data])
+	
+	def _render(self):
+		"""Return the cached [mime, text, bytes] rendering, producing it again if the MIME document changed.
+		
+		Only one of the text or bytes forms is produced; the other is derived from it on demand.
+		"""
+		rendered = self._adopted()
+		
+		if rendered is not None:
+			return rendered
+		
+		mime = self.mime
+		rendered = self._rendered
+		
+		if rendered is None or rendered[0] is not mime:
+			if _binary(mime):
+				rendered = [mime, None, mime.as_bytes()]
+			else:
+				rendered = [mime, mime.as_string(), None]
+			
+			object.__setattr__(self, '_rendered', rendered)
+		
+		return rendered
 	
 	def __str__(self):
-		return self.mime.as_string()
+		rendered = self._render()
+		
+		if rendered[1] is None:
+			rendered[1] = rendered[2] if str is bytes else rendered[2].decode('utf-8', 'surrogateescape')
+		
+		return rendered[1]
 	
 	__unicode__ = __str__
 	
 	def __bytes__(self):
-		return self.mime.as_string().encode('ascii')
+		rendered = self._render()
+		
+		if rendered[2] is None:
+			rendered[2] = rendered[1].encode('ascii')
+		
+		return rendered[2]
+	
+	def stream(self, size=65536, eight=None, utf8=None):
+		"""Serialize the message incrementally, yielding byte strings of at most size bytes.
+		
+		The concatenated chunks equal bytes(message).  Multipart containers and lazily encoded attachments are
+		streamed; each other leaf part, such as a text body, is rendered into memory whole, one at a time.  Every call
+		serializes the message afresh.
+		
+		To tailor the output to the receiving server, pass eight and utf8 as true or false according to whether it
+		advertises the 8BITMIME and SMTPUTF8 extensions.  Text parts are then written as 8bit where possible, and
+		documents built under a policy using an unsupported extension are downgraded to suit.  The MAIL parameters
+		needed to deliver the result are given by mail_options.
+		"""
+		data = self._verbatim(eight, utf8)
+		
+		if data is not None:
+			return (data[i:i + size] for i in range(0, len(data), size))
+		
+		mime = self.mime
+		
+		if _binary(mime):
+			return flatten_binary(mime, size, self._policy(mime, eight, utf8))
+		
+		return flatten(mime, size, eight=bool(eight))
+	
+	def mail_options(self, eight=None, utf8=None):
+		"""Return the ESMTP parameters of the MAIL command needed to deliver stream(size, eight, utf8)."""
+		data = self._verbatim(eight, utf8)
+		
+		if data is not None:
+			if seven_bit(data):
+				return []
+			
+			return ['BODY=8BITMIME'] + (['SMTPUTF8'] if not seven_bit(_blank.split(data, 1)[0]) else [])
+		
+		mime = self.mime
+		
+		if not _binary(mime):
+			return ['BODY=8BITMIME'] if eight and eight_bit(mime) else []
+		
+		policy = self._policy(mime, eight, utf8)
+		options = []
+		
+		if policy.cte_type == '8bit' and eight_bit(mime):
+			options.append('BODY=8BITMIME')
+		
+		if policy.utf8 and international(mime):
+			options.append('SMTPUTF8')
+		
+		return options
+	
+	def _verbatim(self, eight, utf8):
+		"""Return the adopted rendering if it may be delivered as-is to a server with the given capabilities."""
+		if self._adopted() is None:
+			return None
+		
+		data = self.__bytes__()
+		
+		if (eight is None and utf8 is None) or (eight and utf8) or seven_bit(data):
+			return data
+		
+		return None
+	
+	@staticmethod
+	def _policy(document, eight, utf8):
+		"""Return the policy of a modern document, downgraded to avoid the extensions a server does not support."""
+		policy = document.policy
+		
+		if utf8 is False and policy.utf8:
+			policy = policy.clone(utf8=False)
+		
+		if eight is False and policy.cte_type == '8bit':
+			policy = policy.clone(cte_type='7bit')
+		
+		return policy
+	
+	def reader(self, size=65536):
+		"""Return a read-only binary file-like object producing the serialized message on demand."""
+		return io.BufferedReader(ChunkReader(self.stream(size)), size)
 	
 	@property
 	def id(self):
 		if not self._id or (self._processed and self._dirty):
-			self._id = make_msgid()
+			generator = self.id_generator
+			
+			if isinstance(generator, basestring):
+				generator = msgid.generators[generator] if ':' not in generator else load_object(generator)
+			
+			self._id = generator()
 			self._processed = False
 		return self._id
 
@@ -238,22 +499,54 @@ class Message(object):
 
 		self._processed = False
 
-		plain = MIMEText(self._callable(self.plain), 'plain', self.encoding)
+		if self.builder is not None:
+			return self._build()
+
+		# The encoded bodies are re-used unless they have changed or are produced dynamically.
+		if self._parts is None or 'body' in self._dirty or callable(self.plain) or callable(self.rich):
+			plain = TextPart(self._callable(self.plain), 'plain', self.encoding)
 
-		rich = None
-		if self.rich:
-			rich = MIMEText(self._callable(self.rich), 'html', self.encoding)
+			rich = None
+			if self.rich:
+				rich = TextPart(self._callable(self.rich), 'html', self.encoding)
+
+			self._parts = plain, rich
+
+		plain, rich = self._parts
 
 		message = self._mime_document(plain, rich)
+
+		if message is plain:
+			message = _detach(plain)  # Headers are about to be added; leave the cached part untouched.
+
 		headers = self._build_header_list(author, sender)
 		self._add_headers_to_message(message, headers)
 
 		self._mime = message
 		self._processed = True
-		self._dirty = False
+		self._dirty.clear()
 
 		return message
 
+	def _build(self):
+		"""Produce the MIME document using an alternative builder."""
+		builder = self.builder
+		
+		if isinstance(builder, basestring):
+			if ':' in builder:
+				builder = load_object(builder)
+			else:
+				from marrow.mailer.builder import builders
+				builder = builders[builder]
+		
+		message = builder(self, self._callable(self.plain), self._callable(self.rich))
+		
+		self._mime = message
+		self._processed = True
+		self._dirty.clear()
+		
+		return message
+
 	def attach(self, name, data=None, maintype=None, subtype=None,
 		inline=False, filename=None, filename_charset='', filename_language='',
 		encoding=None):
@@ -263,7 +556,9 @@ class Message(object):
 					 of the file if the ``data`` argument is given
 		:param data: Contents of the file to attach, or None if the data is to
 					 be read from the file pointed to by the ``name`` argument
-		:type data: bytes or a file-like object
+		:type data: bytes, bytearray, mmap, or a file-like object; seekable files
+					and files named by path are only read when the message is
+					serialized, and must remain available until it is sent
 		:param maintype: First part of the MIME type of the file -- will be
 						 automatically guessed if not given
 		:param subtype: Second part of the MIME type of the file -- will be
@@ -278,7 +573,7 @@ class Message(object):
 		:param encoding: Value of the Content-Encoding MIME header (e.g. "gzip"
 						 in case of .tar.gz, but usually empty)
 		"""
-		self._dirty = True
+		self._dirty.add('attachments')
 
 		if not maintype:
 			maintype, guessed_encoding = guess_type(name)
@@ -288,24 +583,14 @@ class Message(object):
 			else:
 				maintype, _, subtype = maintype.partition('/')
 
-		part = MIMENonMultipart(maintype, subtype)
-		part.add_header('Content-Transfer-Encoding', 'base64')
-
-		if encoding:
-			part.add_header('Content-Encoding', encoding)
-
 		if data is None:
-			with open(name, 'rb') as fp:
-				value = fp.read()
+			part = self._attachment(maintype, subtype, path=name)
 			name = os.path.basename(name)
-		elif isinstance(data, bytes):
-			value = data
-		elif hasattr(data, 'read'):
-			value = data.read()
 		else:
-			raise TypeError("Unable to read attachment contents")
-		
-		part.set_payload(base64.encodestring(value))
+			part = self._attachment(maintype, subtype, data)
+
+		if encoding:
+			part.add_header('Content-Encoding', encoding)
 
 		if not filename:
 			filename = name
@@ -339,6 +624,19 @@ class Message(object):
 				part.add_header('Content-Disposition', 'attachment', filename=filename)
 			self.attachments.append(part)
 
+	@staticmethod
+	def _attachment(maintype, subtype, data=None, path=None):
+		"""Produce the MIME part for the given content, sharing its encoding through the attachment cache."""
+		if path is not None:
+			os.stat(path)  # Fail early, rather than at delivery, if the file is missing.
+			return Attachment(maintype, subtype, path=path, cache=cache)  # Read as the message is serialized.
+		
+		if isinstance(data, (bytes, bytearray, mmap.mmap)) or hasattr(data, 'read'):
+			key = cache.key(data)
+			return Attachment(maintype, subtype, data, encoded=cache.encoded(key, data) if key else None)
+		
+		raise TypeError("Unable to read attachment contents")
+
 	def embed(self, name, data=None):
 		"""Attach an image file and prepare for HTML embedding.
 
@@ -350,17 +648,27 @@ class Message(object):
 					 be read from the file pointed to by the ``name`` argument
 		"""
 		if data is None:
-			with open(name, 'rb') as fp:
-				data = fp.read()
-			name = os.path.basename(name)
-		elif isinstance(data, bytes):
-			pass
+			# The type of a cached image file is remembered, rather than sniffed again.
+			key = cache.key(path=name)
+			subtype = cache.kind(key, lambda: imghdr.what(name)) if key else imghdr.what(name)
+			self.attach(name, None, 'image', subtype, True)
+			return
+
+		# Only the leading bytes are needed to identify the image type.
+		if isinstance(data, (bytes, bytearray, mmap.mmap)):
+			header = bytes(data[:32])
 		elif hasattr(data, 'read'):
-			data = data.read()
+			try:
+				position = data.tell()
+				header = data.read(32)
+				data.seek(position)
+			except (AttributeError, IOError, OSError):
+				data = data.read()
+				header = data[:32]
 		else:
 			raise TypeError("Unable to read image contents")
 
-		subtype = imghdr.what(None, data)
+		subtype = imghdr.what(None, header)
 		self.attach(name, data, 'image', subtype, True)
 
 	@staticmethod
@@ -0,0 +1,112 @@
+# encoding: utf-8
+
+"""Message-ID generation strategies.
+
+Each generator is a callable accepting an optional domain and returning a complete, angle-bracketed Message-ID.  The
+local host name, used when no domain is given, is looked up once and cached; resolving it can be slow on hosts with
+misconfigured reverse DNS.
+"""
+
+from __future__ import unicode_literals
+
+import binascii
+import itertools
+import os
+import random
+import socket
+import threading
+import time
+
+
+__all__ = ['hostname', 'standard', 'counter', 'ulid', 'generators']
+
+
+_hostname = None
+
+
+def hostname(value=None):
+	"""Return the cached fully qualified name of the local host, looking it up on first use.
+	
+	Passing a value replaces the cached name.
+	"""
+	
+	global _hostname
+	
+	if value is not None:
+		_hostname = value
+	
+	elif _hostname is None:
+		_hostname = socket.getfqdn()
+	
+	return _hostname
+
+
+def standard(domain=None):
+	"""Equivalent to email.utils.make_msgid, without the per-call host name lookup."""
+	
+	return '<%d.%d.%d@%s>' % (int(time.time() * 100), os.getpid(), random.getrandbits(64), domain or hostname())
+
+
+_counter = itertools.count()
+_prefix = (None, None)  # The process the prefix was generated for, and the prefix.
+
+
+def counter(domain=None):
+	"""A process-unique prefix, a monotonically increasing counter, and a random suffix.
+	
+	The prefix is regenerated in forked child processes.
+	"""
+	
+	global _prefix
+	
+	pid, prefix = _prefix
+	
+	if pid != os.getpid():
+		pid = os.getpid()
+		prefix = '%x.%x.%x' % (int(time.time()), pid, random.getrandbits(32))
+		_prefix = (pid, prefix)
+	
+	return '<%s.%x.%08x@%s>' % (prefix, next(_counter), random.getrandbits(32), domain or hostname())
+
+
+_alphabet = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'  # Crockford's base 32.
+_ulid_lock = threading.Lock()
+_ulid_last = [0, 0]  # Millisecond timestamp and random component of the most recent ULID.
+
+
+def ulid(domain=None):
+	"""A time-ordered, 26 character ULID: a 48-bit millisecond timestamp followed by 80 random bits.
+	
+	Identifiers generated within the same millisecond increment the random component, keeping them strictly
+	ordered.
+	"""
+	
+	timestamp = int(time.time() * 1000)
+	
+	with _ulid_lock:
+		if timestamp <= _ulid_last[0]:
+			timestamp = _ulid_last[0]
+			entropy = (_ulid_last[1] + 1) & 0xffffffffffffffffffff
+		
+		else:
+			entropy = int(binascii.hexlify(os.urandom(10)), 16)
+		
+		_ulid_last[0], _ulid_last[1] = timestamp, entropy
+	
+	value = timestamp << 80 | entropy
+	chars = []
+	
+	for i in range(26):
+		chars.append(_alphabet[value & 31])
+		value >>= 5
+	
+	chars.reverse()
+	
+	return '<%s@%s>' % (''.join(chars), domain or hostname())
+
+
+generators = {
+		'standard': standard,
+		'counter': counter,
+		'ulid': ulid,
+	}
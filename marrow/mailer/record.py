@@ -0,0 +1,165 @@
+# encoding: utf-8
+
+"""A compact, versioned serialization of messages for spools, queues, and other processes.
+
+Pickling a Message captures everything reachable from it: the cached MIME document with its encoded attachment
+payloads, the address objects and their caches, and any bound Mailer.  A record holds only the values set by the
+user, as plain strings, numbers, and tuples in a fixed order.  Attachments read from files are referenced by path,
+and in-memory attachments are stored as their raw, unencoded content.
+
+Records are produced by pickle, and loaded by an unpickler refusing anything but plain values and dates, so decoding
+runs at the speed of the C unpickler without importing or calling arbitrary code.
+"""
+
+from __future__ import unicode_literals
+
+import email
+import io
+import pickle
+import struct
+import sys
+
+from marrow.mailer.address import Address, AddressList
+from marrow.mailer.attachment import Attachment
+from marrow.util.compat import basestring, unicode
+
+
+__all__ = ['MAGIC', 'VERSION', 'dumps', 'loads']
+
+
+MAGIC = b'MR'  # Distinguishes records from pickles, which begin with the PROTO opcode.
+VERSION = 1
+
+_header = struct.Struct(str('>2sB'))  # Magic and version.
+
+# Protocol 2 would store byte strings as calls to _codecs.encode; protocol 3 and later have a native representation.
+_protocol = 2 if sys.version_info < (3, 0) else min(pickle.HIGHEST_PROTOCOL, 4)
+
+_safe = {
+		('datetime', 'datetime'), ('datetime', 'date'), ('datetime', 'timedelta'), ('datetime', 'timezone'),
+	}
+
+
+class _Unpickler(pickle.Unpickler):
+	def find_class(self, module, name):
+		if (module, name) not in _safe:
+			raise pickle.UnpicklingError("Message records may not reference %s.%s" % (module, name))
+
+		return pickle.Unpickler.find_class(self, module, name)
+
+
+def _named(message, attribute):
+	"""Return a strategy which must be given by name, if it can be recorded at all."""
+
+	value = getattr(message, attribute)
+
+	if value is not None and not isinstance(value, basestring):
+		raise TypeError("Unable to record the %s of a message; use a name or 'package:object' reference." % (
+				attribute, ))
+
+	return value
+
+
+def _addresses(addresses):
+	return tuple((address.name, address.address) for address in addresses) or None
+
+
+def _text(value):
+	return value if isinstance(value, basestring) else unicode(value)
+
+
+def _part(part):
+	if not isinstance(part, Attachment):
+		return None, None, part.as_string()  # Any other MIME part is recorded in full.
+
+	headers = tuple((_text(name), _text(value)) for name, value in part.items())
+
+	if part._path is not None:
+		return headers, part._path, None
+
+	return headers, None, part.get_payload(decode=True)
+
+
+def dumps(message):
+	"""Serialize the given message as a record."""
+
+	headers = message.headers
+
+	if isinstance(headers, dict):
+		headers = dict((name, _text(value)) for name, value in headers.items())
+	else:
+		headers = tuple((name, _text(value)) for name, value in headers)
+
+	sender = message.sender
+
+	record = (
+			message.subject, message.date, message.encoding, message.organization, message.priority,
+			message._callable(message.plain), message._callable(message.rich), headers, message.retries,
+			message.brand, message._id, _named(message, 'id_generator'), _named(message, 'builder'),
+			(sender.name, sender.address) if sender else None,
+			_addresses(message.author), _addresses(message.to), _addresses(message.cc), _addresses(message.bcc),
+			_addresses(message.reply), _addresses(message.notify),
+			tuple(_part(part) for part in message.attachments), tuple(_part(part) for part in message.embedded),
+		)
+
+	return _header.pack(MAGIC, VERSION) + pickle.dumps(record, _protocol)
+
+
+def _restore(message, record):
+	headers, path, data = record
+
+	if headers is None:
+		return email.message_from_string(data)
+
+	if path is not None:
+		# Read when delivered, and not before: a missing file then fails the delivery of this message alone.
+		part = Attachment('application', 'octet-stream', path=path)
+	else:
+		part = message._attachment('application', 'octet-stream', data)
+
+	part._headers = [(str(name), value) for name, value in headers]
+
+	return part
+
+
+def loads(data, cls):
+	"""Reconstruct a message of the given class from a record."""
+
+	magic, version = _header.unpack_from(data)
+
+	if magic != MAGIC:
+		raise ValueError("Not a message record.")
+
+	if version != VERSION:
+		raise ValueError("Unsupported message record version: %d" % (version, ))
+
+	stream = io.BytesIO(data)
+	stream.seek(_header.size)
+
+	(subject, date, encoding, organization, priority, plain, rich, headers, retries, brand, id_, id_generator,
+			builder, sender, author, to, cc, bcc, reply, notify, attachments, embedded) = _Unpickler(stream).load()
+
+	message = cls(subject=subject, date=date, encoding=encoding, organization=organization, priority=priority,
+			plain=plain, rich=rich, retries=retries, brand=brand)
+
+	message.headers = headers if isinstance(headers, dict) else [tuple(header) for header in headers]
+	message._id = id_
+
+	if id_generator is not None:
+		message.id_generator = id_generator
+
+	if builder is not None:
+		message.builder = builder
+
+	if sender is not None:
+		message.sender = Address(sender)
+
+	for name, addresses in (('author', author), ('to', to), ('cc', cc), ('bcc', bcc), ('reply', reply),
+			('notify', notify)):
+		if addresses:
+			setattr(message, name, AddressList(list(addresses)))
+
+	message.attachments = [_restore(message, part) for part in attachments]
+	message.embedded = [_restore(message, part) for part in embedded]
+
+	return message
@@ -0,0 +1,241 @@
+# encoding: utf-8
+
+"""Incremental serialization of MIME documents.
+
+The standard library generator renders every part of a multipart document into memory before writing any of it,
+so the complete message exists several times over.  Here multipart containers are framed by hand and only a single
+leaf part is rendered at a time, producing output identical to ``as_string()``, or to ``as_bytes()`` for documents
+built with a modern ``email.policy``.
+"""
+
+from __future__ import unicode_literals
+
+import io
+import re
+import sys
+
+from email import generator
+from email.generator import Generator
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+try:
+	from io import StringIO
+except ImportError:  # pragma: no cover
+	from StringIO import StringIO
+
+
+try:
+	from email.generator import BytesGenerator
+except ImportError:  # pragma: no cover
+	BytesGenerator = None
+
+
+__all__ = ['flatten', 'flatten_binary', 'ChunkReader']
+
+
+if sys.version_info < (3, 0):  # pragma: no cover
+	_options = dict()  # Message.as_string uses the generator's defaults.
+
+else:
+	_options = dict(mangle_from_=False, maxheaderlen=0)
+
+_make_boundary = getattr(Generator, '_make_boundary', None) or generator._make_boundary
+
+
+class _HeaderGenerator(Generator):
+	"""Render only the headers of a part, and the blank line separating them from the body."""
+	
+	def _dispatch(self, msg):
+		pass
+
+
+if BytesGenerator is not None:
+	class _HeaderBytesGenerator(BytesGenerator):
+		"""Render only the headers of a part, and the blank line separating them from the body, as bytes."""
+		
+		def _dispatch(self, msg):
+			pass
+
+_newlines = re.compile(r'\r\n|\r|\n')
+
+
+def _probe():
+	"""Determine if this version of the generator terminates the close-delimiter of a multipart with a newline."""
+	
+	sample = MIMEMultipart(boundary='=')
+	sample.attach(MIMEText('x'))
+	
+	return sample.as_string().endswith('--=--\n')
+
+_close_newline = _probe()
+
+
+def _render(part, cls=Generator):
+	buf = StringIO()
+	cls(buf, **_options).flatten(part, unixfrom=False)
+	return buf.getvalue()
+
+
+class _Text(object):
+	"""Render parts as strings, as Message.as_string would."""
+	
+	nl = '\n'
+	header = _HeaderGenerator
+	eight = False
+	
+	@staticmethod
+	def text(value):
+		return value
+	
+	@staticmethod
+	def render(part, cls=Generator):
+		return _render(part, cls)
+
+
+class _Eight(_Text):
+	"""Render parts as byte strings, writing text parts which permit it as 8bit, for servers supporting 8BITMIME."""
+	
+	nl = b'\n'
+	eight = True
+	
+	@staticmethod
+	def text(value):
+		return value.encode('ascii')
+	
+	@staticmethod
+	def render(part, cls=Generator):
+		return _render(part, cls).encode('ascii')
+
+
+class _Binary(object):
+	"""Render parts as byte strings using a single policy throughout, as BytesGenerator would."""
+	
+	def __init__(self, policy):
+		self.policy = policy
+		self.linesep = policy.linesep
+		self.nl = policy.linesep.encode('ascii')
+		self.header = _HeaderBytesGenerator
+		self.eight = False  # The policy alone determines the transfer encoding of each part.
+	
+	def text(self, value):
+		return _newlines.sub(self.linesep, value).encode('ascii')
+	
+	def render(self, part, cls=None):
+		buf = io.BytesIO()
+		(cls or BytesGenerator)(buf, mangle_from_=False, policy=self.policy).flatten(part, unixfrom=False)
+		return buf.getvalue()
+
+
+def _parts(part, output=_Text):
+	"""Yield the text of the given MIME part as a series of strings (or byte strings, for binary output)."""
+	
+	text, nl = output.text, output.nl
+	
+	if hasattr(part, 'iter_payload'):
+		# Lazily encoded attachments are never held in memory whole.
+		yield output.render(part, output.header)
+		
+		for chunk in part.iter_payload():
+			yield text(chunk)
+		
+		return
+	
+	if output.eight and getattr(part, 'raw', None) is not None:
+		yield output.render(part.eight_bit(), output.header)
+		yield part.raw
+		return
+	
+	if part.get_content_maintype() != 'multipart' or part.get_content_subtype() == 'signed' or \
+			not isinstance(part.get_payload(), list):
+		yield output.render(part)
+		return
+	
+	boundary = part.get_boundary()
+	
+	if not boundary:
+		# Fix the boundary up front; the generator would otherwise choose one after rendering every subpart.
+		boundary = _make_boundary()
+		part.set_boundary(boundary)
+	
+	yield output.render(part, output.header)
+	
+	if part.preamble is not None:
+		yield text(part.preamble + '\n')
+	
+	delimiter = text('--' + boundary) + nl
+	
+	for i, subpart in enumerate(part.get_payload()):
+		yield delimiter if not i else nl + delimiter
+		
+		for chunk in _parts(subpart, output):
+			yield chunk
+	
+	yield nl + text('--' + boundary + '--') + (nl if _close_newline else text(''))
+	
+	if part.epilogue is not None:
+		yield text(part.epilogue if _close_newline else '\n' + part.epilogue)
+
+
+def flatten(part, size=65536, encoding='ascii', eight=False):
+	"""Serialize a MIME document, yielding encoded byte strings of at most size characters each.
+	
+	The concatenation of the chunks is identical to ``part.as_string().encode(encoding)``, unless eight is true: text
+	parts able to be are then written unencoded, declaring the 8bit transfer encoding, for a server supporting the
+	8BITMIME extension.
+	"""
+	
+	if eight:
+		for data in _parts(part, _Eight):
+			for i in range(0, len(data), size):
+				yield data[i:i + size]
+		
+		return
+	
+	for text in _parts(part):
+		for i in range(0, len(text), size):
+			yield text[i:i + size].encode(encoding)
+
+
+def flatten_binary(part, size=65536, policy=None):
+	"""Serialize a MIME document using the given policy (by default its own), yielding byte strings of at most size.
+	
+	The concatenation of the chunks is identical to ``part.as_bytes(policy=policy)``.
+	"""
+	
+	output = _Binary(policy or part.policy)
+	
+	for data in _parts(part, output):
+		for i in range(0, len(data), size):
+			yield data[i:i + size]
+
+
+class ChunkReader(io.RawIOBase):
+	"""A read-only binary file reading from an iterable of byte strings.
+	
+	Wrap in an io.BufferedReader for efficient line-oriented access.
+	"""
+	
+	def __init__(self, chunks):
+		super(ChunkReader, self).__init__()
+		self._chunks = iter(chunks)
+		self._pending = b''
+	
+	def readable(self):
+		return True
+	
+	def readinto(self, buffer):
+		pending = self._pending
+		
+		while not pending:
+			try:
+				pending = next(self._chunks)
+			
+			except StopIteration:
+				return 0
+		
+		size = min(len(buffer), len(pending))
+		buffer[:size] = pending[:size]
+		self._pending = pending[size:]
+		
+		return size
@@ -0,0 +1,159 @@
+# encoding: utf-8
+
+"""Selection of the Content-Transfer-Encoding of each text part.
+
+Rather than quoted-printable encoding every body, as the charset registered for UTF-8 would have the email package do,
+each body is scanned once and given the cheapest encoding able to carry it:
+
+ * 7bit, the content as-is, for ASCII text with lines of reasonable length;
+ * 8bit, also as-is, for other such text, but only when delivering to a server advertising 8BITMIME; or
+ * quoted-printable or base64, whichever produces less output, for everything else.  For mostly non-ASCII text, such
+   as Cyrillic or CJK, base64 is typically the smaller of the two.
+"""
+
+from __future__ import unicode_literals
+
+import binascii
+import copy
+
+from email.charset import Charset
+from email.mime.nonmultipart import MIMENonMultipart
+from email.mime.text import MIMEText
+
+from marrow.mailer.attachment import _encode
+from marrow.util.compat import native, unicode
+
+
+__all__ = ['choose', 'encode_body', 'TextPart', 'eight_bit', 'seven_bit', 'international']
+
+
+LINE = 998  # The longest line permitted by RFC 5322, excluding the line ending.
+
+_bytes = lambda values: bytes(bytearray(values))
+
+_SEVEN = _bytes(i for i in range(1, 128) if i != 13)  # Octets 7bit content may contain; newlines are bare LF.
+_ASCII = _bytes(range(128))
+_HIGH = _bytes(range(128, 256))
+_LITERAL = _bytes([9, 10, 32] + [i for i in range(33, 127) if i != 61])  # Not escaped by quoted-printable.
+
+
+def _short(data):
+	"""Determine if every line of the given content fits within the line length limit."""
+	return len(data) <= LINE or max(len(line) for line in data.split(b'\n')) <= LINE
+
+
+def seven_bit(data):
+	"""Determine if the given byte string is entirely 7-bit."""
+	return not data.translate(None, _ASCII)
+
+
+def choose(data, eight=False):
+	"""Return the cheapest Content-Transfer-Encoding able to carry the given content, a byte string with LF newlines.
+
+	The 8bit encoding is only considered if eight is true.  The scan is performed by bytes.translate, without
+	examining the content a byte at a time in Python.
+	"""
+
+	unusual = data.translate(None, _SEVEN)  # Eight-bit octets, NUL, and bare CR.
+
+	if _short(data):
+		if not unusual:
+			return '7bit'
+
+		if eight and not unusual.translate(None, _HIGH):
+			return '8bit'
+
+	return _smaller(data)
+
+
+def _smaller(data):
+	"""Choose between quoted-printable and base64 by estimating their encoded sizes, including line breaks."""
+
+	escaped = len(data) + 2 * len(data.translate(None, _LITERAL))
+	qp = escaped + 2 * (escaped // 75)
+	base64 = (len(data) + 2) // 3 * 4
+	base64 += base64 // 76
+
+	return 'quoted-printable' if qp <= base64 else 'base64'
+
+
+def encode_body(text, charset):
+	"""Encode the given text as a body in the named output charset, returning (encoding, payload, raw).
+
+	The payload is the native string to use with the returned Content-Transfer-Encoding; raw is the encoded content to
+	write as 8bit instead when the server advertises 8BITMIME, or None if the content is not suitable for it.
+	"""
+
+	data = text.encode(charset) if not isinstance(text, bytes) else text
+
+	if b'\r' in data:
+		data = data.replace(b'\r\n', b'\n')
+
+	raw = None
+	encoding = choose(data, True)
+
+	if encoding == '8bit':
+		raw = data
+		encoding = _smaller(data)  # The encoding used when the server does not support 8BITMIME.
+
+	if encoding == '7bit':
+		payload = native(data)
+	elif encoding == 'base64':
+		payload = native(_encode(data))
+	else:
+		payload = native(binascii.b2a_qp(data, False, True))
+
+	return encoding, payload, raw
+
+
+class TextPart(MIMEText, object):
+	"""A text MIME part given the cheapest transfer encoding able to carry its content.
+
+	The part itself, as seen by the email package, is always 7-bit clean.  When the content could instead be sent as
+	8bit, its encoded form is retained as ``raw``, and incremental serialization for an 8BITMIME server writes that
+	rather than the quoted-printable or base64 payload.
+
+	A drop-in replacement for MIMEText, which would encode the content as the charset's registered body encoding.
+	"""
+
+	def __init__(self, text, subtype='plain', charset='utf-8'):
+		charset = Charset(charset).get_output_charset()
+		MIMENonMultipart.__init__(self, 'text', subtype, charset=charset)
+
+		encoding, payload, self.raw = encode_body(text, charset)
+
+		self.set_payload(payload)
+		self['Content-Transfer-Encoding'] = encoding
+
+	def eight_bit(self):
+		"""Return a copy of this part whose headers declare the 8bit encoding of the raw content."""
+
+		clone = copy.copy(self)
+		clone._headers = list(self._headers)
+		clone.replace_header('Content-Transfer-Encoding', '8bit')
+
+		return clone
+
+
+def eight_bit(document):
+	"""Determine if any part of the given document is to be written as 8bit when the server permits it."""
+
+	for part in document.walk():
+		if getattr(part, 'raw', None) is not None or part.get('Content-Transfer-Encoding', '').lower() == '8bit':
+			return True
+
+	return False
+
+
+def international(document):
+	"""Determine if any header of the given document contains non-ASCII text, requiring SMTPUTF8 to deliver as-is."""
+
+	for part in document.walk():
+		for value in part.values():
+			try:
+				unicode(value).encode('ascii')
+
+			except UnicodeError:
+				return True
+
+	return False
@@ -0,0 +1,394 @@
+# encoding: utf-8
+
+"""Deliver messages using (E)SMTP from an asyncio event loop.
+
+Requires Python 3.5 or later.  The transport API methods (startup, deliver, and shutdown) are coroutines; use this
+transport with the asyncio delivery manager.
+"""
+
+import asyncio
+import base64
+import socket
+import ssl
+
+from smtplib import (CRLF, SMTPException, SMTPRecipientsRefused, SMTPSenderRefused, SMTPServerDisconnected,
+                     SMTPDataError, SMTPAuthenticationError, SMTPResponseException, quoteaddr, quotedata)
+
+from marrow.mailer.exc import (TransportExhaustedException, TransportException, TransportFailedException,
+                               MessageFailedException)
+from marrow.mailer.transport.smtp import SMTPTransport, interrupted, quote_chunks
+
+
+__all__ = ['AsyncSMTPTransport']
+
+log = __import__('logging').getLogger(__name__)
+
+
+class AsyncSMTPTransport(SMTPTransport):
+    """An asynchronous (E)SMTP pipelining transport.
+
+    Accepts the same configuration as the blocking SMTP transport.  STARTTLS upgrades require Python 3.11 or later;
+    on older interpreters use ``tls = ssl`` for an implicitly secured connection.
+    """
+
+    __slots__ = ('reader', 'writer', 'features')
+
+    def __init__(self, config):
+        super(AsyncSMTPTransport, self).__init__(config)
+
+        self.reader = None
+        self.writer = None
+        self.features = {}
+
+    async def startup(self):
+        if not self.connected:
+            await self.connect_to_server()
+
+    async def shutdown(self):
+        if not self.connected:
+            return
+
+        log.debug("Closing SMTP connection")
+
+        try:
+            try:
+                await self.command('quit')
+
+            except (SMTPException, OSError, asyncio.TimeoutError): # pragma: no cover
+                pass
+
+        finally:
+            self.close()
+
+    def close(self):
+        """Drop the connection without saying goodbye."""
+
+        if self.writer is not None:
+            self.writer.close()
+
+        self.reader = self.writer = None
+        self.features = {}
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.transport.is_closing()
+
+    @property
+    def extensions(self):
+        return self.features
+
+    async def probe(self):
+        """Check that the connection is still usable by issuing a NOOP."""
+
+        if not self.connected:
+            return False
+
+        try:
+            code, reply = await self.command('noop')
+
+        except (SMTPException, OSError, asyncio.TimeoutError):
+            self.close()
+            return False
+
+        return code == 250
+
+    async def connect_to_server(self):
+        context = None
+
+        if self.tls == 'ssl' or self.tls in ('required', 'optional', True):
+            context = ssl.create_default_context()
+
+            if self.certfile:
+                context.load_cert_chain(self.certfile, self.keyfile)
+
+        log.info("Connecting to SMTP server %s:%s", self.host, self.port)
+
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(
+                self.host, self.port, ssl=context if self.tls == 'ssl' else None), self.timeout)
+
+        code, reply = await self.reply()
+
+        if code != 220:
+            self.close()
+            raise SMTPResponseException(code, reply)
+
+        await self.ehlo()
+
+        if self.tls in ('required', 'optional', True):
+            if 'starttls' in self.features and hasattr(self.writer, 'start_tls'):
+                code, reply = await self.command('STARTTLS')
+
+                if code != 220:
+                    self.close()
+                    raise SMTPResponseException(code, reply)
+
+                await self.writer.start_tls(context, server_hostname=self.host)
+                await self.ehlo()
+
+            elif self.tls == 'required':
+                self.close()
+                raise TransportException('TLS is required but not available on the server -- aborting')
+
+        if self.username and self.password:
+            log.info("Authenticating as %s", self.username)
+            await self.login(self.username, self.password)
+
+        self.sent = 0
+
+    async def ehlo(self):
+        hostname = self.local_hostname
+
+        if not hostname:
+            hostname = await asyncio.get_event_loop().run_in_executor(None, socket.getfqdn)
+
+        code, reply = await self.command('ehlo ' + hostname)
+
+        if code != 250:
+            code, reply = await self.command('helo ' + hostname)
+
+            if code != 250:
+                raise SMTPResponseException(code, reply)
+
+            self.features = {}
+            return
+
+        features = {}
+
+        for line in reply.decode('ascii', 'replace').split('\n')[1:]:
+            name, _, params = line.partition(' ')
+            features[name.lower()] = params.strip()
+
+        self.features = features
+
+    async def login(self, username, password):
+        mechanisms = self.features.get('auth', '').upper().split()
+
+        if 'PLAIN' in mechanisms or 'LOGIN' not in mechanisms:
+            token = base64.b64encode(('\0%s\0%s' % (username, password)).encode('utf-8')).decode('ascii')
+            code, reply = await self.command('AUTH PLAIN ' + token)
+
+        else:
+            code, reply = await self.command('AUTH LOGIN')
+
+            for value in (username, password):
+                if code != 334:
+                    break
+
+                code, reply = await self.command(base64.b64encode(value.encode('utf-8')).decode('ascii'))
+
+        if code != 235:
+            raise SMTPAuthenticationError(code, reply)
+
+    async def reply(self):
+        """Read a (possibly multi-line) reply, returning the code and text like smtplib.SMTP.getreply."""
+
+        lines = []
+
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+
+            if not line:
+                self.close()
+                raise SMTPServerDisconnected("Connection unexpectedly closed")
+
+            lines.append(line[4:].strip())
+
+            if line[3:4] != b'-':
+                break
+
+        try:
+            code = int(line[:3])
+
+        except ValueError:
+            code = -1
+
+        return code, b'\n'.join(lines)
+
+    async def command(self, command):
+        """Issue a single command and wait for its reply."""
+
+        self.writer.write((command + CRLF).encode('ascii'))
+        await self.writer.drain()
+
+        return await self.reply()
+
+    async def deliver(self, message):
+        if not self.connected:
+            await self.connect_to_server()
+
+        result = None
+
+        try:
+            result = await self.send_with_smtp(message)
+
+        finally:
+            if not self.pipeline or self.sent >= self.pipeline:
+                raise TransportExhaustedException(result=result)
+
+        return result
+
+    async def send_with_smtp(self, message):
+        try:
+            sender = str(message.envelope)
+            recipients = message.recipients.string_addresses
+            content, options = self.content(message)
+            limit = self.recipient_limit or len(recipients)
+            delivered = False
+            refused = {}
+
+            for i in range(0, len(recipients), limit):
+                chunk = recipients[i:i + limit]
+
+                try:
+                    refused.update(await self.sendmail(sender, chunk, content, options))
+                    delivered = True
+                    continue
+
+                except SMTPRecipientsRefused as e:
+                    refused.update(e.recipients)
+
+                    if self.connected:
+                        continue
+
+                    if not delivered:
+                        raise
+
+                    reason, reply = 'SMTPServerDisconnected', (421, b'Connection closed.')
+
+                except Exception as e:
+                    if not delivered:
+                        raise
+
+                    if not isinstance(e, SMTPResponseException):
+                        self.close()  # No longer in step with the server.
+
+                    reason, reply = e.__class__.__name__, interrupted(e)
+
+                remainder = [recipient for recipient in recipients[i:] if recipient not in refused]
+                log.warning("%s DEFERRED %d recipients %s", message.id, len(remainder), reason)
+                refused.update((recipient, reply) for recipient in remainder)
+                break
+
+            if len(refused) == len(recipients):
+                raise SMTPRecipientsRefused(refused)
+
+            self.sent += 1
+
+            for recipient in refused:
+                log.warning("%s REFUSED %s %s %s", message.id, recipient, *refused[recipient])
+
+            return refused
+
+        except SMTPSenderRefused as e:
+            log.error("%s REFUSED %s %s", message.id, e.__class__.__name__, e)
+            raise MessageFailedException(str(e))
+
+        except SMTPRecipientsRefused as e:
+            log.warning("%s REFUSED %s %s", message.id, e.__class__.__name__, e)
+            raise MessageFailedException(str(e))
+
+        except SMTPServerDisconnected:
+            log.warning("%s DEFERRED %s", message.id, "SMTPServerDisconnected")
+            self.close()
+            raise TransportFailedException()
+
+        except asyncio.CancelledError:  # An Exception before Python 3.8; not a failure of the transport.
+            self.close()
+            raise
+
+        except Exception as e:
+            # Whether, and when, to try again is the delivery manager's decision.
+            cls_name = e.__class__.__name__
+            log.debug("%s EXCEPTION %s", message.id, cls_name, exc_info=True)
+            log.exception("%s DEFERRED %s", message.id, cls_name)
+            self.close()
+            raise TransportFailedException()
+
+    async def sendmail(self, sender, recipients, content, options=()):
+        """Perform a mail transaction, returning a dictionary of refused recipients.
+
+        Mirrors SMTPTransport.sendmail: the envelope and DATA are pipelined when the server advertises support, and
+        content given as a callable returning byte strings is streamed.
+        """
+
+        streaming = callable(content)
+        options = list(options)
+
+        if not streaming:
+            content = quotedata(content)
+
+            if not content.endswith(CRLF):
+                content += CRLF
+
+            if 'size' in self.features:
+                options.insert(0, 'size=%d' % (len(content), ))
+
+        commands = ['mail FROM:%s%s' % (quoteaddr(sender), ''.join(' ' + option for option in options))]
+        commands.extend('rcpt TO:%s' % (quoteaddr(recipient), ) for recipient in recipients)
+        commands.append('data')
+
+        if self.pipelining and 'pipelining' in self.features:
+            self.writer.write((CRLF.join(commands) + CRLF).encode('ascii'))
+            await self.writer.drain()
+            replies = [await self.reply() for command in commands]
+
+        else:
+            replies = [await self.command(commands[0])]
+
+            if replies[0][0] == 250:
+                for command in commands[1:]:
+                    replies.append(await self.command(command))
+
+            else:
+                replies.extend([(503, b'Skipped')] * (len(commands) - 1))
+
+        mail, data = replies[0], replies[-1]
+        refused = dict((recipient, reply) for recipient, reply in zip(recipients, replies[1:-1]) if reply[0] not in (250, 251))
+
+        if data[0] == 354 and (mail[0] != 250 or len(refused) == len(recipients)):
+            data = await self.command('.')
+
+        if mail[0] != 250:
+            await self._abort(mail[0])
+            raise SMTPSenderRefused(mail[0], mail[1], sender)
+
+        closing = any(code == 421 for code, resp in refused.values())
+
+        if closing or len(refused) == len(recipients):
+            await self._abort(421 if closing else data[0])
+            raise SMTPRecipientsRefused(refused)
+
+        if data[0] != 354:
+            await self._abort(data[0])
+            raise SMTPDataError(*data)
+
+        try:
+            if streaming:
+                for chunk in quote_chunks(content()):
+                    self.writer.write(chunk)
+                    await self.writer.drain()
+
+                self.writer.write(('.' + CRLF).encode('ascii'))
+
+            else:
+                self.writer.write((content + '.' + CRLF).encode('ascii'))
+
+            await self.writer.drain()
+            code, resp = await self.reply()
+
+        except:
+            self.close()  # Mid-DATA; see SMTPTransport.sendmail.
+            raise
+
+        if code != 250:
+            await self._abort(code)
+            raise SMTPDataError(code, resp)
+
+        return refused
+
+    async def _abort(self, code):
+        if code == 421:
+            self.close()
+            return
+
+        await self.command('rset')
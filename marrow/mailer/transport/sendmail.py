@@ -1,8 +1,10 @@
 # encoding: utf-8
 
+import errno
+
 from subprocess import Popen, PIPE
 
-from marrow.mailer.exc import MessageFailedException
+from marrow.mailer.exc import MessageFailedException, TransportFailedException
 
 
 __all__ = ['SendmailTransport']
@@ -11,7 +13,7 @@ log = __import__('logging').getLogger(__name__)
 
 
 
-class SendmailTransport(object): # pragma: no cover
+class SendmailTransport(object):
     __slots__ = ('ephemeral', 'executable')
 
     def __init__(self, config):
@@ -31,8 +33,22 @@ class SendmailTransport(object): # pragma: no cover
             args.extend(['-f', message.sendmail_f])
 
         proc = Popen(args, shell=False, stdin=PIPE)
-        proc.communicate(bytes(message))
-        proc.stdin.close()
+
+        try:
+            try:
+                for chunk in message.stream():
+                    proc.stdin.write(chunk)
+
+            finally:
+                proc.stdin.close()
+
+        except (IOError, OSError) as e:  # BrokenPipeError on Python 3.
+            if e.errno != errno.EPIPE:
+                raise
+
+            # The command exited, or closed its input, before reading the whole message.
+            raise TransportFailedException("Status code %d; message not read in full." % (proc.wait(), ))
+
         if proc.wait() != 0:
             raise MessageFailedException("Status code %d." % (proc.returncode, ))
 
@@ -4,8 +4,10 @@
 
 import socket
 
-from smtplib import (SMTP, SMTP_SSL, SMTPException, SMTPRecipientsRefused,
-                     SMTPSenderRefused, SMTPServerDisconnected)
+from functools import partial
+from smtplib import (SMTP, SMTP_SSL, CRLF, SMTPException, SMTPRecipientsRefused,
+                     SMTPSenderRefused, SMTPServerDisconnected, SMTPDataError, SMTPResponseException,
+                     quoteaddr, quotedata)
 
 from marrow.util.convert import boolean
 from marrow.util.compat import native
@@ -17,10 +19,53 @@ from marrow.mailer.exc import (
 log = __import__('logging').getLogger(__name__)
 
 
+def quote_chunks(chunks):
+    """Prepare a stream of byte strings for transmission as SMTP DATA.
+
+    Line endings are converted to CRLF and lines beginning with a period are dot-stuffed, as smtplib.quotedata does
+    for complete strings, correctly handling lines split across chunks.  The output always ends with CRLF.
+    """
+
+    start = True  # The next byte begins a line.
+    carriage = False  # The previous chunk ended with a bare carriage return.
+
+    for chunk in chunks:
+        if carriage:
+            chunk = b'\r' + chunk
+
+        carriage = chunk.endswith(b'\r')
+
+        if carriage:
+            chunk = chunk[:-1]
+
+        if not chunk:
+            continue
+
+        chunk = chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+        if start and chunk.startswith(b'.'):
+            chunk = b'.' + chunk
+
+        start = chunk.endswith(b'\n')
+        yield chunk.replace(b'\n.', b'\n..').replace(b'\n', b'\r\n')
+
+    if carriage or not start:
+        yield b'\r\n'
+
+
+def interrupted(exception):
+    """The (code, reply) to report for recipients left undelivered by an interrupted transaction."""
+
+    if isinstance(exception, SMTPResponseException) and exception.smtp_code:
+        return exception.smtp_code, exception.smtp_error
+
+    return 451, b'Delivery interrupted.'
+
+
 class SMTPTransport(object):
     """An (E)SMTP pipelining transport."""
 
-    __slots__ = ('ephemeral', 'host', 'tls', 'certfile', 'keyfile', 'port', 'local_hostname', 'username', 'password', 'timeout', 'debug', 'pipeline', 'connection', 'sent')
+    __slots__ = ('ephemeral', 'host', 'tls', 'certfile', 'keyfile', 'port', 'local_hostname', 'username', 'password', 'timeout', 'debug', 'pipeline', 'pipelining', 'max_recipients', 'buffer', 'eightbit', 'connection', 'sent')
 
     def __init__(self, config):
         self.host = native(config.get('host', '127.0.0.1'))
@@ -42,6 +87,16 @@ class SMTPTransport(object):
         if self.pipeline not in (None, True, False):
             self.pipeline = int(self.pipeline)
 
+        # Batch MAIL, RCPT and DATA into a single round trip when the server advertises RFC 2920 support.
+        self.pipelining = boolean(config.get('pipelining', True))
+
+        # Recipients per transaction, zero for no limit; larger envelopes are split, sharing one rendering of the body.
+        self.max_recipients = int(config.get('max_recipients', 0))
+        self.buffer = int(config.get('buffer', 65536))  # Bytes of message content to send per write.
+
+        # Send text unencoded, as 8bit, to servers advertising 8BITMIME (RFC 6152).
+        self.eightbit = boolean(config.get('eightbit', True))
+
         self.connection = None
         self.sent = 0
 
@@ -66,6 +121,19 @@ class SMTPTransport(object):
             finally:
                 self.connection = None
 
+    def probe(self):
+        """Check that the connection is still usable by issuing a NOOP."""
+
+        if not self.connected:
+            return False
+
+        try:
+            return self.connection.noop()[0] == 250
+
+        except (SMTPException, socket.error):
+            self.connection = None
+            return False
+
     def connect_to_server(self):
         if self.tls == 'ssl': # pragma: no cover
             connection = SMTP_SSL(local_hostname=self.local_hostname, keyfile=self.keyfile,
@@ -97,26 +165,115 @@ class SMTPTransport(object):
     def connected(self):
         return getattr(self.connection, 'sock', None) is not None
 
+    @property
+    def extensions(self):
+        """The ESMTP extensions advertised by the server, mapped to their parameters."""
+
+        return getattr(self.connection, 'esmtp_features', {})
+
+    @property
+    def recipient_limit(self):
+        """The number of recipients permitted per transaction, honouring any RCPTMAX advertised via LIMITS.
+
+        Zero if neither the configuration nor the server impose a limit.
+        """
+
+        limit = self.max_recipients
+
+        for option in self.extensions.get('limits', '').split():
+            name, _, value = option.partition('=')
+
+            if name.upper() == 'RCPTMAX' and value.isdigit() and int(value):
+                limit = min(limit, int(value)) if limit else int(value)
+
+        return limit
+
+    def content(self, message):
+        """Return the streamed content of the message, tailored to the server, and the MAIL parameters it needs."""
+
+        extensions = self.extensions
+        eight, utf8 = self.eightbit and '8bitmime' in extensions, 'smtputf8' in extensions
+
+        return partial(message.stream, eight=eight, utf8=utf8), message.mail_options(eight, utf8)
+
     def deliver(self, message):
         if not self.connected:
             self.connect_to_server()
 
+        result = None
+
         try:
-            self.send_with_smtp(message)
+            result = self.send_with_smtp(message)
 
         finally:
             if not self.pipeline or self.sent >= self.pipeline:
-                raise TransportExhaustedException()
+                raise TransportExhaustedException(result=result)
+
+        return result
 
     def send_with_smtp(self, message):
+        """Deliver the message, returning a dictionary of refused recipients mapped to their (code, reply).
+
+        Envelopes larger than the recipient limit are split across several transactions on this connection, each
+        uploading the same DATA.  The message is streamed to the server as it is serialized rather than rendered
+        into memory as a whole.
+
+        Should a later transaction fail once an earlier one has been accepted, the recipients not yet delivered to
+        are returned as refused with the failing reply (a temporary 451 if there was none) rather than failing the
+        message, which would deliver it to the accepted recipients a second time when retried.
+        """
+
         try:
             sender = str(message.envelope)
             recipients = message.recipients.string_addresses
-            content = str(message)
+            content, options = self.content(message)
+            limit = self.recipient_limit or len(recipients)
+            delivered = False
+            refused = {}
+
+            for i in range(0, len(recipients), limit):
+                chunk = recipients[i:i + limit]
+
+                try:
+                    refused.update(self.sendmail(sender, chunk, content, options))
+                    delivered = True
+                    continue
+
+                except SMTPRecipientsRefused as e:
+                    refused.update(e.recipients)
+
+                    if self.connected:
+                        continue
+
+                    if not delivered:
+                        raise
+
+                    reason, reply = 'SMTPServerDisconnected', (421, b'Connection closed.')
+
+                except Exception as e:
+                    if not delivered:
+                        raise
+
+                    if not isinstance(e, SMTPResponseException):
+                        self.connection.close()  # No longer in step with the server.
+
+                    reason, reply = e.__class__.__name__, interrupted(e)
+
+                remainder = [recipient for recipient in recipients[i:] if recipient not in refused]
+                log.warning("%s DEFERRED %d recipients %s", message.id, len(remainder), reason)
+                refused.update((recipient, reply) for recipient in remainder)
+                break
+
+            if len(refused) == len(recipients):
+                raise SMTPRecipientsRefused(refused)
 
-            self.connection.sendmail(sender, recipients, content)
             self.sent += 1
 
+            for recipient in refused:
+                log.warning("%s REFUSED %s %s %s", message.id, recipient, *refused[recipient])
+
+            return refused
+
         except SMTPSenderRefused as e:
             # The envelope sender was refused.  This is bad.
             log.error("%s REFUSED %s %s", message.id, e.__class__.__name__, e)
@@ -128,21 +285,132 @@ class SMTPTransport(object):
             log.warning("%s REFUSED %s %s", message.id, e.__class__.__name__, e)
             raise MessageFailedException(str(e))
 
-        except SMTPServerDisconnected as e: # pragma: no cover
-            if message.retries >= 0:
-                log.warning("%s DEFERRED %s", message.id, "SMTPServerDisconnected")
-                message.retries -= 1
-
+        except SMTPServerDisconnected: # pragma: no cover
+            log.warning("%s DEFERRED %s", message.id, "SMTPServerDisconnected")
             raise TransportFailedException()
 
         except Exception as e: # pragma: no cover
+            # Whether, and when, to try again is the delivery manager's decision.
             cls_name = e.__class__.__name__
             log.debug("%s EXCEPTION %s", message.id, cls_name, exc_info=True)
+            log.exception("%s DEFERRED %s", message.id, cls_name)
+            raise TransportFailedException()
+
+    def sendmail(self, sender, recipients, content, options=()):
+        """Perform a mail transaction, returning a dictionary of refused recipients.
 
-            if message.retries >= 0:
-                log.exception("%s DEFERRED %s", message.id, cls_name)
-                message.retries -= 1
+        The content is either the complete message as a string or a callable returning an iterable of byte strings,
+        such as Message.stream; the latter is uploaded incrementally, without assembling the whole message.  Any
+        options, such as ``BODY=8BITMIME``, are given as parameters of the MAIL command.
+
+        When the server advertises PIPELINING (RFC 2920) the envelope commands and DATA are written as a single
+        batch and their replies read back together, costing two round trips regardless of the number of recipients.
+        Failures raise the same exceptions ``SMTP.sendmail`` would.
+        """
+
+        connection = self.connection
+        connection.ehlo_or_helo_if_needed()
+
+        streaming = callable(content)
+        pipelined = self.pipelining and connection.has_extn('pipelining')
+
+        if not pipelined and not streaming:
+            return connection.sendmail(sender, recipients, content, list(options))
+
+        options = list(options)
+
+        if not streaming:
+            content = quotedata(content)
+
+            if not content.endswith(CRLF):
+                content += CRLF
+
+            if connection.has_extn('size'):
+                options.insert(0, 'size=%d' % (len(content), ))
+
+        commands = ['mail FROM:%s%s' % (quoteaddr(sender), ''.join(' ' + option for option in options))]
+        commands.extend('rcpt TO:%s' % (quoteaddr(recipient), ) for recipient in recipients)
+        commands.append('data')
+
+        if pipelined:
+            connection.send(CRLF.join(commands) + CRLF)
+            replies = [connection.getreply() for command in commands]
+
+        else:
+            connection.send(commands[0] + CRLF)
+            replies = [connection.getreply()]
+
+            if replies[0][0] == 250:
+                for command in commands[1:]:
+                    connection.send(command + CRLF)
+                    replies.append(connection.getreply())
 
             else:
-                log.exception("%s REFUSED %s", message.id, cls_name)
-                raise TransportFailedException()
+                replies.extend([(503, b'Skipped')] * (len(commands) - 1))
+
+        mail, data = replies[0], replies[-1]
+        refused = dict((recipient, reply) for recipient, reply in zip(recipients, replies[1:-1]) if reply[0] not in (250, 251))
+
+        if data[0] == 354 and (mail[0] != 250 or len(refused) == len(recipients)):
+            # Some servers accept DATA even without a valid envelope; terminate the empty message to resynchronize.
+            connection.send('.' + CRLF)
+            data = connection.getreply()
+
+        if mail[0] != 250:
+            self._abort(mail[0])
+            raise SMTPSenderRefused(mail[0], mail[1], sender)
+
+        closing = any(code == 421 for code, resp in refused.values())
+
+        if closing or len(refused) == len(recipients):
+            self._abort(421 if closing else data[0])
+            raise SMTPRecipientsRefused(refused)
+
+        if data[0] != 354:
+            self._abort(data[0])
+            raise SMTPDataError(*data)
+
+        try:
+            if streaming:
+                buffered = []
+                length = 0
+
+                for chunk in quote_chunks(content()):
+                    buffered.append(chunk)
+                    length += len(chunk)
+
+                    if length >= self.buffer:
+                        connection.send(b''.join(buffered))
+                        buffered, length = [], 0
+
+                buffered.append(b'.' + CRLF.encode('ascii'))
+                connection.send(b''.join(buffered))
+
+            else:
+                connection.send(content + '.' + CRLF)
+
+            code, resp = connection.getreply()
+
+        except:
+            # The server is still reading the message; a QUIT would be taken as content, waiting on a reply forever.
+            connection.close()
+            raise
+
+        if code != 250:
+            self._abort(code)
+            raise SMTPDataError(code, resp)
+
+        return refused
+
+    def _abort(self, code):
+        """Reset the transaction after a failure, or drop the connection if the server is closing it."""
+
+        if code == 421:
+            self.connection.close()
+            return
+
+        try:
+            self.connection.rset()
+
+        except SMTPServerDisconnected: # pragma: no cover
+            pass
@@ -100,7 +100,11 @@ Code written in 2009 and donated to the public domain.
 
 import re
 
-__all__ = ['ValidationException', 'BaseValidator', 'DomainValidator', 'EmailValidator', 'EmailHarvester']
+from collections import OrderedDict
+from threading import Lock
+
+__all__ = ['ValidationException', 'BaseValidator', 'DomainValidator', 'EmailValidator', 'CachingEmailValidator',
+        'EmailHarvester']
 
 
 class ValidationException(ValueError):
@@ -259,12 +263,21 @@ class EmailValidator(DomainValidator):
     # TODO: Local part in quotes?
     # TODO: Quoted-printable local part?
 
+    # Compiled local part expressions, shared by every validator accepting the same characters.
+    _local_part_regexes = {}
+
     def __init__(self, local_part_chars=".-+_!#$%&'/=`|~?^{}*", **k):
         super(EmailValidator, self).__init__(**k)
         # Add a backslash before the dash so it can go into the regex:
         self.local_part_pattern = '[a-z0-9' + local_part_chars.replace('-', r'\-') + ']+'
         # Regular expression for validation:
-        self.local_part_regex = re.compile('^' + self.local_part_pattern + '$', re.IGNORECASE)
+        regex = self._local_part_regexes.get(self.local_part_pattern)
+
+        if regex is None:
+            regex = re.compile('^' + self.local_part_pattern + '$', re.IGNORECASE)
+            self._local_part_regexes[self.local_part_pattern] = regex
+
+        self.local_part_regex = regex
 
     def validate_local_part(self, part):
         part, err = self._apply_common_rules(part, maxlength=64)
@@ -302,6 +315,46 @@ class EmailValidator(DomainValidator):
     validate = validate_email
 
 
+class CachingEmailValidator(EmailValidator):
+    """An EmailValidator remembering the outcome of the most recent *size*
+    distinct validations, so repeated addresses are checked only once.
+
+    Instances are safe to share between threads.
+    """
+
+    def __init__(self, size=4096, **k):
+        super(CachingEmailValidator, self).__init__(**k)
+        self.size = size
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def validate_email(self, email):
+        cache = self._cache
+
+        with self._lock:
+            result = cache.pop(email, None)
+
+            if result is not None:
+                cache[email] = result  # Mark as most recently used.
+                return result
+
+        result = super(CachingEmailValidator, self).validate_email(email)
+
+        with self._lock:
+            cache[email] = result
+
+            if len(cache) > self.size:
+                cache.popitem(last=False)
+
+        return result
+
+    validate = validate_email
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
 class EmailHarvester(EmailValidator):
     def __init__(self, *a, **k):
         super(EmailHarvester, self).__init__(*a, **k)
@@ -83,12 +83,15 @@ setup(
 						'immediate = marrow.mailer.manager.immediate:ImmediateManager',
 						'futures = marrow.mailer.manager.futures:FuturesManager',
 						'dynamic = marrow.mailer.manager.dynamic:DynamicManager',
+						'asyncio = marrow.mailer.manager.aio:AsyncManager',
+						'spool = marrow.mailer.manager.spool:SpoolManager',
 						# 'transactional = marrow.mailer.manager.transactional:TransactionalDynamicManager'
 					],
 				'marrow.mailer.transport': [
 						'amazon = marrow.mailer.transport.ses:AmazonTransport',
 						'mock = marrow.mailer.transport.mock:MockTransport',
 						'smtp = marrow.mailer.transport.smtp:SMTPTransport',
+						'aiosmtp = marrow.mailer.transport.aiosmtp:AsyncSMTPTransport',
 						'mbox = marrow.mailer.transport.mbox:MailboxTransport',
 						'mailbox = marrow.mailer.transport.mbox:MailboxTransport',
 						'maildir = marrow.mailer.transport.maildir:MaildirTransport',
@@ -0,0 +1,12 @@
+# encoding: utf-8
+
+import sys
+
+
+collect_ignore = []
+
+if sys.version_info < (3, 5):  # pragma: no cover
+	collect_ignore.extend(['manager/test_aio.py', 'transport/test_aiosmtp.py'])
+
+if sys.version_info < (3, 6):  # pragma: no cover
+	collect_ignore.append('test_builder.py')
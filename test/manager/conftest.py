@@ -0,0 +1,90 @@
+# encoding: utf-8
+
+"""Fake transports shared by the delivery manager tests."""
+
+import threading
+import pytest
+
+from marrow.mailer.exc import TransportFailedException
+from marrow.mailer.manager.util import clock
+
+
+class Recorder(object):
+    """A transport factory recording the time and subject of each message delivered through it.
+
+    Deliveries of messages matching hold wait until the gate is set; entered is set as the first of them arrives, and
+    the greatest number waiting at once is kept as peak.  The first failures attempts raise TransportFailedException.
+    """
+
+    def __init__(self, hold=None, failures=0):
+        self.hold = hold
+        self.failures = failures
+        self.attempts = 0
+        self.active = 0
+        self.peak = 0
+        self.delivered = []
+        self.gate = threading.Event()
+        self.entered = threading.Event()
+        self.lock = threading.Lock()
+
+        if hold is None:
+            self.gate.set()
+
+    def __call__(self, config=None):
+        return RecordingTransport(self)
+
+    @property
+    def subjects(self):
+        return [subject for when, subject in self.delivered]
+
+    def deliver(self, message):
+        held = self.hold is not None and self.hold(message)
+
+        with self.lock:
+            self.attempts += 1
+
+            if self.attempts <= self.failures:
+                raise TransportFailedException()
+
+            self.active += held
+            self.peak = max(self.peak, self.active)
+
+        if held:
+            self.entered.set()
+            self.gate.wait(5)
+
+        with self.lock:
+            self.active -= held
+            self.delivered.append((clock(), message.subject))
+
+        return True
+
+
+class RecordingTransport(object):
+    def __init__(self, recorder):
+        self.ephemeral = False
+        self.recorder = recorder
+
+    def startup(self):
+        pass
+
+    def deliver(self, message):
+        return self.recorder.deliver(message)
+
+    def shutdown(self):
+        pass
+
+
+@pytest.fixture
+def recorder():
+    """Deliver every message immediately."""
+    return Recorder()
+
+
+@pytest.fixture
+def gated():
+    """Hold every message until the gate is set; it is set on teardown, so no delivery thread is left waiting."""
+
+    recorder = Recorder(lambda message: True)
+    yield recorder
+    recorder.gate.set()
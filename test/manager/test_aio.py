@@ -0,0 +1,158 @@
+# encoding: utf-8
+
+"""Test the asyncio delivery manager and Mailer.asend."""
+
+import asyncio
+import pytest
+
+from functools import partial
+
+from marrow.mailer import Mailer, Message
+from marrow.mailer.exc import MailerNotRunning, TransportFailedException, TransportExhaustedException, DeliveryFailedException, MessageFailedException
+from marrow.mailer.manager.aio import AsyncManager
+
+
+class MockTransport(object):
+    """An asynchronous transport recording activity; exceptions passed as messages are raised once."""
+
+    def __init__(self, log, config=None):
+        self.ephemeral = False
+        self.log = log
+
+    async def startup(self):
+        self.log.append('running')
+
+    async def deliver(self, message):
+        self.log.append(message)
+        await asyncio.sleep(0.01)
+
+        if isinstance(message, Exception) and self.log.count(message) < 2:
+            raise message
+
+        return True
+
+    async def shutdown(self):
+        self.log.append('stopped')
+
+
+class ProbedTransport(MockTransport):
+    healthy = True
+
+    async def probe(self):
+        self.log.append('probe')
+        return self.healthy
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class TestAsyncManager(object):
+    def setup_method(self, method):
+        self.log = []
+        self.manager = AsyncManager(dict(workers=10, retry_delay=0.01), partial(MockTransport, self.log))
+        self.manager.startup()
+
+    def test_success(self):
+        async def scenario():
+            return await self.manager.deliver("success")
+
+        assert run(scenario()) == ("success", True)
+        assert self.log == ['running', 'success']
+
+        self.manager.shutdown()
+        assert self.log == ['running', 'success', 'stopped']
+
+    def test_concurrency(self):
+        async def scenario():
+            return await asyncio.gather(*[self.manager.deliver(i) for i in range(50)])
+
+        results = run(scenario())
+
+        assert [message for message, result in results] == list(range(50))
+        assert self.log.count('running') == 10  # Capped by the number of workers.
+        assert len(self.manager.transports) == 10
+
+    def test_message_failure(self):
+        exc = MessageFailedException("Bad.")
+
+        with pytest.raises(DeliveryFailedException):
+            run(self.manager.deliver(exc))
+
+        assert self.log == ['running', exc]
+
+    def test_transport_failure(self):
+        exc = TransportFailedException()
+        exc.retries = 1
+
+        assert run(self.manager.deliver(exc)) == (exc, True)
+        assert self.log == ['running', exc, 'stopped', 'running', exc]
+        assert exc.retries == 0
+
+    def test_transport_failure_exhausts_retries(self):
+        exc = TransportFailedException()
+        exc.retries = 0
+
+        with pytest.raises(DeliveryFailedException):
+            run(self.manager.deliver(exc))
+
+        assert self.log == ['running', exc, 'stopped']
+
+    def test_transport_exhaustion(self):
+        exc = TransportExhaustedException()
+
+        run(self.manager.deliver(exc))
+        assert self.log == ['running', exc, 'stopped']
+        assert not self.manager.transports
+
+    def test_health_probe(self):
+        manager = AsyncManager(dict(pool_probe=True), partial(ProbedTransport, self.log))
+        manager.startup()
+
+        run(manager.deliver("first"))
+        manager.transports[0].healthy = False
+        run(manager.deliver("second"))
+
+        assert self.log == ['running', 'first', 'probe', 'stopped', 'running', 'second']
+
+    def test_shutdown_within_loop(self):
+        async def scenario():
+            await self.manager.deliver("success")
+            await self.manager.shutdown()
+
+        run(scenario())
+        assert self.log[-1] == 'stopped'
+
+
+class TestAsyncSend(object):
+    def message(self, mailer):
+        return mailer.new('from@example.com', 'to@example.com', "Subject.", plain="Body.")
+
+    def test_not_running(self):
+        mailer = Mailer(dict(transport=dict(use='mock')))
+
+        with pytest.raises(MailerNotRunning):
+            mailer.asend(Message())
+
+    def test_immediate(self):
+        mailer = Mailer(dict(transport=dict(use='mock'))).start()
+        message = self.message(mailer)
+
+        assert run(mailer.asend(message)) == (message, True)
+        mailer.stop()
+
+    def test_futures(self):
+        mailer = Mailer(dict(manager=dict(use='futures'), transport=dict(use='mock'))).start()
+        message = self.message(mailer)
+
+        assert run(mailer.asend(message)) == (message, True)
+        mailer.stop()
+
+    def test_asyncio(self):
+        log = []
+        mailer = Mailer(dict(manager=dict(use=AsyncManager), transport=dict(use=partial(MockTransport, log)))).start()
+        message = self.message(mailer)
+
+        assert run(mailer.asend(message)) == (message, True)
+        assert log == ['running', message]
+        mailer.stop()
@@ -0,0 +1,191 @@
+# encoding: utf-8
+
+"""Test the bounded work queue of the dynamic manager."""
+
+import threading
+import time
+import pytest
+
+from concurrent import futures
+
+from marrow.mailer import Message
+from marrow.mailer.exc import QueueFullException
+from marrow.mailer.manager.dynamic import DynamicManager, ScalingPoolExecutor, WorkQueue, WorkItem
+
+
+def item(value):
+    return WorkItem(None, None, (value, ), {})
+
+
+def message(i):
+    return Message('from@example.com', 'to@example.com', "Message %d." % i, plain="Hello.")
+
+
+class TestWorkQueue(object):
+    def test_unbounded(self):
+        jobs = WorkQueue()
+
+        for i in range(100):
+            jobs.put(item(i))
+
+        assert jobs.depth == 100
+
+    def test_raise(self):
+        jobs = WorkQueue(2, 'raise')
+        jobs.put(item(1))
+        jobs.put(item(2))
+
+        with pytest.raises(QueueFullException):
+            jobs.put(item(3))
+
+        assert jobs.rejected == 1
+        assert jobs.depth == 2
+
+    def test_block_times_out(self):
+        jobs = WorkQueue(1, 'block', 0.05)
+        jobs.put(item(1))
+
+        start = time.time()
+
+        with pytest.raises(QueueFullException):
+            jobs.put(item(2))
+
+        assert time.time() - start >= 0.05
+
+    def test_block_until_room(self):
+        jobs = WorkQueue(1, 'block')
+        jobs.put(item(1))
+
+        timer = threading.Timer(0.05, jobs.get)
+        timer.start()
+
+        jobs.put(item(2))  # Returns once the timer has made room.
+        timer.join()
+
+        assert jobs.get().args == (2, )
+
+    def test_admit(self):
+        jobs = WorkQueue(1, 'raise')
+        jobs.put(item(1))
+        jobs.put(item(2), False)
+
+        assert jobs.depth == 2
+
+    def test_spill_preserves_order(self, tmpdir):
+        jobs = WorkQueue(2, 'spill', path=str(tmpdir))
+
+        for i in range(10):
+            jobs.put(item(i))
+
+        assert jobs.qsize() == 2
+        assert jobs.depth == 10
+        assert jobs.spilled == 8
+
+        assert [jobs.get().args[0] for i in range(10)] == list(range(10))
+        assert jobs.depth == 0
+        jobs.close()
+
+    def test_wait_time(self):
+        jobs = WorkQueue()
+        jobs.put(item(1))
+        time.sleep(0.02)
+        jobs.get()
+
+        assert jobs.wait >= 0.02
+        assert jobs.average > 0
+
+    def test_unknown_policy(self):
+        with pytest.raises(ValueError):
+            WorkQueue(1, 'drop')
+
+
+class TestScalingPoolExecutor(object):
+    def test_requeue_ignores_capacity(self):
+        entered, gate = threading.Event(), threading.Event()
+        executor = ScalingPoolExecutor(1, 10, 1, 1, 'raise')
+
+        def occupy():
+            entered.set()
+            gate.wait(5)
+
+        executor.submit(occupy)
+        entered.wait(5)  # Taken by the only thread.
+        waiting = executor.submit(lambda: 1)
+
+        with pytest.raises(QueueFullException):
+            executor.submit(lambda: 2)
+
+        retried = executor.requeue(lambda: 3)
+        assert executor.depth == 2
+
+        gate.set()
+        assert waiting.result(5) == 1
+        assert retried.result(5) == 3
+
+        executor.shutdown()
+
+
+class TestDynamicManager(object):
+    def manager(self, transport, **config):
+        manager = DynamicManager(config, transport)
+        manager.startup()
+        return manager
+
+    def test_raise(self, gated):
+        manager = self.manager(gated, workers=1, capacity=2, overflow='raise')
+
+        first = manager.deliver(message(0))
+        gated.entered.wait(5)  # Taken by the only worker, which waits on the gate.
+
+        manager.deliver(message(1))
+        manager.deliver(message(2))
+
+        assert manager.depth == 2
+
+        with pytest.raises(QueueFullException):
+            manager.deliver(message(3))
+
+        gated.gate.set()
+        first.result(5)
+        manager.shutdown()
+
+        assert gated.subjects == ["Message 0.", "Message 1.", "Message 2."]
+
+    def test_accepted_work_ignores_capacity(self, gated):
+        manager = self.manager(gated, workers=1, capacity=1, overflow='raise')
+
+        first = manager.deliver(message(0))
+        gated.entered.wait(5)
+        manager.deliver(message(1))
+
+        parked = futures.Future()
+        manager._attempt(parked, message(2), 0, True)  # As the retry scheduler does once a rate limit allows.
+
+        assert manager.depth == 2
+
+        gated.gate.set()
+        first.result(5)
+        parked.result(5)
+        manager.shutdown()
+
+        assert len(gated.delivered) == 3
+
+    def test_spill(self, gated, tmpdir):
+        manager = self.manager(gated, workers=1, capacity=1, overflow='spill', spill_path=str(tmpdir))
+        results = [manager.deliver(message(i)) for i in range(5)]
+
+        assert manager.depth >= 3
+
+        gated.gate.set()
+
+        for result in results:
+            result.result(5)
+
+        manager.shutdown()
+
+        assert gated.subjects == ["Message %d." % i for i in range(5)]
+        assert manager.wait > 0
+
+    def test_unknown_policy(self):
+        with pytest.raises(ValueError):
+            DynamicManager(dict(overflow='drop'), None)
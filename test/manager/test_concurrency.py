@@ -0,0 +1,131 @@
+# encoding: utf-8
+
+"""Test the latency-driven concurrency limit of the dynamic manager."""
+
+import threading
+import time
+
+from marrow.mailer import Message
+from marrow.mailer.manager.dynamic import DynamicManager, ScalingPoolExecutor, _throttled
+from marrow.mailer.manager.util import Concurrency
+
+
+class TestConcurrency(object):
+    def test_defaults(self):
+        limit = Concurrency({}, 10)
+
+        assert int(limit) == 1
+        assert limit.minimum == 1
+        assert limit.maximum == 10
+
+    def test_additive_increase(self):
+        limit = Concurrency({}, 10)
+
+        for i in range(100):
+            limit(0.1)
+
+        assert int(limit) == 10  # Never beyond the maximum.
+
+    def test_increase_is_one_per_window(self):
+        limit = Concurrency(dict(concurrency_initial=4), 10)
+
+        for i in range(4):
+            limit(0.1)
+
+        assert 4.5 < limit.limit < 5  # Roughly one more after a window of four.
+
+    def test_congestion(self):
+        limit = Concurrency(dict(concurrency_initial=8), 10)
+
+        for i in range(8):
+            limit(0.1, True)
+
+        assert int(limit) == 4
+
+    def test_single_decrease_per_window(self):
+        limit = Concurrency(dict(concurrency_initial=8), 10)
+        limit.completed = 8
+
+        limit(0.1, True)
+        limit(0.1, True)
+        limit(0.1, True)
+
+        assert int(limit) == 4
+
+    def test_latency(self):
+        limit = Concurrency(dict(concurrency_initial=8), 10)
+
+        limit(0.1)
+        assert limit.baseline == 0.1
+
+        for i in range(20):
+            limit(1.0)
+
+        assert limit.latency > 0.2
+        assert int(limit) < 8
+
+    def test_minimum(self):
+        limit = Concurrency(dict(concurrency_minimum=2, concurrency_initial=2), 10)
+        limit.completed = 2
+        limit(0.1, True)
+
+        assert int(limit) == 2
+
+
+class TestThrottled(object):
+    def test_results(self):
+        assert not _throttled(None)
+        assert not _throttled({})
+        assert not _throttled({'a@example.com': (550, "No such user.")})
+        assert _throttled({'a@example.com': (550, "No such user."), 'b@example.com': (451, "Slow down.")})
+
+
+class TestScalingPoolExecutor(object):
+    def test_limited(self):
+        limit = Concurrency(dict(concurrency_initial=2), 10)
+        executor = ScalingPoolExecutor(10, 1, 1, concurrency=limit)
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def work():
+            with lock:
+                active.append(1)
+                peak.append(len(active))
+
+            time.sleep(0.01)
+
+            with lock:
+                active.pop()
+
+        results = [executor.submit(work) for i in range(20)]
+
+        for result in results:
+            result.result(5)
+
+        executor.shutdown()
+
+        assert max(peak) <= 2
+
+
+class TestDynamicManager(object):
+    def test_disabled_by_default(self):
+        assert DynamicManager({}, None).concurrency is None
+
+    def test_adaptive(self, recorder):
+        recorder.failures = 3
+        config = dict(workers=4, adaptive=True, concurrency_initial=4, retry_delay=0.01, retry_jitter=0)
+        manager = DynamicManager(config, recorder)
+        manager.startup()
+
+        results = [manager.deliver(Message('from@example.com', 'to@example.com', "Hi.", plain="Hello."))
+                for i in range(20)]
+
+        for result in results:
+            result.result(5)
+
+        manager.shutdown()
+
+        assert len(recorder.delivered) == 20
+        assert manager.concurrency.baseline is not None
+        assert manager.concurrency.limit <= 4
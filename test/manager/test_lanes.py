@@ -0,0 +1,160 @@
+# encoding: utf-8
+
+"""Test the weighted, starvation-protected delivery lanes of the background managers."""
+
+import time
+
+from marrow.mailer import Message
+from marrow.mailer.manager.dynamic import DynamicManager, WorkItem
+from marrow.mailer.manager.futures import FuturesManager
+from marrow.mailer.manager.util import LaneQueue, lane, weights
+
+
+class Prioritized(object):
+    def __init__(self, priority):
+        self.priority = priority
+
+
+def item(priority, name=None):
+    return WorkItem(None, None, (Prioritized(priority), name), {})
+
+
+def message(subject, priority):
+    return Message('from@example.com', 'to@example.com', subject, plain="Hi.", priority=priority)
+
+
+class TestLane(object):
+    def test_lanes(self):
+        assert lane(Prioritized(None)) == 'normal'
+        assert lane(Prioritized(5), "1") == 'high'
+        assert lane(Prioritized(1)) == 'high'
+        assert lane(Prioritized("2 (High)")) == 'high'
+        assert lane(Prioritized(3)) == 'normal'
+        assert lane(Prioritized("5 (Lowest)")) == 'low'
+        assert lane(Prioritized("urgent")) == 'high'
+        assert lane(Prioritized("Bulk")) == 'low'
+        assert lane(Prioritized("whenever")) == 'normal'
+        assert lane(None) == 'normal'
+
+    def test_weights(self):
+        assert weights(None) == {'high': 8, 'normal': 4, 'low': 1}
+        assert weights("high: 3, low: 1") == {'high': 3, 'low': 1}
+        assert weights({'normal': 2}) == {'normal': 2}
+
+
+class TestLaneQueue(object):
+    def test_high_overtakes(self):
+        jobs = LaneQueue()
+
+        for i in range(100):
+            jobs.put(item('bulk', i))
+
+        jobs.put(item(1, 'urgent'))
+
+        assert jobs.get().args[1] == 'urgent'
+        assert jobs.qsize() == 100
+
+    def test_weighted_fairness(self):
+        jobs = LaneQueue({'high': 3, 'low': 1})
+
+        for i in range(40):
+            jobs.put(item(1, 'high'))
+            jobs.put(item(5, 'low'))
+
+        taken = [jobs.get().args[1] for i in range(40)]
+
+        assert taken.count('high') == 30
+        assert taken.count('low') == 10
+        assert 'low' in taken[:4]  # Interleaved, not merely ordered.
+
+    def test_fifo_within_lane(self):
+        jobs = LaneQueue()
+
+        for i in range(10):
+            jobs.put(item(3, i))
+
+        assert [jobs.get().args[1] for i in range(10)] == list(range(10))
+
+    def test_unknown_lane(self):
+        jobs = LaneQueue({'high': 2, 'low': 1})
+        jobs.put(item(3, 'normal'))  # No normal lane configured; falls back to the lowest weighted.
+
+        assert jobs.lanes['low']
+
+    def test_starvation(self):
+        jobs = LaneQueue({'high': 1000, 'low': 1}, 0.05)
+        jobs.put(item(5, 'starved'))
+
+        for i in range(10):
+            jobs.put(item(1, i))
+
+        jobs.get()  # Normally, the first of the high priority items.
+        time.sleep(0.05)
+
+        assert jobs.get().args[1] == 'starved'
+
+    def test_sentinel_last(self):
+        jobs = LaneQueue()
+        jobs.put(item(5, 'low'))
+        jobs.put(None)
+        jobs.put(item(1, 'high'))
+
+        assert jobs.get().args[1] == 'high'
+        assert jobs.get().args[1] == 'low'
+        assert jobs.get() is None
+
+
+class TestManagers(object):
+    def deliver(self, gated, Manager, given=False, **config):
+        manager = Manager(dict(workers=1, **config), gated)
+        manager.startup()
+
+        if given:  # Passed alongside messages of no priority of their own.
+            send = lambda subject, priority: manager.deliver(message(subject, None), priority)
+        else:
+            send = lambda subject, priority: manager.deliver(message(subject, priority))
+
+        results = [send("Bulk.", "5")]
+        gated.entered.wait(5)  # Occupies the only worker.
+
+        results.extend(send("Bulk.", "5") for i in range(10))
+        results.append(send("Reset.", "1"))
+
+        gated.gate.set()
+
+        for result in results:
+            result.result(5)
+
+        manager.shutdown()
+
+        return gated.subjects
+
+    def test_futures(self, gated):
+        delivered = self.deliver(gated, FuturesManager)
+
+        assert len(delivered) == 12
+        assert delivered.index("Reset.") == 1
+
+    def test_futures_given_priority(self, gated):
+        delivered = self.deliver(gated, FuturesManager, True)
+
+        assert len(delivered) == 12
+        assert delivered.index("Reset.") == 1
+
+    def test_dynamic(self, gated):
+        delivered = self.deliver(gated, DynamicManager)
+
+        assert len(delivered) == 12
+        assert delivered.index("Reset.") == 1
+
+    def test_dynamic_given_priority(self, gated):
+        delivered = self.deliver(gated, DynamicManager, True, adaptive=True)
+
+        assert len(delivered) == 12
+        assert delivered.index("Reset.") == 1
+
+    def test_dynamic_spilled(self, gated, tmpdir):
+        delivered = self.deliver(gated, DynamicManager, capacity=2, overflow='spill', spill_path=str(tmpdir))
+
+        assert len(delivered) == 12
+        assert delivered.index("Reset.") <= 3
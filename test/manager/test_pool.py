@@ -0,0 +1,247 @@
+# encoding: utf-8
+
+"""Test the bounded, self-pruning transport pool."""
+
+import threading
+import time
+import pytest
+
+from functools import partial
+
+from marrow.mailer.exc import TransportPoolTimeoutException
+from marrow.mailer.manager.util import TransportPool
+
+
+class MockTransport(object):
+    def __init__(self, log, config=None):
+        self.ephemeral = False
+        self.healthy = True
+        self.log = log
+        self.running = False
+
+    def startup(self):
+        self.running = True
+        self.log.append(('start', self))
+
+    def probe(self):
+        return self.healthy
+
+    def shutdown(self):
+        self.running = False
+        self.log.append(('stop', self))
+
+
+class TestTransportPool(object):
+    def pool(self, **config):
+        self.log = []
+        pool = TransportPool(partial(MockTransport, self.log), config)
+        pool.startup()
+        return pool
+
+    def test_lifo_reuse(self):
+        pool = self.pool()
+
+        with pool() as first:
+            with pool() as second:
+                assert first is not second
+
+        with pool() as transport:
+            assert transport is first  # The most recently released.
+
+        assert pool.count == 2
+        pool.shutdown()
+
+        assert pool.count == 0
+        assert not first.running and not second.running
+
+    def test_bounded_size_blocks(self):
+        pool = self.pool(pool_size=1)
+        acquired = []
+
+        def borrow():
+            with pool() as transport:
+                acquired.append(transport)
+
+        with pool() as transport:
+            thread = threading.Thread(target=borrow)
+            thread.start()
+            time.sleep(0.05)
+            assert not acquired  # Waiting for the only transport.
+
+        thread.join(1)
+        assert acquired == [transport]
+        assert pool.count == 1
+
+    def test_acquire_timeout(self):
+        pool = self.pool(pool_size=1, pool_timeout=0.05)
+
+        with pool():
+            with pytest.raises(TransportPoolTimeoutException):
+                with pool():
+                    pass
+
+        with pool():  # Capacity is restored once released.
+            pass
+
+    def test_idle_eviction(self):
+        pool = self.pool(pool_idle=0.05)
+
+        with pool() as first:
+            pass
+
+        time.sleep(0.1)
+
+        with pool() as second:
+            assert second is not first
+
+        assert not first.running
+        assert pool.count == 1
+
+    def test_age_eviction(self):
+        pool = self.pool(pool_age=0.05)
+
+        with pool() as first:
+            time.sleep(0.1)
+
+        assert not first.running  # Retired on release.
+        assert pool.count == 0
+
+    def test_health_probe(self):
+        pool = self.pool(pool_probe=True)
+
+        with pool() as first:
+            first.healthy = False
+
+        with pool() as second:
+            assert second is not first
+
+        assert not first.running
+
+    def test_failure_frees_capacity(self):
+        pool = self.pool(pool_size=1, pool_timeout=0.05)
+
+        with pytest.raises(ValueError):
+            with pool() as transport:
+                raise ValueError()
+
+        assert not transport.running
+        assert pool.count == 0
+
+        with pool() as transport:
+            transport.ephemeral = True
+
+        assert not transport.running
+        assert pool.count == 0
+
+    def test_release_after_shutdown(self):
+        pool = self.pool()
+
+        with pool() as transport:
+            pool.shutdown()
+
+        assert not transport.running
+        assert pool.count == 0
+
+
+class SlowTransport(MockTransport):
+    def startup(self):
+        time.sleep(0.1)
+        super(SlowTransport, self).startup()
+
+
+class TestPrewarm(object):
+    def pool(self, Transport=MockTransport, **config):
+        self.log = []
+        return TransportPool(partial(Transport, self.log), config)
+
+    def test_parallel_startup(self):
+        pool = self.pool(SlowTransport, pool_prewarm=5)
+
+        start = time.time()
+        pool.startup(True)
+
+        assert time.time() - start < 0.3  # Opened concurrently, not one after another.
+        assert len(pool.transports) == pool.count == 5
+
+        started = [transport for action, transport in self.log]
+
+        with pool() as transport:
+            assert transport in started
+            assert len(self.log) == 5
+
+        pool.shutdown()
+
+    def test_startup_does_not_wait(self):
+        pool = self.pool(SlowTransport, pool_prewarm=2)
+
+        start = time.time()
+        pool.startup()
+
+        assert time.time() - start < 0.1
+        assert pool.count == pool.warming == 2
+
+        pool.shutdown()
+
+    def test_floor_restored(self):
+        pool = self.pool(pool_prewarm=2)
+        pool.startup(True)
+
+        with pool() as transport:
+            transport.ephemeral = True
+
+        for i in range(100):
+            if len(pool.transports) == 2:
+                break
+
+            time.sleep(0.01)
+
+        assert len(pool.transports) == pool.count == 2
+        assert transport not in [entry[0] for entry in pool.transports]
+
+        pool.shutdown()
+        assert pool.count == 0
+
+    def test_floor_counts_idle_only(self):
+        pool = self.pool(pool_prewarm=2)
+        pool.startup(True)
+
+        with pool():
+            for i in range(100):
+                if not pool.warming:
+                    break
+
+                time.sleep(0.01)
+
+            assert len(pool.transports) == 2
+            assert pool.count == 3
+
+        pool.shutdown()
+
+    def test_limited_by_size(self):
+        pool = self.pool(pool_prewarm=5, pool_size=2)
+        pool.startup(True)
+
+        assert pool.count == 2
+        pool.shutdown()
+
+    def test_startup_failure(self):
+        class Unreachable(MockTransport):
+            def startup(self):
+                self.log.append(('start', self))
+                raise IOError()
+
+        pool = self.pool(Unreachable, pool_prewarm=2)
+        pool.startup(True)
+
+        assert pool.count == 0
+        assert len(self.log) == 2
+
+        for i in range(10):
+            with pytest.raises(IOError):
+                with pool():
+                    pass
+
+        time.sleep(0.05)
+
+        assert len(self.log) == 12  # Backing off; no pre-warming attempted alongside each failed acquisition.
+        assert pool.count == pool.warming == 0
@@ -0,0 +1,252 @@
+# encoding: utf-8
+
+"""Test rate limiting by recipient domain, by transport, and overall."""
+
+import time
+import pytest
+
+from concurrent import futures
+
+from marrow.mailer import Message
+from marrow.mailer.exc import DeliveryFailedException, QueueFullException, RateLimitedException
+from marrow.mailer.manager.futures import FuturesManager, worker
+from marrow.mailer.manager.dynamic import DynamicManager
+from marrow.mailer.manager.immediate import ImmediateManager
+from marrow.mailer.manager.util import RateLimiter, TokenBucket, TransportPool, clock
+
+
+def message(to, subject="Hello."):
+    return Message('from@example.com', to, subject, plain="Hi.")
+
+
+class TestTokenBucket(object):
+    def test_burst(self):
+        bucket = TokenBucket(10, 2)
+        now = clock()
+
+        assert bucket.wait(now) == 0
+        bucket.take()
+        assert bucket.wait(now) == 0
+        bucket.take()
+        assert bucket.wait(now) == pytest.approx(0.1, abs=0.01)
+
+    def test_refill(self):
+        bucket = TokenBucket(10, 1)
+        now = clock()
+
+        bucket.take()
+        assert bucket.wait(now + 0.1) == 0
+
+    def test_debt(self):
+        bucket = TokenBucket(10, 1)
+        now = clock()
+
+        for i in range(4):
+            bucket.take()
+
+        assert bucket.wait(now) == pytest.approx(0.4, abs=0.01)
+
+
+class TestRateLimiter(object):
+    def test_unconfigured(self):
+        limiter = RateLimiter({})
+
+        assert not limiter.configured
+        assert limiter.reserve(message('to@example.com')) == 0
+        assert limiter.acquire(object()) == 0
+
+    def test_domains(self):
+        limiter = RateLimiter(dict(rate_domain=10, rate_domains="slow.example.com: 1"))
+
+        assert limiter.reserve(message('a@slow.example.com')) == 0
+        assert limiter.reserve(message('b@SLOW.example.com')) == pytest.approx(1, abs=0.01)
+        assert limiter.reserve(message('a@fast.example.com')) == 0  # Another domain is unaffected.
+
+    def test_every_domain(self):
+        limiter = RateLimiter(dict(rate_domain=1))
+        limiter.reserve(message('a@two.example.com'))
+
+        assert limiter.reserve(message(['a@one.example.com', 'b@two.example.com'])) == pytest.approx(1, abs=0.01)
+
+    def test_reservations_spread(self):
+        limiter = RateLimiter(dict(rate=10, rate_burst=0))
+        delays = [limiter.reserve(message('to@example.com')) for i in range(5)]
+
+        assert delays[0] == 0
+        assert delays[1:] == pytest.approx([0.1, 0.2, 0.3, 0.4], abs=0.01)
+
+    def test_transport(self):
+        limiter = RateLimiter(dict(rate_transport=10, rate_burst=0))
+        first, second = object(), object()
+
+        assert limiter.acquire(first) == 0
+        assert limiter.acquire(first) > 0
+        assert limiter.acquire(second) == 0
+
+    def test_forget(self):
+        limiter = RateLimiter(dict(rate_transport=10, rate_burst=0))
+        transport = object()
+
+        assert limiter.acquire(transport) == 0
+        limiter.forget(transport)
+
+        assert not limiter.buckets
+        assert limiter.acquire(transport) == 0
+
+    def test_forgotten_once_shut_down(self, recorder):
+        limiter = RateLimiter(dict(rate_transport=10))
+        pool = TransportPool(recorder, None, limiter.forget)
+        pool.startup()
+
+        with pool() as transport:
+            limiter.acquire(transport)
+            transport.ephemeral = True
+
+        assert not limiter.buckets
+
+        with pool() as transport:
+            limiter.acquire(transport)
+
+        pool.shutdown()
+
+        assert not limiter.buckets
+
+    def test_prune(self, monkeypatch):
+        monkeypatch.setattr(RateLimiter, 'limit', 10)
+        limiter = RateLimiter(dict(rate_domain=1000))
+
+        for i in range(10):
+            limiter.reserve(message('to@%d.example.com' % i))
+
+        time.sleep(0.01)
+        limiter.reserve(message('to@new.example.com'))
+
+        assert len(limiter.buckets) == 1
+
+
+class TestWorker(object):
+    def test_transport_limited(self, recorder):
+        pool = TransportPool(recorder)
+        pool.startup()
+        limiter = RateLimiter(dict(rate_transport=1))
+
+        worker(pool, message('to@example.com'), limiter)
+
+        with pytest.raises(RateLimitedException) as exc:
+            worker(pool, message('to@example.com'), limiter)
+
+        assert exc.value.delay > 0
+        assert len(recorder.delivered) == 1
+        assert pool.count == 1  # The transport was returned to the pool, not discarded.
+
+        pool.shutdown()
+
+
+class TestManagers(object):
+    def test_immediate(self, recorder):
+        manager = ImmediateManager(dict(rate=20, rate_burst=0), recorder)
+        manager.startup()
+
+        for i in range(3):
+            manager.deliver(message('to@example.com'))
+
+        manager.shutdown()
+
+        assert recorder.delivered[-1][0] - recorder.delivered[0][0] >= 0.09
+
+    @pytest.mark.parametrize('Manager', [FuturesManager, DynamicManager])
+    def test_throttled_domain_does_not_stall_others(self, Manager, recorder):
+        manager = Manager(dict(workers=1, rate_domains="slow.example.com: 5", rate_burst=0), recorder)
+        manager.startup()
+
+        start = clock()
+        results = [manager.deliver(message('to@slow.example.com', "Slow.")) for i in range(4)]
+        results.extend(manager.deliver(message('to@fast.example.com', "Fast.")) for i in range(4))
+
+        for result in results:
+            result.result(5)
+
+        manager.shutdown()
+
+        fast = [when for when, subject in recorder.delivered if subject == "Fast."]
+        slow = [when for when, subject in recorder.delivered if subject == "Slow."]
+
+        assert len(recorder.delivered) == 8
+        assert max(fast) - start < 0.2  # Not held up behind the throttled domain, despite a single worker.
+        assert slow[-1] - slow[0] >= 0.55  # Three intervals of 0.2 seconds, give or take.
+
+    def test_transport_limited_is_retried_without_using_retries(self, recorder):
+        manager = FuturesManager(dict(workers=2, rate_transport=10, rate_burst=0), recorder)
+        manager.startup()
+
+        messages = [message('to@example.com') for i in range(3)]
+
+        for item in messages:
+            item.retries = 0
+
+        for result in [manager.deliver(item) for item in messages]:
+            result.result(5)
+
+        manager.shutdown()
+
+        assert len(recorder.delivered) == 3
+
+    @pytest.mark.parametrize('Manager', [FuturesManager, DynamicManager])
+    def test_shutdown_fails_parked(self, Manager, recorder):
+        manager = Manager(dict(workers=1, rate_domain=1, rate_burst=0), recorder)
+        manager.startup()
+
+        results = [manager.deliver(message('to@example.com')) for i in range(3)]
+        results[0].result(5)
+
+        start = clock()
+        manager.shutdown()  # Neither delivers the parked messages early nor waits for them to fall due.
+
+        assert clock() - start < 0.5
+        assert len(recorder.delivered) == 1
+
+        for result in results[1:]:
+            with pytest.raises(DeliveryFailedException):
+                result.result(0)
+
+    def test_parked_work_is_requeued_when_full(self, gated):
+        manager = DynamicManager(dict(workers=1, capacity=1, overflow='raise', rate_domain=10, rate_burst=0), gated)
+        manager.startup()
+
+        results = [manager.deliver(message('to@example.com')) for i in range(3)]  # One runs, two are parked.
+        gated.entered.wait(5)
+        results.append(manager.deliver(message('to@other.example.com')))  # Fills the queue.
+
+        with pytest.raises(QueueFullException):
+            manager.deliver(message('to@third.example.com'))
+
+        deadline = clock() + 5
+
+        while manager.depth < 3 and clock() < deadline:  # The parked messages falling due are requeued.
+            time.sleep(0.01)
+
+        assert manager.depth == 3
+        gated.gate.set()
+
+        for result in results:
+            result.result(5)
+
+        manager.shutdown()
+
+        assert len(gated.delivered) == 4
+
+    def test_dispatch_failure_resolves(self, recorder, monkeypatch):
+        def fail(self, fn, message, admit, priority=None):
+            raise ValueError("Unable to queue.")
+
+        monkeypatch.setattr(FuturesManager, '_dispatch', fail)
+        manager = FuturesManager(dict(workers=1, rate_domain=10), recorder)
+        manager.startup()
+
+        future = futures.Future()
+        manager._attempt(future, message('to@example.com'), 0, True)  # As once a parked message falls due.
+
+        with pytest.raises(DeliveryFailedException):
+            future.result(0)
+
+        manager.shutdown()
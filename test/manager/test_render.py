@@ -0,0 +1,132 @@
+# encoding: utf-8
+
+"""Test rendering messages in a process pool ahead of delivery."""
+
+import os
+
+from functools import partial
+
+from marrow.mailer import Message
+from marrow.mailer.manager.futures import FuturesManager, render
+from marrow.mailer.manager.dynamic import DynamicManager
+
+
+class RecordingTransport(object):
+    """Record the serialized form of each message delivered."""
+
+    def __init__(self, delivered, config=None):
+        self.ephemeral = False
+        self.delivered = delivered
+
+    def startup(self):
+        pass
+
+    def deliver(self, message):
+        self.delivered.append((message, bytes(message), b''.join(message.stream(100))))
+        return True
+
+    def shutdown(self):
+        pass
+
+
+def message(i=0):
+    message = Message('from@example.com', 'to%d@example.com' % i, "Subject.", plain="Body ✓ %d." % i)
+    message.attach('data.bin', b'\0' * 1000)
+    return message
+
+
+class TestAdoptedRendering(object):
+    def test_used_until_changed(self):
+        original = message()
+        copy = message()
+        copy._adopt(bytes(original))
+
+        assert bytes(copy) == bytes(original)
+        assert b''.join(copy.stream(7)) == bytes(original)
+
+        copy.subject = "Changed."
+
+        assert b'Subject: Changed.' in bytes(copy)
+        assert b''.join(copy.stream()) == bytes(copy)
+
+    def test_released(self):
+        instance = message()
+        instance._adopt(b'Adopted.')
+        instance._adopt(None)
+
+        assert instance._adopted() is None
+        assert b'Subject: Subject.' in bytes(instance)
+
+    def test_stale_parts_discarded(self):
+        instance = message()
+        instance.mime
+        instance.plain = "Changed body."
+        instance._adopt(render(instance))
+        instance.subject = "Changed."  # Invalidates the adopted rendering; everything is built again.
+
+        assert b'Changed body.' in bytes(instance)
+        assert b'Subject: Changed.' in bytes(instance)
+
+    def test_stale_document_discarded(self):
+        instance = message()
+        instance.mime
+        instance.subject = "Changed."
+        instance._adopt(render(instance))
+
+        assert 'Subject: Changed.' in instance.mime.as_string()
+
+
+class TestRenderPool(object):
+    def deliver(self, Manager, count):
+        delivered = []
+        manager = Manager(dict(workers=2, render=2), partial(RecordingTransport, delivered))
+        manager.startup()
+
+        try:
+            messages = [message(i) for i in range(count)]
+            results = [manager.deliver(i).result(10) for i in messages]
+
+        finally:
+            manager.shutdown()
+
+        return messages, results, delivered
+
+    def test_futures(self):
+        messages, results, delivered = self.deliver(FuturesManager, 5)
+
+        assert [result for result in results] == [(i, True) for i in messages]
+        assert len(delivered) == 5
+
+        for instance, data, streamed in delivered:
+            assert instance._adopted() is None  # Released once delivered.
+            assert data == streamed
+            assert instance.id.encode('ascii') in data
+            assert instance.to[0].address.encode('ascii') in data
+
+    def test_dynamic(self):
+        messages, results, delivered = self.deliver(DynamicManager, 3)
+
+        assert len(delivered) == 3
+        assert all(data == streamed for instance, data, streamed in delivered)
+
+    def test_not_forked(self):
+        renderer = FuturesManager(dict(render=1), None)._renderer()
+
+        assert renderer._mp_context.get_start_method() != 'fork'
+        renderer.shutdown()
+
+    def test_failed_render_falls_back(self):
+        delivered = []
+        manager = FuturesManager(dict(render=1), partial(RecordingTransport, delivered))
+        manager.startup()
+
+        try:
+            instance = message()
+            instance.plain = lambda: "Dynamic %d." % os.getpid()  # Closures can not be pickled.
+            assert manager.deliver(instance).result(10) == (instance, True)
+
+        finally:
+            manager.shutdown()
+
+        assert instance._adopted() is None
+        assert ('Dynamic %d.' % os.getpid()).encode('ascii') in delivered[0][1]
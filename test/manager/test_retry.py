@@ -0,0 +1,235 @@
+# encoding: utf-8
+
+"""Test delayed retries of deliveries whose transport has failed."""
+
+import logging
+import threading
+import time
+import pytest
+
+from functools import partial
+
+from marrow.mailer import Message
+from marrow.mailer.exc import TransportFailedException, DeliveryFailedException
+from marrow.mailer.manager.util import Backoff, RetryScheduler
+from marrow.mailer.manager.futures import FuturesManager
+from marrow.mailer.manager.dynamic import DynamicManager
+from marrow.mailer.manager.immediate import ImmediateManager
+
+
+class FlakyTransport(object):
+    """Fail the first `failures` delivery attempts, recording the time of each."""
+
+    def __init__(self, attempts, failures, config=None):
+        self.ephemeral = False
+        self.attempts = attempts
+        self.failures = failures
+
+    def startup(self):
+        pass
+
+    def deliver(self, message):
+        self.attempts.append(time.time())
+
+        if len(self.attempts) <= self.failures:
+            raise TransportFailedException()
+
+        return True
+
+    def shutdown(self):
+        pass
+
+
+def until(condition, timeout=5):
+    deadline = time.time() + timeout
+
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+    return condition()
+
+
+def message(retries=3):
+    message = Message('from@example.com', 'to@example.com', "Subject.", plain="Body.")
+    message.retries = retries
+    return message
+
+
+class TestBackoff(object):
+    def test_growth_and_bound(self):
+        backoff = Backoff(dict(retry_delay=1, retry_factor=2, retry_maximum=5, retry_jitter=0))
+
+        assert [backoff(i) for i in range(5)] == [1, 2, 4, 5, 5]
+
+    def test_jitter(self):
+        backoff = Backoff(dict(retry_delay=10, retry_jitter=0.5))
+        delays = [backoff(0) for i in range(100)]
+
+        assert all(5 <= delay <= 10 for delay in delays)
+        assert len(set(delays)) > 1
+
+
+class TestRetryScheduler(object):
+    def setup_method(self, method):
+        self.scheduler = RetryScheduler()
+        self.scheduler.startup()
+
+    def teardown_method(self, method):
+        self.scheduler.shutdown(False)
+
+    def test_due_order(self):
+        called = []
+        done = threading.Event()
+
+        self.scheduler.schedule(0.03, called.append, 'late')
+        self.scheduler.schedule(0.01, called.append, 'early')
+        self.scheduler.schedule(0.05, done.set)
+
+        assert done.wait(1)
+        assert called == ['early', 'late']
+        assert not len(self.scheduler)
+
+    def test_flush_on_shutdown(self):
+        called = []
+
+        self.scheduler.schedule(60, called.append, 'pending')
+        self.scheduler.shutdown()
+
+        assert called == ['pending']
+        assert not self.scheduler.schedule(0, called.append, 'refused')
+
+    def test_discard_on_shutdown(self):
+        called = []
+
+        self.scheduler.schedule(60, called.append, 'pending')
+        self.scheduler.shutdown(False)
+
+        assert called == []
+
+    def test_abandon_on_shutdown(self):
+        called, abandoned = [], []
+        scheduler = RetryScheduler(abandoned.append)
+        scheduler.startup()
+
+        scheduler.schedule(60, called.append, 'pending')
+        scheduler.shutdown(False)
+
+        assert called == []
+        assert abandoned == ['pending']
+
+    def test_deferred_abandoned_on_flush(self):
+        called, abandoned = [], []
+        scheduler = RetryScheduler(abandoned.append)
+        scheduler.startup()
+
+        scheduler.defer(60, called.append, 'deferred')
+        scheduler.schedule(60, called.append, 'retry')
+        scheduler.shutdown()
+
+        assert called == ['retry']
+        assert abandoned == ['deferred']
+
+
+class TestFuturesRetry(object):
+    Manager = FuturesManager
+
+    def manager(self, failures, **config):
+        self.attempts = []
+        config.setdefault('retry_delay', 0.02)
+        config.setdefault('retry_jitter', 0)
+        manager = self.Manager(config, partial(FlakyTransport, self.attempts, failures))
+        manager.startup()
+        return manager
+
+    def test_backoff_between_attempts(self):
+        manager = self.manager(2)
+        msg = message()
+
+        assert manager.deliver(msg).result(2) == (msg, True)
+        manager.shutdown()
+
+        assert len(self.attempts) == 3
+        assert msg.retries == 1
+        assert self.attempts[1] - self.attempts[0] >= 0.015
+        assert self.attempts[2] - self.attempts[1] >= 0.035
+
+    def test_worker_released_while_waiting(self):
+        manager = self.manager(1, retry_delay=0.2)
+
+        first = manager.deliver(message())
+        second = manager.deliver(message())
+
+        assert second.result(0.15)[1] is True  # Delivered while the first message awaits its retry.
+        assert not first.done()
+        assert first.result(1)[1] is True
+
+        manager.shutdown()
+
+    def test_retries_exhausted(self):
+        manager = self.manager(10)
+
+        with pytest.raises(DeliveryFailedException):
+            manager.deliver(message(2)).result(2)
+
+        manager.shutdown()
+        assert len(self.attempts) == 3
+
+    def test_cancel_pending_retry(self):
+        manager = self.manager(1, retry_delay=0.1)
+        future = manager.deliver(message())
+
+        time.sleep(0.05)
+        assert future.cancel()
+
+        manager.shutdown()
+        assert len(self.attempts) == 1
+
+    def test_shutdown_attempts_pending_retry(self):
+        manager = self.manager(1, retry_delay=60)
+        future = manager.deliver(message())
+
+        time.sleep(0.05)
+        manager.shutdown()
+
+        assert future.result(0)[1] is True
+        assert len(self.attempts) == 2
+
+    def test_shutdown_without_waiting_fails_pending_retry(self):
+        manager = self.manager(1, retry_delay=5)
+        future = manager.deliver(message())
+
+        assert until(lambda: len(manager.scheduler))
+        manager.shutdown(False)
+
+        with pytest.raises(DeliveryFailedException):
+            future.result(1)
+
+        assert len(self.attempts) == 1
+
+    def test_transient_failure_is_not_logged_as_an_error(self, caplog):
+        manager = self.manager(1)
+        msg = message()
+
+        assert manager.deliver(msg).result(2) == (msg, True)
+        manager.shutdown()
+
+        assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+
+
+class TestDynamicRetry(TestFuturesRetry):
+    Manager = DynamicManager
+
+
+class TestImmediateRetry(object):
+    def test_bounded_retries(self):
+        attempts = []
+        manager = ImmediateManager(dict(retry_delay=0.01, retry_jitter=0), partial(FlakyTransport, attempts, 10))
+        manager.startup()
+
+        with pytest.raises(DeliveryFailedException):
+            manager.deliver(message(2))
+
+        assert len(attempts) == 3
+        assert attempts[2] - attempts[1] >= 0.015
+
+        manager.shutdown()
@@ -0,0 +1,158 @@
+# encoding: utf-8
+
+"""Test partitioning the dynamic manager's work by destination."""
+
+import threading
+import time
+import pytest
+
+from marrow.mailer import Message
+from marrow.mailer.exc import QueueFullException
+from marrow.mailer.manager.dynamic import DynamicManager, ScalingPoolExecutor, domain
+from marrow.mailer.manager.util import Concurrency, clock
+
+
+try:
+    import DNS
+except ImportError:
+    DNS = None
+
+
+def message(to, subject):
+    return Message('from@example.com', to, subject, plain="Hi.")
+
+
+def until(condition, timeout=5):
+    deadline = clock() + timeout
+
+    while not condition() and clock() < deadline:
+        time.sleep(0.01)
+
+    return condition()
+
+
+class Slow(object):
+    """Work which waits for the gate when given the key 'slow', setting entered as it does."""
+
+    def __init__(self):
+        self.entered = threading.Event()
+        self.gate = threading.Event()
+
+    def __call__(self, key):
+        if key == 'slow':
+            self.entered.set()
+            self.gate.wait(5)
+
+        return key
+
+
+class TestDomain(object):
+    def test_domain(self):
+        assert domain(message('to@Example.COM', "Hi.")) == 'example.com'
+        assert domain(message(['a@zebra.example.com', 'b@apple.example.com'], "Hi.")) == 'apple.example.com'
+        assert domain(object()) is None
+
+
+class TestScalingPoolExecutor(object):
+    def test_held_for_shard(self):
+        work = Slow()
+        executor = ScalingPoolExecutor(4, 1, 5, shard=lambda key: key, shard_workers=1)
+
+        slow = [executor.submit(work, 'slow') for i in range(3)]
+        work.entered.wait(5)
+        fast = [executor.submit(work, 'fast') for i in range(3)]
+
+        for result in fast:
+            assert result.result(2) == 'fast'  # Not stuck behind the slow shard.
+
+        assert executor.depth == 2  # Two slow items held while the first runs.
+        assert not any(result.done() for result in slow)
+
+        work.gate.set()
+
+        for result in slow:
+            assert result.result(2) == 'slow'
+
+        assert executor.depth == 0
+        assert not executor._shards
+
+        executor.shutdown()
+
+    def test_held_counts_against_capacity(self):
+        work = Slow()
+        executor = ScalingPoolExecutor(4, 1, 5, 2, 'raise', shard=lambda key: key, shard_workers=1)
+
+        slow = [executor.submit(work, 'slow') for i in range(3)]
+        assert until(lambda: executor._work_queue.held == 2)
+
+        with pytest.raises(QueueFullException):
+            executor.submit(work, 'fast')
+
+        work.gate.set()
+
+        for result in slow:
+            assert result.result(2) == 'slow'
+
+        assert executor.submit(work, 'fast').result(2) == 'fast'
+        executor.shutdown()
+
+    def test_held_work_regulated(self):
+        work = Slow()
+        limit = Concurrency(dict(concurrency_initial=2), 10)
+        executor = ScalingPoolExecutor(10, 10, 5, concurrency=limit, shard=lambda key: key, shard_workers=1)
+
+        slow = [executor.submit(work, 'slow')]
+        work.entered.wait(5)
+        slow.extend(executor.submit(work, 'slow') for i in range(2))  # Taken up, and held, by a second thread.
+        assert until(lambda: executor._work_queue.held == 2)
+        assert len(executor._threads) == 2
+
+        limit.limit = 1
+        work.gate.set()  # The thread finishing first retires, returning the held work it took up to the queue.
+
+        for result in slow:
+            assert result.result(2) == 'slow'
+
+        assert len(executor._threads) == 1
+        assert not executor._shards
+
+        executor.shutdown()
+
+
+class TestDynamicManager(object):
+    def test_slow_domain_isolated(self, gated):
+        gated.hold = lambda message: domain(message) == 'tarpit.example.com'
+        manager = DynamicManager(dict(workers=4, divisor=1, shard='domain', shard_workers=1), gated)
+        manager.startup()
+
+        slow = [manager.deliver(message('to@tarpit.example.com', "Slow.")) for i in range(6)]
+        fast = [manager.deliver(message('to%d@example.com' % i, "Fast.")) for i in range(6)]
+
+        for result in fast:
+            result.result(2)
+
+        assert gated.subjects == ["Fast."] * 6
+        assert manager.depth == 5
+
+        gated.gate.set()
+
+        for result in slow:
+            result.result(5)
+
+        manager.shutdown()
+
+        assert len(gated.delivered) == 12
+        assert gated.peak == 1
+
+    def test_shard_workers_default(self):
+        assert DynamicManager(dict(workers=8, shard='domain'), None).shard_workers == 2
+        assert DynamicManager(dict(workers=2, shard='domain'), None).shard_workers == 1
+
+    def test_unknown_shard(self):
+        with pytest.raises(ValueError):
+            DynamicManager(dict(shard='country'), None)
+
+    @pytest.mark.skipif(DNS is not None, reason="PyDNS is installed.")
+    def test_mx_requires_pydns(self):
+        with pytest.raises(ImportError):
+            DynamicManager(dict(shard='mx'), None)
@@ -0,0 +1,199 @@
+# encoding: utf-8
+
+"""Test the journal-backed spool delivery manager."""
+
+import os
+import shutil
+import tempfile
+import time
+
+from concurrent import futures
+from functools import partial
+
+from marrow.mailer import Message
+from marrow.mailer.exc import DeliveryFailedException, MessageFailedException, TransportFailedException
+from marrow.mailer.manager.spool import Journal, SpoolManager
+
+
+class RecordingTransport(object):
+    def __init__(self, delivered, config=None):
+        self.ephemeral = False
+        self.delivered = delivered
+
+    def startup(self):
+        pass
+
+    def deliver(self, message):
+        if message.subject == "Undeliverable.":
+            raise MessageFailedException("Refused.")
+
+        if message.subject == "Unreachable.":
+            raise TransportFailedException()
+
+        self.delivered.append(message)
+        return True
+
+    def shutdown(self):
+        pass
+
+
+class TestSpool(object):
+    def setup_method(self, method):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'spool')
+        self.delivered = []
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.directory)
+
+    def manager(self, **config):
+        config.setdefault('path', self.path)
+        return SpoolManager(config, partial(RecordingTransport, self.delivered))
+
+    def message(self, subject="Subject."):
+        return Message('from@example.com', 'to@example.com', subject, plain="Body.")
+
+    def test_delivery_is_acknowledged(self):
+        manager = self.manager()
+        manager.startup()
+
+        for i in range(10):
+            manager.deliver(self.message("Message %d." % i))
+
+        manager.shutdown()
+
+        assert len(self.delivered) == 10
+
+        journal = Journal(self.path)
+        assert journal.open() == []
+        journal.close()
+
+    def test_replay_after_crash(self):
+        message = self.message("Interrupted.")
+        identity = message.id
+
+        journal = Journal(self.path)
+        journal.open()
+        journal.append(SpoolManager.dumps(message))
+        journal.close()
+
+        with open(self.path, 'ab') as fh:
+            fh.write(b'E\x00\x00')  # A torn write.
+
+        manager = self.manager()
+        manager.startup()
+        manager.shutdown()
+
+        assert [i.subject for i in self.delivered] == ["Interrupted."]
+        assert self.delivered[0].id == identity
+
+        manager = self.manager()
+        manager.startup()
+        manager.shutdown()
+
+        assert len(self.delivered) == 1
+
+    def test_durable_commit(self):
+        manager = self.manager(durable=True, interval=1)
+        manager.startup()
+
+        journal = manager.journal
+        manager.deliver(self.message()).result()
+
+        assert journal.synced >= 1
+
+        manager.shutdown()
+
+    def test_durable_by_default(self):
+        assert self.manager().durable
+        assert not self.manager(durable=False).durable
+
+    def test_failures_retained(self):
+        manager = self.manager()
+        manager.startup()
+
+        manager.deliver(self.message("Delivered.")).result()
+        assert manager.deliver(self.message("Undeliverable.")).exception() is not None
+        manager.shutdown()
+
+        assert [message.subject for ident, message in manager.failures()] == ["Undeliverable."]
+
+        manager = self.manager()
+        manager.startup()
+        manager.shutdown()
+
+        assert [message.subject for message in self.delivered] == ["Delivered."]  # Failed, not redelivered.
+        assert len(manager.failures()) == 1  # But still retained.
+
+    def test_abandoned_retry_is_redelivered(self):
+        manager = self.manager(retry_delay=60)
+        manager.startup()
+
+        future = manager.deliver(self.message("Unreachable."))
+        deadline = time.time() + 5
+
+        while not len(manager.scheduler) and time.time() < deadline:  # Until it awaits its retry.
+            time.sleep(0.01)
+
+        manager.shutdown(False)
+
+        assert isinstance(future.exception(1), DeliveryFailedException)
+        assert manager.failures() == []
+
+        journal = Journal(self.path)
+        assert [SpoolManager.loads(payload).subject for ident, payload in journal.open()] == ["Unreachable."]
+        journal.close()
+
+    def test_concluded_after_shutdown(self):
+        message = self.message("Undeliverable.")
+        manager = self.manager()
+        manager.startup()
+
+        ident, position = manager.journal.append(SpoolManager.dumps(message))
+        manager.journal.wait(position)
+        manager.shutdown()
+
+        future = futures.Future()
+        future.set_exception(DeliveryFailedException(message, "Refused."))
+        manager._concluded(ident, message, future)  # As a delivery still running at shutdown(False) concludes.
+
+        assert manager.failures() == []
+
+        journal = Journal(self.path)
+        assert [ident for ident, payload in journal.open()] == [ident]
+        journal.close()
+
+    def test_failures_discarded(self):
+        manager = self.manager(failed='')
+        manager.startup()
+        manager.deliver(self.message("Undeliverable.")).exception()
+        manager.shutdown()
+
+        assert manager.failures() == []
+        assert not os.path.exists(self.path + '.failed')
+
+    def test_bound_mailer_is_not_spooled(self):
+        message = self.message()
+        message.mailer = object()
+
+        assert SpoolManager.loads(SpoolManager.dumps(message)).mailer is None
+
+    def test_compaction(self):
+        journal = Journal(self.path, compact=0)
+        journal.open()
+
+        ident, position = journal.append(b'payload')
+        journal.acknowledge(ident)
+        journal.close()
+
+        assert os.path.getsize(self.path) == 0
+
+    def test_journalled_as_record(self):
+        import pickle
+        
+        message = self.message()
+        payload = SpoolManager.dumps(message)
+        
+        assert payload.startswith(b'MR')
+        assert SpoolManager.loads(payload).subject == message.subject
+        assert SpoolManager.loads(pickle.dumps(message, 2)).subject == message.subject  # Journals predating records.
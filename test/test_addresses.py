@@ -241,3 +241,78 @@ class TestAddressList(object):
 		self.addresses = 'foo@exámple.test'
 		encoded_address = 'foo@xn--exmple-qta.test'
 		assert self.addresses.string_addresses == [encoded_address]
+
+
+class TestAddressCaching(object):
+	def test_immutable(self):
+		addr = Address('Foo', 'foo@example.com')
+		
+		with pytest.raises(AttributeError):
+			addr.name = 'Bar'
+		
+		with pytest.raises(AttributeError):
+			addr.extra = True
+	
+	def test_hashable(self):
+		assert len(set([Address('foo@example.com'), Address(' foo@example.com ')])) == 1
+	
+	def test_hash_consistent_with_string_equality(self):
+		addr = Address('Foo', 'foo@example.com')
+		
+		assert addr == 'Foo <foo@example.com>'
+		assert hash(addr) == hash('Foo <foo@example.com>')
+		assert 'Foo <foo@example.com>' in set([addr])
+	
+	def test_encoding_cached(self):
+		addr = Address('Fóo', 'foo@exámple.test')
+		encoded = addr.encode()
+		
+		assert addr.encode() is encoded
+		assert addr.envelope == 'foo@xn--exmple-qta.test'
+		assert addr.envelope is addr.envelope
+	
+	def test_pickle(self):
+		import pickle
+		
+		addr = Address('Foo', 'foo@example.com')
+		assert pickle.loads(pickle.dumps(addr, 2)) == addr
+	
+	def test_list_slotted(self):
+		import pickle
+		
+		addresses = AddressList(['Fóo <foo@example.com>', 'bar@example.com'], 'iso-8859-1')
+		bytes(addresses)
+		
+		assert not hasattr(addresses, '__dict__')
+		
+		for protocol in (0, 2):
+			restored = pickle.loads(pickle.dumps(addresses, protocol))
+			
+			assert restored == addresses and restored.encoding == 'iso-8859-1'
+			assert bytes(restored) == bytes(addresses)
+	
+	def test_list_cache_invalidation(self):
+		addresses = AddressList(['foo@example.com', 'bar@example.com'])
+		
+		assert unicode(addresses) == 'foo@example.com, bar@example.com'
+		assert bytes(addresses) is bytes(addresses)
+		
+		addresses.append('baz@example.com')
+		assert unicode(addresses) == 'foo@example.com, bar@example.com, baz@example.com'
+		
+		del addresses[0]
+		assert bytes(addresses) == b'bar@example.com, baz@example.com'
+		
+		addresses.reverse()
+		assert unicode(addresses) == 'baz@example.com, bar@example.com'
+		
+		addresses[0] = 'qux@example.com'
+		assert unicode(addresses) == 'qux@example.com, bar@example.com'
+		
+		addresses += ['foo@example.com']
+		assert isinstance(addresses[-1], Address)
+		assert addresses.string_addresses == ['qux@example.com', 'bar@example.com', 'foo@example.com']
+		
+		addresses.pop()
+		addresses.insert(0, Address('foo@example.com'))
+		assert unicode(addresses) == 'foo@example.com, qux@example.com, bar@example.com'
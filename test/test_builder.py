@@ -0,0 +1,129 @@
+# encoding: utf-8
+
+"""Test the email.policy based MIME builders, and benchmark them against the legacy builder."""
+
+import base64
+import email
+import timeit
+
+from email import policy
+
+import pytest
+
+from marrow.mailer import Message
+from marrow.mailer.builder import Builder, SMTP
+
+
+GIF = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+
+
+def build(builder=None, plain="Hello world.\n", subject="Greetings.", **kw):
+	message = Message('Authör <author@example.com>', 'recipient@example.com', subject, plain=plain, **kw)
+	message.builder = builder
+	return message
+
+
+def full(builder=None):
+	message = build(builder, plain="Hello wörld.\n" * 20, rich="<p>Hello wörld.</p>\n" * 20)
+	message.attach('data.bin', b'\0\1\2' * 100)
+	message.embed('pixel.gif', GIF)
+	return message
+
+
+def parts(data):
+	"""Reduce a serialized message to its content types and decoded payloads."""
+	
+	document = email.message_from_bytes(data, policy=policy.default)
+	return [(part.get_content_type(), part.get_content()) for part in document.walk() if not part.is_multipart()]
+
+
+class TestBuilder(object):
+	def test_crlf_bytes(self):
+		data = bytes(full('smtp'))
+		
+		assert data.count(b'\r\n') == data.count(b'\n')
+		assert b'MIME-Version: 1.0\r\n' in data
+	
+	def test_equivalent_content(self):
+		legacy, modern = full(), full('smtp')
+		
+		assert parts(bytes(modern)) == parts(bytes(legacy).replace(b'\n', b'\r\n'))
+		assert email.message_from_bytes(bytes(modern))['Subject'] == "Greetings."
+	
+	@pytest.mark.parametrize('builder', ['smtp', 'smtputf8'])
+	def test_stream(self, builder):
+		message = full(builder)
+		
+		assert b''.join(message.stream(100)) == bytes(message)
+		assert message.reader().read() == bytes(message)
+	
+	@pytest.mark.parametrize('plain,encoding', [
+			("Plain ASCII.\n", '7bit'),
+			("Mostly ASCII, naïve.\n", 'quoted-printable'),
+			("Почти всё по-русски.\n", 'base64'),
+		])
+	def test_cheapest_encoding(self, plain, encoding):
+		document = build('smtp', plain).mime
+		assert document['Content-Transfer-Encoding'] == encoding
+	
+	def test_utf8(self):
+		message = build('smtputf8', "Почти всё по-русски.\n", "Привет.")
+		data = bytes(message)
+		
+		assert message.mime['Content-Transfer-Encoding'] == '8bit'
+		assert "Subject: Привет.".encode('utf-8') in data
+		assert "Authör <author@example.com>".encode('utf-8') in data
+		assert "Почти всё по-русски.".encode('utf-8') in data
+	
+	def test_downgraded(self):
+		message = build('smtputf8', "Почти всё по-русски.\n", "Привет.")
+		
+		assert message.mail_options(True, True) == ['BODY=8BITMIME', 'SMTPUTF8']
+		assert message.mail_options(True, False) == ['BODY=8BITMIME']
+		assert message.mail_options(False, False) == []
+		
+		data = b''.join(message.stream(eight=False, utf8=False))
+		document = email.message_from_bytes(data, policy=policy.default)
+		
+		assert not data.translate(None, bytes(range(128)))
+		assert document['Subject'] == "Привет."
+		assert document.get_content().rstrip() == "Почти всё по-русски."
+	
+	def test_encoded_headers(self):
+		data = bytes(build('smtp', subject="Привет."))
+		
+		assert b'Subject: =?utf-8?' in data
+		assert email.message_from_bytes(data, policy=policy.default)['Subject'] == "Привет."
+	
+	def test_custom(self):
+		message = build(Builder(SMTP.clone(linesep='\n')))
+		assert b'\r\n' not in bytes(message)
+		
+		message = build('marrow.mailer.builder:builders')
+		with pytest.raises(TypeError):
+			message.mime
+	
+	def test_rebuilt_when_changed(self):
+		message = build('smtp')
+		first = bytes(message)
+		
+		message.subject = "Changed."
+		
+		assert bytes(message) != first
+		assert b'Subject: Changed.\r\n' in bytes(message)
+
+
+class TestBenchmark(object):
+	"""Compare the time taken to build and serialize a message with each builder."""
+	
+	def test_build(self, record_property):
+		produced = {}
+		
+		for builder in (None, 'smtp'):
+			def run():
+				produced[builder] = bytes(full(builder))
+			
+			elapsed = min(timeit.repeat(run, number=20, repeat=3)) / 20
+			record_property('seconds_%s' % (builder or 'legacy'), elapsed)
+		
+		assert parts(produced['smtp']) == parts(produced[None].replace(b'\n', b'\r\n'))
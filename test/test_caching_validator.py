@@ -0,0 +1,39 @@
+# encoding: utf-8
+
+"""Test the memoizing e-mail validator shared by all addresses."""
+
+from marrow.mailer.validator import EmailValidator, CachingEmailValidator
+
+
+class TestCachingEmailValidator(object):
+	def test_shared_expression(self):
+		assert EmailValidator().local_part_regex is EmailValidator().local_part_regex
+		assert EmailValidator(local_part_chars='.').local_part_regex is not EmailValidator().local_part_regex
+
+	def test_memoized(self):
+		validator = CachingEmailValidator()
+		calls = []
+		original = validator.validate_domain
+
+		def validate_domain(part):
+			calls.append(part)
+			return original(part)
+
+		validator.validate_domain = validate_domain
+
+		assert validator.validate_email('user@example.com') == ('user@example.com', '')
+		assert validator.validate('user@example.com') == ('user@example.com', '')
+		assert validator.validate_email('bad,user@example.com')[1]
+		assert validator.validate_email('bad,user@example.com')[1]
+		assert calls == ['example.com', 'example.com']
+
+	def test_bounded(self):
+		validator = CachingEmailValidator(size=2)
+
+		for address in ('a@example.com', 'b@example.com', 'a@example.com', 'c@example.com'):
+			validator.validate_email(address)
+
+		assert list(validator._cache) == ['a@example.com', 'c@example.com']
+
+		validator.clear()
+		assert not validator._cache
@@ -214,6 +214,59 @@ class TestMethods(TestCase):
 
 		interface.stop()
 
+	def test_send_priority(self):
+		message = Message('from@example.com', 'to@example.com', "Test.", plain="Hello.")
+
+		given = []
+		
+		class Recording(ImmediateManager):
+			__slots__ = ()
+			
+			def deliver(self, message, *args):
+				given.append(args)
+				return super(Recording, self).deliver(message, *args)
+		
+		interface = Mailer(dict(manager=dict(use=Recording), transport=dict(use='mock'))).start()
+		interface.send(message, priority=1)
+		interface.send(message)
+		interface.stop()
+
+		assert given == [(1, ), ()]
+		assert message.priority is None
+		assert 'X-Priority' not in str(message)
+
+	def test_bulk(self):
+		delivered = []
+		
+		class Recording(MockTransport):
+			def deliver(self, message):
+				delivered.append(message)
+				return {}
+		
+		def message(subject, bcc):
+			return Message('from@example.com', 'list@example.com', subject, bcc=bcc, plain="Hello.")
+		
+		messages = [message("News.", 'a@example.com'), message("Other.", 'b@example.com'),
+				message("News.", ['b@example.com', 'a@example.com']), message("News.", 'c@example.com')]
+		
+		interface = Mailer(dict(manager=dict(use='immediate'), transport=dict(use=Recording)))
+		
+		with pytest.raises(MailerNotRunning):
+			interface.bulk(messages)
+		
+		interface.start()
+		results = interface.bulk(messages)
+		interface.stop()
+		
+		assert len(results) == len(delivered) == 2
+		assert [message.subject for message in delivered] == ["News.", "Other."]
+		assert delivered[0].recipients.string_addresses == ['list@example.com', 'a@example.com', 'b@example.com',
+				'c@example.com']
+		assert delivered[0].id == messages[0].id
+		assert str(delivered[0]) == str(messages[0])  # Blind copies leave the content unchanged.
+		assert delivered[1] is messages[1]
+		assert messages[0].bcc == ['a@example.com']
+	
 	def test_new(self):
 		config = dict(
 			manager=dict(use='immediate'), transport=dict(use='mock'),
@@ -0,0 +1,190 @@
+# encoding: utf-8
+
+"""Test mail merge templates."""
+
+from __future__ import unicode_literals
+
+import pickle
+import re
+import sys
+import pytest
+
+from datetime import datetime
+
+from marrow.mailer import Mailer, Message
+from marrow.mailer.exc import MailerNotRunning
+from marrow.mailer.merge import Template, MergedMessage
+
+
+boundary = re.compile(r'=+\d+==')
+
+
+def normalize(text):
+	"""Boundaries are chosen at random; number them in order of appearance instead."""
+	
+	seen = []
+	
+	def replace(match):
+		if match.group() not in seen:
+			seen.append(match.group())
+		
+		return 'BOUNDARY%d' % seen.index(match.group())
+	
+	return boundary.sub(replace, text)
+
+
+class TestTemplate(object):
+	date = datetime(2012, 12, 21, 12, 0)
+	
+	def prototype(self, **kw):
+		values = dict(subject="Your invoice, {name}", date=self.date,
+				plain="Dear {name},\n\nYour balance is {balance:.2f} €.\nThank you.\n",
+				rich="<p>Dear {name},</p>\n<p>Your balance is {balance:.2f} €.</p>\n")
+		values.update(kw)
+		return Message('billing@example.com', None, **values)
+	
+	def expected(self, merged, record, **kw):
+		"""Build the equivalent message the conventional way."""
+		
+		values = dict(subject="Your invoice, %s" % record['name'], date=self.date,
+				plain="Dear %s,\n\nYour balance is %.2f €.\nThank you.\n" % (record['name'], record['balance']),
+				rich="<p>Dear %s,</p>\n<p>Your balance is %.2f €.</p>\n" % (record['html'], record['balance']),
+				headers=[('Message-Id', merged.id)])
+		values.update(kw)
+		return Message('billing@example.com', record['to'], **values)
+	
+	def test_identical_rendering(self):
+		template = Template(self.prototype())
+		
+		for record in (dict(to='alice@example.com', name="Alice", html="Alice", balance=12.5),
+				dict(to='"Bøb" <bob@example.com>', name="Bøb <b>", html="Bøb &lt;b&gt;", balance=0)):
+			merged = template(record)
+			
+			assert isinstance(merged, MergedMessage)
+			assert normalize(str(merged)) == normalize(str(self.expected(merged, record)))
+	
+	@pytest.mark.parametrize('plain', [
+			"Dear {name},\n\nThank you.\n",  # 7bit
+			"Уважаемый {name},\n\nСпасибо за покупку, сумма {balance:.2f} рублей.\n",  # base64
+		])
+	def test_transfer_encoding(self, plain):
+		template = Template(self.prototype(plain=plain, rich=None))
+		record = dict(to='alice@example.com', name="Alice", balance=1)
+		merged = template(record)
+		expected = self.expected(merged, dict(record, html=None), plain=plain.format(**record), rich=None)
+		
+		assert normalize(str(merged)) == normalize(str(expected))
+		assert merged.mime.get_payload(decode=True) == plain.format(**record).encode('utf-8')
+	
+	def test_eight_bit(self):
+		template = Template(self.prototype())
+		record = dict(to='a@example.com', name="Bøb", html="Bøb", balance=1)
+		merged = template(record)
+		expected = self.expected(merged, record)
+		
+		assert merged.mail_options(True) == expected.mail_options(True) == ['BODY=8BITMIME']
+		assert merged.mail_options(False) == []
+		assert normalize(b''.join(merged.stream(64, True)).decode('utf-8')) == \
+				normalize(b''.join(expected.stream(64, True)).decode('utf-8'))
+	
+	@pytest.mark.skipif(sys.version_info < (3, 6), reason="The alternative builders require Python 3.6.")
+	def test_builder(self):
+		template = Template(self.prototype(builder='smtp'))
+		record = dict(to='a@example.com', name="A", html="A", balance=1)
+		merged = template(record)
+		
+		assert not merged._pristine()
+		assert normalize(str(merged)) == normalize(str(self.expected(merged, record, builder='smtp')))
+	
+	def test_static_subject_and_attachments(self):
+		template = Template(self.prototype(subject="Newsletter", rich=None))
+		template.prototype.attach('logo.txt', b'logo')
+		template = Template(template.prototype)
+		
+		record = dict(to='alice@example.com', name="Alice", balance=1)
+		merged = template(record)
+		expected = self.expected(merged, dict(record, html=None), subject="Newsletter", rich=None)
+		expected.attach('logo.txt', b'logo')
+		
+		assert normalize(str(merged)) == normalize(str(expected))
+		assert merged.attachments[0] is template.prototype.attachments[0]
+	
+	def test_unique_identifiers(self):
+		template = Template(self.prototype())
+		first, second = (template(dict(to='a@example.com', name="A", balance=1)) for i in range(2))
+		
+		assert first.id != second.id
+		assert first.id in str(first)
+	
+	def test_dated_individually(self):
+		template = Template(self.prototype(date=None))
+		record = dict(to='a@example.com', name="A", html="A", balance=1)
+		first = template(record)
+		first._created -= 86400
+		second = template(record)
+		
+		assert first.date != second.date
+		assert normalize(str(first)) == normalize(str(self.expected(first, record, date=first.date)))
+		assert normalize(str(second)) == normalize(str(self.expected(second, record, date=second.date)))
+	
+	def test_stream(self):
+		template = Template(self.prototype())
+		merged = template(dict(to='a@example.com', name="A", balance=1))
+		
+		assert b''.join(merged.stream(64)) == bytes(merged)
+		assert b''.join(template(dict(to='a@example.com', name="A", balance=1)).stream(64)).startswith(b'Content-Type:')
+		assert merged.recipients == ['a@example.com']
+		assert merged.mime['To'] == 'a@example.com'
+	
+	def test_modified(self):
+		template = Template(self.prototype())
+		record = dict(to='a@example.com', name="A", html="A", balance=1)
+		merged = template(record)
+		
+		merged.retries = 0  # Delivery bookkeeping does not affect the content.
+		assert merged._pristine()
+		
+		merged.cc = 'c@example.com'
+		
+		expected = self.expected(merged, record, cc='c@example.com')
+		assert normalize(str(merged)) == normalize(str(expected))
+		assert b''.join(merged.stream()) == bytes(merged)
+	
+	def test_pickle(self):
+		template = Template(self.prototype())
+		record = dict(to='a@example.com', name="A", html="A", balance=1)
+		merged = template(record)
+		
+		restored = pickle.loads(pickle.dumps(merged, 2))
+		
+		assert restored.id == merged.id
+		assert normalize(str(restored)) == normalize(str(merged))
+
+
+class TestMailerMerge(object):
+	def test_delivery(self):
+		mailer = Mailer(dict(manager=dict(use='immediate'), transport=dict(use='mock'))).start()
+		prototype = Message('billing@example.com', None, "Hello {name}", plain="Dear {name}.")
+		
+		results = list(mailer.merge(prototype, (dict(to='%d@example.com' % i, name=i) for i in range(3))))
+		mailer.stop()
+		
+		assert [message.to for message, result in results] == [['0@example.com'], ['1@example.com'], ['2@example.com']]
+		assert all(message.mailer is mailer for message, result in results)
+		assert 'Subject: Hello 2' in str(results[2][0])
+	
+	def test_eager(self):
+		mailer = Mailer(dict(manager=dict(use='immediate'), transport=dict(use='mock')))
+		prototype = Message('billing@example.com', None, "Hello {name}", plain="Dear {name}.")
+		
+		with pytest.raises(MailerNotRunning):
+			mailer.merge(prototype, [dict(to='a@example.com', name="A")])
+		
+		mailer.start()
+		delivered = []
+		mailer.send = lambda message: delivered.append(message) or (message, True)
+		results = mailer.merge(prototype, [dict(to='a@example.com', name="A")])
+		mailer.stop()
+		
+		assert isinstance(results, list)
+		assert len(delivered) == 1
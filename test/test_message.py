@@ -18,6 +18,8 @@ from email.utils import formatdate, parsedate_tz
 
 from marrow.mailer import Message
 from marrow.mailer.address import AddressList
+from marrow.mailer.attachment import AttachmentCache, cache
+from marrow.mailer.transfer import choose
 from marrow.util.compat import basestring, unicode
 
 
@@ -479,9 +481,11 @@ class TestBasicMessage(TestCase):
 		message = self.build_message()
 		assert 'iso-8859-1' not in unicode(message).lower()
 		message.encoding = 'ISO-8859-1'
+		message.plain = "Caf\xe9 au lait."
 		msg = email.message_from_string(str(message))
 		assert msg['Content-Type'] == 'text/plain; charset="iso-8859-1"'
 		assert msg['Content-Transfer-Encoding'] == 'quoted-printable'
+		assert msg.get_payload(decode=True) == b'Caf\xe9 au lait.'
 	
 	# def test_message_encoding_can_be_set_in_config_file(self):
 	#	 interface.config['mail.message.encoding'] = 'ISO-8859-1'
@@ -490,12 +494,25 @@ class TestBasicMessage(TestCase):
 	#	 self.assertEqual('text/plain; charset="iso-8859-1"', msg['Content-Type'])
 	#	 self.assertEqual('quoted-printable', msg['Content-Transfer-Encoding'])
 	
-	def test_plain_utf8_encoding_uses_qp(self):
+	def test_plain_ascii_uses_7bit(self):
 		message = self.build_message()
 		msg = email.message_from_string(str(message))
 		assert msg['Content-Type'] == 'text/plain; charset="utf-8"'
+		assert msg['Content-Transfer-Encoding'] == '7bit'
+	
+	def test_plain_utf8_encoding_uses_qp(self):
+		message = self.build_message()
+		message.plain = "Mostly ASCII text, na\xefvely accented."
+		msg = email.message_from_string(str(message))
 		assert msg['Content-Transfer-Encoding'] == 'quoted-printable'
 	
+	def test_mostly_non_ascii_uses_base64(self):
+		message = self.build_message()
+		message.plain = "\u041f\u0440\u0438\u0432\u0435\u0442, \u043c\u0438\u0440! " * 20
+		msg = email.message_from_string(str(message))
+		assert msg['Content-Transfer-Encoding'] == 'base64'
+		assert msg.get_payload(decode=True).decode('utf-8') == message.plain
+	
 	def test_callable_bodies(self):
 		message = self.build_message()
 		message.plain = lambda: "plain text"
@@ -504,3 +521,522 @@ class TestBasicMessage(TestCase):
 		assert 'plain text' in unicode(message)
 		assert 'rich text' in unicode(message)
 
+
+
+class TestStreamedMessage(object):
+	def build_message(self, **kw):
+		message = Message('author@example.com', 'recipient@example.com', "Subject.", plain="Plain.\n.leading\nFrom here",
+				rich="<p>Rich.</p>", **kw)
+		message.attach('data.bin', b'\0' * 100000)
+		message.embed('pixel.gif', base64.b64decode(TestBasicMessage.gif))
+		return message
+	
+	def test_identical_to_bytes(self):
+		for message in (self.build_message(), Message('author@example.com', 'recipient@example.com', "Subject.",
+				plain="Plain.")):
+			assert b''.join(message.stream()) == bytes(message)
+	
+	def test_bounded_chunks(self):
+		message = self.build_message()
+		chunks = list(message.stream(1024))
+		
+		assert max(len(chunk) for chunk in chunks) <= 1024
+		assert b''.join(chunks) == bytes(message)
+	
+	def test_preamble_and_epilogue(self):
+		message = self.build_message()
+		message.mime.preamble = "This is a MIME message."
+		message.mime.epilogue = "Fin."
+		
+		assert b''.join(message.stream()) == bytes(message)
+	
+	def test_reader(self):
+		message = self.build_message()
+		reader = message.reader(4096)
+		
+		assert reader.readline().startswith(b'Content-Type: multipart/mixed;')
+		assert reader.readline() + reader.read() == bytes(message).partition(b'\n')[2]
+		assert reader.read() == b''
+
+
+class TestLazyAttachment(object):
+	content = bytes(bytearray(range(256))) * 1000
+	
+	@pytest.fixture(autouse=True)
+	def uncached(self, monkeypatch):
+		monkeypatch.setattr(cache, 'limit', 0)
+	
+	def build_message(self):
+		return Message('author@example.com', 'recipient@example.com', "Subject.", plain="Plain.")
+	
+	def test_path_read_on_serialization(self, tmpdir):
+		path = tmpdir.join('data.bin')
+		path.write_binary(b'stale')
+		
+		message = self.build_message()
+		message.attach(str(path))
+		path.write_binary(self.content)
+		
+		part = message.attachments[0]
+		assert part.get_payload(decode=True) == self.content
+		assert base64.b64decode(part.get_payload()) == self.content
+		assert b''.join(message.stream(4096)) == bytes(message)
+	
+	def test_missing_path(self, tmpdir):
+		message = self.build_message()
+		
+		with pytest.raises((IOError, OSError)):
+			message.attach(str(tmpdir.join('missing.bin')))
+	
+	def test_seekable_file(self, tmpdir):
+		path = tmpdir.join('data.bin')
+		path.write_binary(b'header' + self.content)
+		
+		with open(str(path), 'rb') as fh:
+			fh.read(6)
+			message = self.build_message()
+			message.attach('data.bin', fh)
+			fh.read()  # The attachment remembers its own starting offset.
+			
+			assert message.attachments[0].get_payload(decode=True) == self.content
+			assert b''.join(message.stream()) == bytes(message)
+	
+	def test_mmap(self, tmpdir):
+		import mmap
+		
+		path = tmpdir.join('data.bin')
+		path.write_binary(self.content)
+		
+		with open(str(path), 'rb') as fh:
+			mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+			message = self.build_message()
+			message.attach('data.bin', mapping)
+			
+			assert message.attachments[0].get_payload(decode=True) == self.content
+			assert b''.join(message.stream()) == bytes(message)
+			mapping.close()
+	
+	def test_encoding_matches_eager(self):
+		message = self.build_message()
+		message.attach('data.bin', self.content)
+		
+		encoded = message.attachments[0].get_payload()
+		assert encoded == base64.encodebytes(self.content).decode('ascii') if hasattr(base64, 'encodebytes') else \
+				base64.encodestring(self.content)
+	
+	def test_streamed_in_pieces(self):
+		message = self.build_message()
+		message.attach('data.bin', self.content)
+		
+		chunks = list(message.attachments[0].iter_payload())
+		assert len(chunks) > 1
+		assert all(chunk.endswith('\n') for chunk in chunks)
+	
+	def test_pickle_captures_file_content(self, tmpdir):
+		import pickle
+		
+		path = tmpdir.join('data.bin')
+		path.write_binary(self.content)
+		
+		message = self.build_message()
+		
+		with open(str(path), 'rb') as fh:
+			message.attach('data.bin', fh)
+			payload = pickle.dumps(message, 2)
+		
+		restored = pickle.loads(payload)
+		assert restored.attachments[0].get_payload(decode=True) == self.content
+		assert b''.join(restored.stream()) == bytes(restored)
+
+
+class TestAttachmentCache(object):
+	content = b'%PDF-1.4 invoice' * 1000
+	
+	@pytest.fixture(autouse=True)
+	def isolated(self, monkeypatch):
+		monkeypatch.setattr('marrow.mailer.message.cache', AttachmentCache(budget=1024 * 1024))
+	
+	def build_message(self):
+		return Message('author@example.com', 'recipient@example.com', "Subject.", plain="Plain.")
+	
+	def test_shared_payload(self):
+		from marrow.mailer import message as module
+		
+		first, second = self.build_message(), self.build_message()
+		first.attach('invoice.pdf', self.content)
+		second.attach('invoice.pdf', bytearray(self.content))
+		
+		assert first.attachments[0].get_payload() is second.attachments[0].get_payload()
+		assert module.cache.hits == 1 and module.cache.misses == 1
+		assert base64.b64decode(first.attachments[0].get_payload()) == self.content
+		assert b''.join(second.stream()) == bytes(second)
+	
+	def test_path_keyed_by_modification(self, tmpdir):
+		import os
+		
+		path = tmpdir.join('logo.bin')
+		path.write_binary(b'first')
+		
+		first, second, third = self.build_message(), self.build_message(), self.build_message()
+		first.attach(str(path))
+		second.attach(str(path))
+		
+		assert first.attachments[0].get_payload() is second.attachments[0].get_payload()
+		
+		path.write_binary(b'second version')
+		os.utime(str(path), (0, 0))
+		third.attach(str(path))
+		
+		assert third.attachments[0].get_payload(decode=True) == b'second version'
+	
+	def test_path_read_when_serialized(self, tmpdir):
+		from marrow.mailer import message as module
+		
+		path = tmpdir.join('small.bin')
+		path.write_binary(b'first')
+		
+		message = self.build_message()
+		message.attach(str(path))
+		
+		assert len(module.cache) == 0
+		assert message.attachments[0]._text is None
+		
+		path.write_binary(b'second version')
+		
+		assert message.attachments[0].get_payload(decode=True) == b'second version'
+		assert b''.join(message.stream()) == bytes(message)
+		assert len(module.cache) == 1
+	
+	def test_embedded_kind_remembered(self, tmpdir):
+		from marrow.mailer import message as module
+		
+		path = tmpdir.join('pixel.gif')
+		path.write_binary(base64.b64decode(TestBasicMessage.gif))
+		
+		calls = []
+		sniff = module.imghdr.what
+		
+		def what(*args):
+			calls.append(args)
+			return sniff(*args)
+		
+		module.imghdr.what = what
+		
+		try:
+			for i in range(3):
+				message = self.build_message()
+				message.embed(str(path))
+				assert message.embedded[0].get_content_type() == 'image/gif'
+		
+		finally:
+			module.imghdr.what = sniff
+		
+		assert len(calls) == 1
+	
+	def test_eviction_by_size(self):
+		local = AttachmentCache(budget=1000, limit=500)
+		
+		for i in range(10):
+			key = local.key(bytes(bytearray([i])) * 300)
+			local.encoded(key, bytes(bytearray([i])) * 300)
+		
+		assert local.size <= 1000
+		assert len(local) == 2  # Each 300 byte chunk encodes to 406 characters.
+		assert local.key(b'x' * 501) is None
+	
+	def test_large_content_remains_lazy(self):
+		from marrow.mailer import message as module
+		
+		message = self.build_message()
+		message.attach('large.bin', b'x' * 200000)
+		
+		assert len(module.cache) == 0
+		assert message.attachments[0]._text is None
+
+
+class TestRenderingCache(object):
+	def build_message(self, **kw):
+		return Message('author@example.com', 'recipient@example.com', "Subject.", plain="Plain.", **kw)
+	
+	def test_rendering_reused(self):
+		message = self.build_message()
+		
+		assert str(message) is str(message)
+		assert bytes(message) is bytes(message)
+	
+	def test_delivery_bookkeeping_preserves_rendering(self):
+		message = self.build_message()
+		rendered, identifier = bytes(message), message.id
+		
+		message.retries -= 1
+		message.mailer = None
+		message.bcc = 'hidden@example.com'
+		
+		assert bytes(message) is rendered
+		assert message.id == identifier
+	
+	def test_header_change_reuses_body(self):
+		message = self.build_message(rich="<p>Rich.</p>")
+		mime, parts = message.mime, message._parts
+		
+		message.subject = "Another subject."
+		
+		assert message.mime is not mime
+		assert message._parts is parts
+		assert 'Another subject.' in str(message)
+		assert 'Subject: Subject.' in mime.as_string()  # The previous document is unaffected.
+	
+	def test_single_part_headers_independent(self):
+		message = self.build_message()
+		first = str(message)
+		
+		message.subject = "Another subject."
+		second = str(message)
+		
+		assert first.count('Subject:') == second.count('Subject:') == 1
+		assert 'Another subject.' in second
+	
+	def test_body_change(self):
+		message = self.build_message()
+		parts = message.mime and message._parts
+		
+		message.plain = "Replaced."
+		
+		assert 'Replaced.' in str(message)
+		assert message._parts is not parts
+	
+	def test_attachment_invalidates(self):
+		message = self.build_message()
+		rendered, parts = str(message), message._parts
+		
+		message.attach('data.txt', b'attached')
+		
+		assert str(message) is not rendered
+		assert 'YXR0YWNoZWQ=' in str(message)
+		assert message._parts is parts
+	
+	def test_dynamic_body_reevaluated(self):
+		calls = []
+		
+		def plain():
+			calls.append(None)
+			return "Plain %d." % len(calls)
+		
+		message = self.build_message()
+		message.plain = plain
+		
+		assert 'Plain 1.' in str(message)
+		assert 'Plain 1.' in str(message)
+		
+		message.subject = "Another subject."
+		assert 'Plain 2.' in str(message)
+
+
+
+class TestTransferEncoding(object):
+	text = "Gr\xfc\xdfe aus K\xf6ln.\n" * 4
+	
+	def build(self, **kw):
+		return Message('author@example.com', 'recipient@example.com', "Subject.", plain=self.text, **kw)
+	
+	@pytest.mark.parametrize('data,eight,encoding', [
+			(b'Plain ASCII.\n', False, '7bit'),
+			(b'Plain ASCII.\n', True, '7bit'),
+			("Na\xefve.\n".encode('utf-8'), True, '8bit'),
+			("Na\xefve, mostly ASCII.\n".encode('utf-8'), False, 'quoted-printable'),
+			("\u041f\u0440\u0438\u0432\u0435\u0442.\n".encode('utf-8'), False, 'base64'),
+			(b'x' * 1000, False, 'quoted-printable'),  # Overlong lines must be encoded.
+			("\xe9".encode('utf-8') * 1000, True, 'base64'),
+			(b'Bare\rreturn.', True, 'quoted-printable'),
+		])
+	def test_choose(self, data, eight, encoding):
+		assert choose(data, eight) == encoding
+	
+	def test_ascii_unaffected(self):
+		message = Message('author@example.com', 'recipient@example.com', "Subject.", plain="Plain.", rich="<p>Rich.</p>")
+		
+		assert b''.join(message.stream(eight=True)) == bytes(message)
+		assert message.mail_options(True, True) == []
+	
+	def test_eight_bit(self):
+		message = self.build(rich="<p>%s</p>" % (self.text, ))
+		message.attach('data.bin', b'\0\1\2')
+		
+		data = b''.join(message.stream(100, eight=True))
+		document = email.message_from_bytes(data) if hasattr(email, 'message_from_bytes') else email.message_from_string(data)
+		plain, rich = [part for part in document.walk() if part.get_content_maintype() == 'text']
+		
+		assert plain['Content-Transfer-Encoding'] == '8bit'
+		assert self.text.encode('utf-8') in data
+		assert plain.get_payload(decode=True).decode('utf-8') == self.text
+		assert rich.get_payload(decode=True).decode('utf-8') == "<p>%s</p>" % (self.text, )
+		assert message.mail_options(True, False) == ['BODY=8BITMIME']
+	
+	def test_seven_bit(self):
+		message = self.build()
+		data = b''.join(message.stream(eight=False))
+		
+		assert data == bytes(message)
+		assert not data.translate(None, bytes(bytearray(range(128))))
+		assert message.mime['Content-Transfer-Encoding'] != '8bit'
+		assert message.mail_options(False, False) == []
+
+
+class TestRecord(object):
+	def build(self):
+		message = Message(('Author', 'author@example.com'), ['one@example.com', ('Two', 'two@example.com')],
+				"Subject \xe9.", plain="Plain.", rich="<p>Rich.</p>")
+		message.cc = 'cc@example.com'
+		message.bcc = 'bcc@example.com'
+		message.sender = 'sender@example.com'
+		message.headers = [('X-Campaign', 'spring')]
+		message.retries = 7
+		message.attach('data.bin', b'\0\1\2' * 1000)
+		return message
+	
+	def test_round_trip(self):
+		message = self.build()
+		message.id  # Assigned identifiers are retained.
+		restored = Message.from_record(message.to_record())
+		
+		for name in ('subject', 'date', 'plain', 'rich', 'headers', 'retries', 'encoding', 'id'):
+			assert getattr(restored, name) == getattr(message, name), name
+		
+		for name in ('author', 'to', 'cc', 'bcc'):
+			assert list(getattr(restored, name)) == list(getattr(message, name)), name
+		
+		assert restored.sender == message.sender
+		assert restored.mailer is None
+		assert restored.attachments[0].get_payload(decode=True) == b'\0\1\2' * 1000
+		assert restored.attachments[0]['Content-Disposition'] == message.attachments[0]['Content-Disposition']
+	
+	def test_compact(self):
+		import pickle
+		
+		message = self.build()
+		str(message)  # Populate the rendering caches.
+		
+		assert len(message.to_record()) < 0.7 * len(pickle.dumps(message, 2))
+	
+	def test_path_referenced(self, tmpdir):
+		path = tmpdir.join('large.bin')
+		path.write_binary(b'x' * 100000)
+		
+		message = self.build()
+		message.attach(str(path))
+		data = message.to_record()
+		
+		assert len(data) < 10000
+		assert Message.from_record(data).attachments[1].get_payload(decode=True) == b'x' * 100000
+	
+	def test_missing_file_restored(self, tmpdir):
+		path = tmpdir.join('removed.bin')
+		path.write_binary(b'x' * 100)
+		
+		message = self.build()
+		message.attach(str(path))
+		data = message.to_record()
+		path.remove()
+		
+		restored = Message.from_record(data)  # Only reading the content, at delivery, fails.
+		
+		with pytest.raises(IOError):
+			bytes(restored)
+	
+	def test_callable_body_evaluated(self):
+		message = self.build()
+		message.plain = lambda: "Rendered."
+		
+		assert Message.from_record(message.to_record()).plain == "Rendered."
+	
+	def test_callable_strategy_refused(self):
+		message = self.build()
+		message.builder = lambda message, plain, rich: None
+		
+		with pytest.raises(TypeError):
+			message.to_record()
+	
+	def test_validated(self):
+		import pickle
+		
+		data = self.build().to_record()
+		
+		with pytest.raises(ValueError):
+			Message.from_record(b'XX' + data[2:])
+		
+		with pytest.raises(ValueError):
+			Message.from_record(data[:2] + b'\xff' + data[3:])
+		
+		with pytest.raises(pickle.UnpicklingError):
+			Message.from_record(data[:3] + pickle.dumps(Message, 2))
+
+
+class TestFootprint(object):
+	"""Measure the memory held by each queued message."""
+	
+	class Original(object):
+		"""The attributes each message was given on construction before messages were slotted, as originally."""
+		
+		def __init__(self, author, to, subject, plain):
+			self._id = None
+			self._processed = False
+			self._dirty = False
+			self.mailer = None
+			
+			self.subject = subject
+			self.date = datetime.now()
+			self.encoding = 'utf-8'
+			self.organization = None
+			self.priority = None
+			self.plain = plain
+			self.rich = None
+			self.attachments = []
+			self.embedded = []
+			self.headers = []
+			self.retries = 3
+			self.brand = True
+			
+			self._sender = None
+			self._author = AddressList(author)
+			self._to = AddressList(to)
+			self._cc = AddressList()
+			self._bcc = AddressList()
+			self._reply = AddressList()
+			self._notify = AddressList()
+	
+	def measure(self, cls, count=2000):
+		tracemalloc = pytest.importorskip('tracemalloc')
+		
+		build = lambda i: cls('author@example.com', 'to%d@example.com' % i, "Subject.", plain="Body.")
+		build(0)
+		
+		tracemalloc.start()
+		
+		try:
+			before = tracemalloc.get_traced_memory()[0]
+			messages = [build(i) for i in range(count)]
+			used = tracemalloc.get_traced_memory()[0] - before
+		
+		finally:
+			tracemalloc.stop()
+		
+		assert len(messages) == count
+		return used // count
+	
+	def test_lazy_allocation(self):
+		message = Message('author@example.com', 'to@example.com', "Subject.", plain="Body.")
+		
+		assert message._cc is None and message._attachments is None and message._date is None
+		assert not message.__dict__
+		
+		message.cc.append('cc@example.com')
+		assert message._cc == ['cc@example.com']
+		assert isinstance(message.date, datetime)
+	
+	def test_benchmark(self, record_property):
+		slotted, original = self.measure(Message), self.measure(self.Original)
+		
+		record_property('bytes_per_message', slotted)
+		record_property('bytes_per_original_message', original)
+		
+		assert slotted < original * 0.8
@@ -0,0 +1,80 @@
+# encoding: utf-8
+
+"""Test the Message-ID generators."""
+
+from __future__ import unicode_literals
+
+import re
+import threading
+
+from functools import partial
+
+from marrow.mailer import Message, msgid
+
+
+class TestGenerators(object):
+	def setup_method(self, method):
+		self.original = msgid.hostname()
+		msgid.hostname('mail.example.com')
+
+	def teardown_method(self, method):
+		msgid.hostname(self.original)
+
+	def test_hostname_cached(self, monkeypatch):
+		calls = []
+		monkeypatch.setattr(msgid.socket, 'getfqdn', lambda: calls.append(1) or 'resolved.example.com')
+		monkeypatch.setattr(msgid, '_hostname', None)
+
+		assert msgid.hostname() == 'resolved.example.com'
+		assert msgid.hostname() == 'resolved.example.com'
+		assert len(calls) == 1
+
+	def test_formats(self):
+		for name, generator in msgid.generators.items():
+			assert re.match(r'^<[0-9A-Za-z.]+@mail\.example\.com>$', generator()), name
+			assert generator('example.org').endswith('@example.org>'), name
+
+	def test_ulid_ordered(self):
+		identifiers = [msgid.ulid() for i in range(1000)]
+
+		assert len(identifiers[0]) == len('<@mail.example.com>') + 26
+		assert identifiers == sorted(identifiers)
+		assert len(set(identifiers)) == 1000
+
+	def test_unique_in_bulk(self):
+		for name, generator in msgid.generators.items():
+			assert len(set(generator() for i in range(100000))) == 100000, name
+
+	def test_unique_across_threads(self):
+		for generator in (msgid.standard, msgid.counter, msgid.ulid):
+			identifiers = []
+
+			def produce():
+				identifiers.extend(generator() for i in range(500))
+
+			threads = [threading.Thread(target=produce) for i in range(4)]
+
+			for thread in threads:
+				thread.start()
+
+			for thread in threads:
+				thread.join()
+
+			assert len(set(identifiers)) == 2000
+
+
+class TestMessageGenerator(object):
+	def test_default(self):
+		assert Message().id.startswith('<')
+
+	def test_named(self):
+		message = Message(id_generator='ulid')
+		assert len(message.id.partition('@')[0]) == 27
+
+	def test_callable(self):
+		message = Message(id_generator=partial(msgid.counter, 'example.org'))
+		assert message.id.endswith('@example.org>')
+
+	def test_reference(self):
+		message = Message(id_generator='marrow.mailer.msgid:ulid')
+		assert len(message.id.partition('@')[0]) == 27
@@ -0,0 +1,247 @@
+# encoding: utf-8
+
+"""Test the asynchronous SMTP transport against an in-process ESMTP server."""
+
+import asyncio
+import pytest
+
+from marrow.mailer import Message
+from marrow.mailer.exc import (MessageFailedException, TransportExhaustedException, TransportException,
+        TransportFailedException)
+from marrow.mailer.transport.aiosmtp import AsyncSMTPTransport
+
+
+class Server(object):
+    """A minimal ESMTP server recording received commands and messages."""
+
+    def __init__(self, extensions=('PIPELINING', 'SIZE 1000000', 'AUTH PLAIN'), refuse=(), quota=None):
+        self.extensions = extensions
+        self.refuse = refuse
+        self.quota = quota  # Messages accepted before DATA is deferred.
+        self.commands = []
+        self.messages = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        self.server.close()
+
+    async def handle(self, reader, writer):
+        writer.write(b'220 test ESMTP\r\n')
+        recipients, data = [], None
+
+        while True:
+            line = await reader.readline()
+
+            if not line:
+                break
+
+            if data is not None:
+                if line == b'.\r\n':
+                    self.messages.append((recipients, b''.join(data)))
+                    recipients, data = [], None
+                    writer.write(b'250 Queued\r\n')
+                else:
+                    data.append(line)
+                continue
+
+            self.commands.append(line)
+            command = line[:4].upper()
+
+            if command == b'EHLO':
+                lines = [b'test'] + [i.encode('ascii') for i in self.extensions]
+                writer.write(b''.join(b'250' + (b' ' if i == len(lines) - 1 else b'-') + l + b'\r\n' for i, l in enumerate(lines)))
+            elif command == b'AUTH':
+                writer.write(b'235 Authenticated\r\n')
+            elif command == b'RCPT':
+                address = line[9:].strip().strip(b'<>').decode('ascii')
+
+                if address in self.refuse:
+                    writer.write(b'550 Unknown\r\n')
+                else:
+                    recipients.append(address)
+                    writer.write(b'250 OK\r\n')
+            elif command == b'DATA':
+                if self.quota is not None and len(self.messages) >= self.quota:
+                    recipients = []
+                    writer.write(b'452 Try later\r\n')
+                elif recipients:
+                    data = []
+                    writer.write(b'354 Go ahead\r\n')
+                else:
+                    writer.write(b'554 No valid recipients\r\n')
+            elif command == b'STAR':
+                writer.write(b'454 TLS not available\r\n')
+            elif command == b'QUIT':
+                writer.write(b'221 Bye\r\n')
+                break
+            else:
+                writer.write(b'250 OK\r\n')
+
+            await writer.drain()
+
+        writer.close()
+
+
+class UnencodableTransport(AsyncSMTPTransport):
+    """Fail to serialize the message part way through DATA, as an 8-bit body might without 8BITMIME."""
+
+    __slots__ = ()
+
+    def content(self, message):
+        def stream():
+            yield b'Subject: Partial.\r\n'
+            raise UnicodeEncodeError('ascii', u'\u2713', 0, 1, "ordinal not in range(128)")
+
+        return stream, []
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class TestAsyncSMTPTransport(object):
+    def message(self, *recipients):
+        return Message('from@example.com', list(recipients) or 'to@example.com', "Subject.", plain="Body.")
+
+    def test_delivery(self):
+        async def scenario():
+            server = Server()
+            transport = AsyncSMTPTransport(dict(port=await server.start(), tls=False, local_hostname='client', pipeline=10))
+
+            try:
+                await transport.startup()
+                assert transport.connected
+                assert 'pipelining' in transport.features
+
+                message = self.message('a@example.com', 'b@example.com')
+                assert await transport.deliver(message) == {}
+                await transport.shutdown()
+
+            finally:
+                server.stop()
+
+            assert not transport.connected
+            return server, message
+
+        server, message = run(scenario())
+
+        assert len(server.messages) == 1
+        recipients, data = server.messages[0]
+        assert recipients == ['a@example.com', 'b@example.com']
+        assert data.replace(b'\r\n', b'\n').decode('ascii') == str(message).rstrip('\n') + '\n'
+
+    def test_exhaustion_and_refusal(self):
+        async def scenario():
+            server = Server(refuse=('b@example.com', ))
+            transport = AsyncSMTPTransport(dict(port=await server.start(), tls=False, local_hostname='client', username='bob', password='dole'))
+
+            try:
+                with pytest.raises(TransportExhaustedException) as exc:
+                    await transport.deliver(self.message('a@example.com', 'b@example.com'))
+
+                assert exc.value.result == {'b@example.com': (550, b'Unknown')}
+
+                transport.pipeline = 10
+
+                with pytest.raises(MessageFailedException):
+                    await transport.deliver(self.message('b@example.com'))
+
+                await transport.shutdown()
+
+            finally:
+                server.stop()
+
+            return server
+
+        server = run(scenario())
+        assert any(command.startswith(b'AUTH PLAIN') for command in server.commands)
+
+    def test_interrupted_after_delivery(self):
+        async def scenario():
+            server = Server(quota=1)
+            transport = AsyncSMTPTransport(dict(port=await server.start(), tls=False, local_hostname='client',
+                    pipeline=10, max_recipients=1))
+
+            try:
+                refused = await transport.deliver(self.message('a@example.com', 'b@example.com', 'c@example.com'))
+                await transport.shutdown()
+
+            finally:
+                server.stop()
+
+            return server, refused
+
+        server, refused = run(scenario())
+
+        assert [recipients for recipients, data in server.messages] == [['a@example.com']]
+        assert refused == {'b@example.com': (452, b'Try later'), 'c@example.com': (452, b'Try later')}
+
+    def test_lock_step_without_pipelining(self):
+        async def scenario():
+            server = Server(extensions=('SIZE 1000000', ))
+            transport = AsyncSMTPTransport(dict(port=await server.start(), tls=False, local_hostname='client', pipeline=10))
+
+            try:
+                await transport.deliver(self.message('a@example.com', 'b@example.com'))
+                await transport.shutdown()
+
+            finally:
+                server.stop()
+
+            return server
+
+        server = run(scenario())
+        assert len(server.messages) == 1
+
+    def test_required_tls(self):
+        async def scenario():
+            server = Server()
+            transport = AsyncSMTPTransport(dict(port=await server.start(), tls='required', local_hostname='client'))
+
+            try:
+                with pytest.raises(TransportException):
+                    await transport.startup()
+
+            finally:
+                server.stop()
+
+        run(scenario())
+
+    def test_unexpected_failure_retires_connection(self):
+        async def scenario():
+            server = Server()
+            transport = UnencodableTransport(dict(port=await server.start(), tls=False, local_hostname='client',
+                    pipeline=10))
+
+            try:
+                with pytest.raises(TransportFailedException):
+                    await transport.deliver(self.message())
+
+                assert not transport.connected
+
+            finally:
+                server.stop()
+
+            return server
+
+        assert not run(scenario()).messages
+
+    @pytest.mark.skipif(not hasattr(asyncio.StreamWriter, 'start_tls'), reason="STARTTLS requires Python 3.11.")
+    def test_refused_starttls_closes_connection(self):
+        async def scenario():
+            server = Server(extensions=('STARTTLS', ))
+            transport = AsyncSMTPTransport(dict(port=await server.start(), tls='optional', local_hostname='client'))
+
+            try:
+                with pytest.raises(TransportException):
+                    await transport.startup()
+
+                assert not transport.connected
+
+            finally:
+                server.stop()
+
+        run(scenario())
@@ -0,0 +1,53 @@
+# encoding: utf-8
+
+"""Test that the on-disk transports write streamed messages intact."""
+
+import mailbox
+import os
+import shutil
+import tempfile
+
+from marrow.mailer import Message
+from marrow.mailer.transport.maildir import MaildirTransport
+from marrow.mailer.transport.mbox import MailboxTransport
+
+
+class TestStreamedDelivery(object):
+    def setup_method(self, method):
+        self.path = tempfile.mkdtemp()
+        self.message = Message('from@example.com', 'to@example.com', "Subject.", plain="Body.\nFrom the start.")
+        self.message.attach('data.bin', b'\0' * 100000)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.path)
+
+    def test_maildir(self):
+        directory = os.path.join(self.path, 'maildir')
+        mailbox.Maildir(directory, create=True)
+
+        transport = MaildirTransport(dict(directory=directory))
+        transport.startup()
+        transport.deliver(self.message)
+        transport.shutdown()
+
+        box = mailbox.Maildir(directory)
+        key, = box.keys()
+
+        assert box.get_bytes(key) == bytes(self.message)
+        assert box[key].get_subdir() == 'new'
+
+    def test_mbox(self):
+        filename = os.path.join(self.path, 'mbox')
+
+        transport = MailboxTransport(dict(file=filename))
+        transport.startup()
+        transport.deliver(self.message)
+        transport.deliver(self.message)
+        transport.shutdown()
+
+        messages = list(mailbox.mbox(filename))
+
+        assert len(messages) == 2
+        assert messages[0].get_from().startswith('MAILER-DAEMON')
+        assert messages[0]['Subject'] == "Subject."
+        assert b'\n>From the start.' in messages[1].as_bytes()
@@ -0,0 +1,53 @@
+# encoding: utf-8
+
+"""Test delivery by piping messages to a sendmail command."""
+
+import os
+import stat
+import sys
+import pytest
+
+from marrow.mailer import Message
+from marrow.mailer.exc import MessageFailedException, TransportFailedException
+from marrow.mailer.transport.sendmail import SendmailTransport
+
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason="Requires a POSIX shell.")
+
+
+class TestSendmailTransport(object):
+    def command(self, tmpdir, script):
+        path = str(tmpdir.join('sendmail'))
+
+        with open(path, 'w') as fh:
+            fh.write("#!/bin/sh\n" + script + "\n")
+
+        os.chmod(path, stat.S_IRWXU)
+        return SendmailTransport(dict(path=path))
+
+    def message(self):
+        message = Message('from@example.com', 'to@example.com', "Subject.", plain="Body.")
+        message.attach('data.bin', b'\0' * 1000000)  # Larger than any pipe buffer.
+        return message
+
+    def test_delivered(self, tmpdir):
+        transport = self.command(tmpdir, 'cat > "$(dirname "$0")/delivered"')
+        message = self.message()
+
+        transport.deliver(message)
+
+        assert tmpdir.join('delivered').read_binary() == bytes(message)
+
+    def test_failed(self, tmpdir):
+        transport = self.command(tmpdir, 'cat > /dev/null; exit 3')
+
+        with pytest.raises(MessageFailedException):
+            transport.deliver(self.message())
+
+    def test_exits_without_reading(self, tmpdir):
+        transport = self.command(tmpdir, 'exit 75')
+
+        with pytest.raises(TransportFailedException) as excinfo:
+            transport.deliver(self.message())
+
+        assert 'Status code 75' in str(excinfo.value)
@@ -0,0 +1,314 @@
+# encoding: utf-8
+
+"""Test RFC 2920 command pipelining and bulk envelopes in the SMTP transport."""
+
+from __future__ import unicode_literals
+
+import pytest
+
+from collections import deque
+from smtplib import SMTPRecipientsRefused, SMTPSenderRefused, SMTPDataError, quotedata
+
+from marrow.mailer import Message
+from marrow.mailer.exc import TransportExhaustedException, MessageFailedException
+from marrow.mailer.transport.smtp import SMTPTransport, quote_chunks
+
+
+class ScriptedConnection(object):
+    """A stand-in for smtplib.SMTP replaying canned replies and counting network round trips."""
+
+    def __init__(self, replies, extensions=('pipelining', )):
+        self.replies = deque(replies)
+        self.extensions = extensions
+        self.esmtp_features = {}
+        self.sent = []
+        self.fallback = None
+        self.turns = 0
+        self.sock = True
+        self._writing = False
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, name):
+        return name.lower() in self.extensions
+
+    def send(self, data):
+        self.sent.append(data)
+        self._writing = True
+
+    def getreply(self):
+        if self._writing:
+            self.turns += 1
+            self._writing = False
+
+        return self.replies.popleft()
+
+    def rset(self):
+        self.sent.append('rset\r\n')
+
+    def close(self):
+        self.sock = None
+
+    def sendmail(self, sender, recipients, content, mail_options=()):
+        self.fallback = (sender, recipients, content)
+        return {}
+
+
+class TestPipelining(object):
+    def build(self, replies, recipients=1, **kw):
+        message = Message('from@example.com', ['to%d@example.com' % i for i in range(recipients)], "Subject.", plain="Body.\n.leading dot")
+        transport = SMTPTransport(dict(pipeline=10, **kw))
+        transport.connection = ScriptedConnection(replies)
+        return transport, message
+
+    def test_batched_envelope(self):
+        recipients = 50
+        replies = [(250, b'OK')] + [(250, b'OK')] * recipients + [(354, b'Go ahead'), (250, b'Queued')]
+        transport, message = self.build(replies, recipients)
+
+        transport.deliver(message)
+
+        connection = transport.connection
+        assert connection.turns == 2
+        assert not connection.replies
+
+        commands = connection.sent[0].split('\r\n')
+        assert commands[0] == 'mail FROM:<from@example.com>'
+        assert commands[1] == 'rcpt TO:<to0@example.com>'
+        assert commands[recipients + 1] == 'data'
+
+        content = connection.sent[1]
+        assert content.endswith(b'\r\n.\r\n')
+        assert b'\r\n..leading dot\r\n' in content
+        assert content == bytes(message).replace(b'\n', b'\r\n').replace(b'\n.', b'\n..') + b'\r\n.\r\n'
+        assert transport.sent == 1
+
+    def test_partial_refusal(self):
+        replies = [(250, b'OK'), (250, b'OK'), (550, b'Unknown'), (354, b'Go ahead'), (250, b'Queued')]
+        transport, message = self.build(replies, 2)
+
+        refused = transport.sendmail('from@example.com', ['to0@example.com', 'to1@example.com'], str(message))
+        assert refused == {'to1@example.com': (550, b'Unknown')}
+
+    def test_refused_sender(self):
+        replies = [(550, b'No'), (503, b'Need MAIL'), (503, b'Need RCPT')]
+        transport, message = self.build(replies)
+
+        with pytest.raises(SMTPSenderRefused):
+            transport.sendmail('from@example.com', ['to0@example.com'], str(message))
+
+        assert transport.connection.sent[-1] == 'rset\r\n'
+
+    def test_refused_recipients_with_accepted_data(self):
+        replies = [(250, b'OK'), (550, b'Unknown'), (354, b'Go ahead'), (554, b'No valid recipients')]
+        transport, message = self.build(replies)
+
+        with pytest.raises(SMTPRecipientsRefused):
+            transport.sendmail('from@example.com', ['to0@example.com'], str(message))
+
+        assert transport.connection.sent[1] == '.\r\n'
+        assert not transport.connection.replies
+
+    def test_rejected_data(self):
+        replies = [(250, b'OK'), (250, b'OK'), (354, b'Go ahead'), (552, b'Too big')]
+        transport, message = self.build(replies)
+
+        with pytest.raises(SMTPDataError):
+            transport.sendmail('from@example.com', ['to0@example.com'], str(message))
+
+    def test_closing_server(self):
+        replies = [(250, b'OK'), (421, b'Bye'), (421, b'Bye')]
+        transport, message = self.build(replies)
+
+        with pytest.raises(SMTPRecipientsRefused):
+            transport.sendmail('from@example.com', ['to0@example.com'], str(message))
+
+        assert transport.connection.sock is None
+
+    def test_fallback_without_extension(self):
+        transport, message = self.build([])
+        transport.connection.extensions = ()
+
+        assert transport.sendmail('from@example.com', ['to0@example.com'], "Data.") == {}
+        assert transport.connection.fallback == ('from@example.com', ['to0@example.com'], "Data.")
+
+    def test_disabled(self):
+        transport, message = self.build([], pipelining='no')
+
+        transport.sendmail('from@example.com', ['to0@example.com'], "Data.")
+        assert transport.connection.fallback
+
+    def test_streamed_lock_step(self):
+        replies = [(250, b'OK'), (250, b'OK'), (550, b'Unknown'), (354, b'Go ahead'), (250, b'Queued')]
+        transport, message = self.build(replies, 2, pipelining='no', buffer=100)
+
+        refused = transport.sendmail('from@example.com', ['to0@example.com', 'to1@example.com'], message.stream)
+
+        connection = transport.connection
+        assert refused == {'to1@example.com': (550, b'Unknown')}
+        assert connection.fallback is None
+        assert connection.turns == 5
+        assert connection.sent[:4] == ['mail FROM:<from@example.com>\r\n', 'rcpt TO:<to0@example.com>\r\n',
+                'rcpt TO:<to1@example.com>\r\n', 'data\r\n']
+        assert len(connection.sent) > 5  # The content was written in several pieces.
+        assert b''.join(connection.sent[4:]).endswith(b'\r\n..leading dot\r\n.\r\n')
+
+
+    def test_content_failure_drops_connection(self):
+        replies = [(250, b'OK'), (250, b'OK'), (354, b'Go ahead')]
+        transport, message = self.build(replies)
+
+        def content():
+            yield b'Partial content.\n'
+            raise IOError("Attachment missing.")
+
+        with pytest.raises(IOError):
+            transport.sendmail('from@example.com', ['to0@example.com'], content)
+
+        assert not transport.connected  # Closed without a QUIT the server would read as content.
+        transport.shutdown()
+
+
+class TestQuoteChunks(object):
+    def quote(self, *chunks):
+        return b''.join(quote_chunks(chunks))
+
+    def test_equivalent_to_quotedata(self):
+        text = "First\n.second\r\nthird\r.fourth\n\n..fifth"
+        expect = quotedata(text) + '\r\n'
+
+        for size in (1, 2, 3, 7, len(text)):
+            chunks = [text[i:i + size].encode('ascii') for i in range(0, len(text), size)]
+            assert self.quote(*chunks) == expect.encode('ascii'), size
+
+    def test_leading_period(self):
+        assert self.quote(b'.', b'x\n') == b'..x\r\n'
+
+    def test_terminated(self):
+        assert self.quote(b'a\n') == b'a\r\n'
+        assert self.quote(b'a\r') == b'a\r\n'
+        assert self.quote() == b''
+
+
+class TestBulkEnvelope(object):
+    def build(self, recipients, replies, **kw):
+        message = Message('from@example.com', 'to@example.com', "Subject.", plain="Body.")
+        message.bcc = ['bcc%d@example.com' % i for i in range(recipients - 1)]
+        transport = SMTPTransport(dict(**kw))
+        transport.connection = ScriptedConnection(replies)
+        return transport, message
+
+    def accept(self, *sizes):
+        replies = []
+
+        for size in sizes:
+            replies.extend([(250, b'OK')] * (size + 1))
+            replies.extend([(354, b'Go ahead'), (250, b'Queued')])
+
+        return replies
+
+    def test_split_transactions(self):
+        transport, message = self.build(250, self.accept(100, 100, 50), max_recipients=100)
+
+        with pytest.raises(TransportExhaustedException) as exc:
+            transport.deliver(message)
+
+        assert exc.value.result == {}
+        assert transport.sent == 1  # Messages, not transactions.
+        assert transport.connection.turns == 6
+
+        envelopes, bodies = transport.connection.sent[::2], transport.connection.sent[1::2]
+        assert [envelope.count('rcpt TO:') for envelope in envelopes] == [100, 100, 50]
+        assert len(set(bodies)) == 1
+
+    def test_server_limit(self):
+        transport, message = self.build(5, self.accept(2, 2, 1), max_recipients=10, pipeline=10)
+        transport.connection.esmtp_features['limits'] = 'MAILMAX=50 RCPTMAX=2'
+
+        assert transport.recipient_limit == 2
+        assert transport.deliver(message) == {}
+        assert transport.sent == 1
+
+    def test_unlimited_by_default(self):
+        transport, message = self.build(250, self.accept(250), pipeline=10)
+
+        assert transport.recipient_limit == 0
+        assert transport.deliver(message) == {}
+        assert transport.connection.sent[0].count('rcpt TO:') == 250
+
+        transport.connection.esmtp_features['limits'] = 'RCPTMAX=100'
+        assert transport.recipient_limit == 100
+
+    def test_interrupted_after_delivery(self):
+        replies = self.accept(2) + [(250, b'OK'), (250, b'OK'), (250, b'OK'), (354, b'Go ahead'), (452, b'Try later')]
+        transport, message = self.build(5, replies, max_recipients=2, pipeline=10)
+
+        refused = transport.deliver(message)  # Not a failure; the first transaction was delivered.
+
+        assert sorted(refused) == ['bcc1@example.com', 'bcc2@example.com', 'bcc3@example.com']
+        assert set(refused.values()) == {(452, b'Try later')}
+        assert transport.connection.turns == 4  # The last transaction was never attempted.
+
+    def test_closed_after_delivery(self):
+        replies = self.accept(2) + [(250, b'OK'), (250, b'OK'), (421, b'Closing'), (354, b'Go ahead')]
+        transport, message = self.build(5, replies, max_recipients=2, pipeline=10)
+
+        refused = transport.deliver(message)
+
+        assert sorted(refused) == ['bcc1@example.com', 'bcc2@example.com', 'bcc3@example.com']
+        assert refused['bcc2@example.com'] == (421, b'Closing')
+        assert refused['bcc3@example.com'][0] == 421
+        assert not transport.connected
+
+    def test_per_recipient_report(self):
+        replies = [(250, b'OK'), (250, b'OK'), (550, b'Unknown'), (354, b'Go ahead'), (250, b'Queued')]
+        replies += [(250, b'OK'), (550, b'Unknown'), (354, b'Go ahead'), (554, b'No valid recipients')]
+        transport, message = self.build(3, replies, max_recipients=2, pipeline=10)
+
+        refused = transport.deliver(message)
+
+        assert refused == {'bcc0@example.com': (550, b'Unknown'), 'bcc1@example.com': (550, b'Unknown')}
+        assert transport.sent == 1
+
+    def test_all_refused(self):
+        replies = [(250, b'OK'), (550, b'Unknown'), (503, b'No recipients')] * 2
+        transport, message = self.build(2, replies, max_recipients=1, pipeline=10)
+
+        with pytest.raises(MessageFailedException):
+            transport.deliver(message)
+
+
+class TestEightBit(object):
+    text = "Viele Gr\xfc\xdfe aus K\xf6ln, und bis bald.\n"
+    
+    def deliver(self, features, **kw):
+        message = Message('from@example.com', 'to@example.com', "Subject.", plain=self.text)
+        transport = SMTPTransport(dict(pipeline=10, **kw))
+        transport.connection = ScriptedConnection([(250, b'OK'), (250, b'OK'), (354, b'Go ahead'), (250, b'Queued')],
+                ('pipelining', ) + features)
+        transport.connection.esmtp_features = dict((feature, '') for feature in features)
+        
+        transport.deliver(message)
+        
+        return transport.connection.sent[0].split('\r\n')[0], b''.join(transport.connection.sent[1:])
+    
+    def test_advertised(self):
+        command, content = self.deliver(('8bitmime', ))
+        
+        assert command == 'mail FROM:<from@example.com> BODY=8BITMIME'
+        assert b'Content-Transfer-Encoding: 8bit\r\n' in content
+        assert self.text.replace('\n', '\r\n').encode('utf-8') in content
+    
+    def test_not_advertised(self):
+        command, content = self.deliver(())
+        
+        assert command == 'mail FROM:<from@example.com>'
+        assert b'Content-Transfer-Encoding: quoted-printable\r\n' in content
+        assert not content.translate(None, bytes(bytearray(range(128))))
+    
+    def test_disabled(self):
+        command, content = self.deliver(('8bitmime', ), eightbit='no')
+        
+        assert command == 'mail FROM:<from@example.com>'
+        assert b'Content-Transfer-Encoding: quoted-printable\r\n' in content